@@ -34,10 +34,14 @@ import re
 import urllib
 import web
 import string
+import time
+import calendar
 
 import bookserver.catalog as catalog
 import bookserver.catalog.output as output
 import bookserver.device
+import bookserver.snapshot
+import bookserver.compress
 
 numRows = 50
 
@@ -52,6 +56,47 @@ pubInfo = {
     'urnroot'  : 'urn:x-internet-archive:bookserver:aggregator',
 }
 
+# Solr fields used by the renderer for each output mode. The atom feed
+# doesn't show formats or summaries, and the html page doesn't show subjects.
+solrFields = {
+    'xml'  : ('urn', 'title', 'updated', 'date', 'creator', 'subject', 'publisher',
+              'language', 'provider', 'link', 'price', 'currencyCode'),
+    'html' : ('urn', 'title', 'updated', 'date', 'creator', 'publisher', 'language',
+              'provider', 'format', 'summary', 'link', 'price', 'currencyCode'),
+}
+
+# compileQueries()
+#______________________________________________________________________________
+# Builds the solr query for each route and output mode. Called once at
+# startup; call it again after changing pubInfo.
+def compileQueries():
+    def compileQuery(**kwargs):
+        return dict((mode, catalog.ingest.SolrQuery(pubInfo['solr_base'], fields=fields, **kwargs))
+                    for (mode, fields) in solrFields.iteritems())
+
+    return {
+        'alpha'      : compileQuery(sort='titleSorter asc', rows=numRows),
+        'provider'   : compileQuery(sort='titleSorter asc', rows=numRows),
+        'opensearch' : compileQuery(sort='titleSorter asc', rows=numRows),
+        'htmlsearch' : compileQuery(sort='titleSorter asc', rows=numRows),
+    }
+
+queries = compileQueries()
+
+# One keep-alive connection pool to solr, shared by all request threads
+solrTransport = catalog.ingest.SolrTransport(maxConnections = 8,
+                                             connectTimeout = 2.0,
+                                             readTimeout    = 10.0,
+                                             retries        = 2)
+
+# The navigation feeds can be rendered ahead of time to static files by
+# running `opds_aggregator.py --snapshot DIR` from cron. Set snapshot to
+# bookserver.snapshot.Snapshot(DIR) to serve them from there, or point the
+# front web server at DIR. Snapshots older than snapshotMaxAge seconds, or
+# written before the last midnight, are ignored.
+snapshot       = None
+snapshotMaxAge = 2*3600
+
 urls = (
     '/(.*)/',                       'redirect',
     '/alpha.(xml|html)',            'alphaList',
@@ -80,7 +125,11 @@ providers = {
     'Feedbooks' : "Feedbooks",
 }
 
-application = web.application(urls, globals()).wsgifunc()
+# Responses over minSize bytes are gzipped for clients that accept it.
+def compressMiddleware(app):
+    return bookserver.compress.CompressMiddleware(app, minSize = 1024)
+
+application = web.application(urls, globals()).wsgifunc(compressMiddleware)
 
 
 def getEnv(key, default = None):
@@ -90,22 +139,68 @@ def getEnv(key, default = None):
     else:
         return default
         
+# getDevice()
+#______________________________________________________________________________
+# Returns None for devices without a page variant of their own (see
+# bookserver.device.Device.variant), so they are served the snapshot.
+# Pages rendered for a device depend on the User-Agent, so caches are told.
 def getDevice():
+    web.header('Vary', 'User-Agent')
     userAgent = getEnv('HTTP_USER_AGENT')
     if userAgent is not None:
         device = bookserver.device.Detect.createFromUserAgent(userAgent)
+        if device is not None and device.variant is not None:
+            return device
+    return None
+
+# snapshotPage()
+#______________________________________________________________________________
+# Returns the body of a page from the static snapshot, or None if there is
+# no snapshot of it that is still current.
+def snapshotPage(name, datestr):
+    if snapshot is None:
+        return None
+
+    midnight  = calendar.timegm(time.strptime(datestr, '%Y-%m-%dT%H:%M:%SZ'))
+    notBefore = max(midnight, time.time() - snapshotMaxAge)
+    return snapshot.read(name, notBefore)
+
+# navigationPage()
+#______________________________________________________________________________
+# Serves a navigation feed from the snapshot if possible, or renders it.
+# HTML pages rendered for a particular device are never snapshotted.
+def navigationPage(name, page, mode):
+    datestr = catalog.getCurrentDate()
+    device  = None
+    if 'html' == mode:
+        device = getDevice()
+
+    web.header('Content-Type', types[mode])
+
+    if device is None:
+        body = snapshotPage(name, datestr)
+        if body is not None:
+            return body
+
+    return renderNavigation(page.createCatalog(mode, datestr), mode, device)
+
+# renderNavigation()
+#______________________________________________________________________________
+def renderNavigation(c, mode, device = None):
+    if 'xml' == mode:
+        r = output.CatalogToAtom(c)
     else:
-        device = None
-    return device
+        r = output.ArchiveCatalogToHtml(c, device = device)
+    return r.toString()
 
 
 # /
 #______________________________________________________________________________
 class index:
     def GET(self, mode='xml'):
+        return navigationPage('index.' + mode, self, mode)
 
-        datestr = catalog.getCurrentDate()
-        
+    def createCatalog(self, mode, datestr):
         c = catalog.Catalog(
                             title     = pubInfo['name'] + ' Aggregator',
                             urn       = pubInfo['urnroot'],
@@ -143,15 +238,8 @@ class index:
         osDescriptionDoc = 'http://bookserver.archive.org/aggregator/opensearch.xml'
         o = catalog.OpenSearch(osDescriptionDoc)
         c.addOpenSearch(o)
-        
-        if 'html' == mode:
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            web.header('Content-Type', 'text/html')
-            return r.toString()
-        else:        
-            r = output.CatalogToAtom(c)
-            web.header('Content-Type', pubInfo['mimetype'])
-            return r.toString()
+
+        return c
 
 # /alpha/a/0
 #______________________________________________________________________________
@@ -170,14 +258,15 @@ class alpha:
             
         
         #TODO: add Image PDFs to this query
-        solrUrl = pubInfo['solr_base'] + '&q=firstTitle%3A'+letter.upper()+'&sort=titleSorter+asc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl = queries['alpha'][mode].getUrl('firstTitle:'+letter.upper(), start=start*numRows)
         titleFragment = 'books starting with "%s"' % (letter.upper())
         urn           = pubInfo['urnroot'] + ':%s:%d'%(letter, start)
 
         ingestor = catalog.ingest.SolrToCatalog(pubInfo, solrUrl, urn,
                                                 start=start, numRows=numRows,
                                                 urlBase='%s/alpha/%s/' % (pubInfo['url_base'], letter),
-                                                titleFragment = titleFragment)
+                                                titleFragment = titleFragment,
+                                                transport = solrTransport)
         c = ingestor.getCatalog()
     
         if 'html' == mode:
@@ -203,8 +292,9 @@ class alphaList:
         #from search engine results, let's change the updated date every midnight
         #TODO: create a version of /alpha.xml with the correct updated dates,
         #and cache it for an hour to ease load on solr
-        datestr = catalog.getCurrentDate()
-                           
+        return navigationPage('alpha.' + extension, self, extension)
+
+    def createCatalog(self, extension, datestr):
         c = catalog.Catalog(
                             title     = pubInfo['name'] + ' Aggregator - All Titles',
                             urn       = pubInfo['urnroot'] + ':titles:all',
@@ -228,15 +318,8 @@ class alphaList:
         osDescriptionDoc = 'http://bookserver.archive.org/aggregator/opensearch.xml'
         o = catalog.OpenSearch(osDescriptionDoc)
         c.addOpenSearch(o)
-        
-        web.header('Content-Type', types[extension])
 
-        if ('xml' == extension):
-            r = output.CatalogToAtom(c)
-        else:
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-
-        return r.toString()
+        return c
 
 # /provider/x/0
 #______________________________________________________________________________
@@ -252,14 +335,15 @@ class provider:
             start = int(start)
         
         #TODO: add Image PDFs to this query
-        solrUrl = pubInfo['solr_base'] + '&q=provider%3A'+domain+'&sort=titleSorter+asc&rows='+str(numRows)+'&start='+str(start*numRows)        
+        solrUrl = queries['provider'][mode].getUrl('provider:'+domain, start=start*numRows)
         titleFragment = 'books for provider ' + providers[domain]
         urn           = pubInfo['urnroot'] + ':provider:%s:%d' % (domain,start)
 
         ingestor = catalog.ingest.SolrToCatalog(pubInfo, solrUrl, urn,
                                                 start=start, numRows=numRows,
                                                 urlBase='%s/provider/%s/' % (pubInfo['url_base'], domain),
-                                                titleFragment = titleFragment)
+                                                titleFragment = titleFragment,
+                                                transport = solrTransport)
         c = ingestor.getCatalog()
     
         web.header('Content-Type', types[mode])
@@ -277,8 +361,9 @@ class provider:
 class providerList:
     def GET(self, mode):
         #TODO: get correct updated dates
-        datestr = catalog.getCurrentDate()
-                           
+        return navigationPage('providers.' + mode, self, mode)
+
+    def createCatalog(self, mode, datestr):
         c = catalog.Catalog(
                             title     = pubInfo['name'] + ' Aggregator - All Providers',
                             urn       = pubInfo['urnroot'] + ':providers:all',
@@ -306,14 +391,8 @@ class providerList:
         osDescriptionDoc = 'http://bookserver.archive.org/aggregator/opensearch.xml'
         o = catalog.OpenSearch(osDescriptionDoc)
         c.addOpenSearch(o)
-            
-        web.header('Content-Type', types[mode])
-        if ('xml' == mode):
-            r = output.CatalogToAtom(c)
-        else:
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
 
-        return r.toString()
+        return c
         
 # /opensearch
 #______________________________________________________________________________        
@@ -328,7 +407,7 @@ class opensearch:
 
         q  = params['?q'][0]
         qq = urllib.quote(q)     
-        solrUrl = pubInfo['solr_base'] + '&q=' + qq +'&sort=titleSorter+asc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl = queries['opensearch']['xml'].getUrl(q, start=start*numRows)
         
         # solrUrl       = pubInfo['solr_base'] + '&q='+qq+'+AND+mediatype%3Atexts+AND+(format%3A(LuraTech+PDF)+OR+scanner:google)&sort=month+desc&rows='+str(numRows)+'&start='+str(start*numRows)
         titleFragment = 'search results for ' + q
@@ -337,7 +416,8 @@ class opensearch:
         ingestor = catalog.ingest.SolrToCatalog(pubInfo, solrUrl, urn,
                                                 start=start, numRows=numRows,
                                                 urlBase='%s/opensearch?q=%s&start=' % (pubInfo['url_base'], qq),
-                                                titleFragment = titleFragment)
+                                                titleFragment = titleFragment,
+                                                transport = solrTransport)
 
         c = ingestor.getCatalog()
 
@@ -394,7 +474,7 @@ class htmlsearch:
                     q += formatStr
         
         qq = urllib.quote(q)
-        solrUrl = pubInfo['solr_base'] + '&q=' + qq +'&sort=titleSorter+asc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl = queries['htmlsearch']['html'].getUrl(q, start=start*numRows)
 
         #solrUrl       = pubInfo['solr_base'] + '?q='+qq+'+AND+mediatype%3Atexts+AND+format%3A(LuraTech+PDF)&fl=identifier,title,creator,oai_updatedate,date,contributor,publisher,subject,language,format&rows='+str(numRows)+'&start='+str(start*numRows)+'&wt=json'        
         titleFragment = 'search results for ' + q
@@ -405,7 +485,8 @@ class htmlsearch:
                                                 # XXX assuming calling from archive.org/bookserver/catalog
                                                 # XXX HTML output is adding .html to end...
                                                 urlBase='/bookserver/catalog/search?q=%s&start=' % (qq),
-                                                titleFragment = titleFragment)
+                                                titleFragment = titleFragment,
+                                                transport = solrTransport)
 
         c = ingestor.getCatalog()
         
@@ -443,9 +524,31 @@ class indexRedirect:
             web.seeother('/')
 
 
+# writeSnapshot()
+#______________________________________________________________________________
+# Renders the navigation feeds, in both output modes, to static files.
+snapshotPages = (
+    ('index.xml',      index,        'xml'),
+    ('index.html',     index,        'html'),
+    ('alpha.xml',      alphaList,    'xml'),
+    ('alpha.html',     alphaList,    'html'),
+    ('providers.xml',  providerList, 'xml'),
+    ('providers.html', providerList, 'html'),
+    )
+
+def writeSnapshot(snapshot):
+    datestr = catalog.getCurrentDate()
+    for (name, page, mode) in snapshotPages:
+        snapshot.write(name, renderNavigation(page().createCatalog(mode, datestr), mode))
+
+
 # main() - standalone mode
 #______________________________________________________________________________        
 if __name__ == "__main__":
-    #run in standalone mode
-    app = web.application(urls, globals())
-    app.run()
\ No newline at end of file
+    if 3 == len(sys.argv) and '--snapshot' == sys.argv[1]:
+        #e.g. from cron: opds_aggregator.py --snapshot /var/www/aggregator-snapshot
+        writeSnapshot(bookserver.snapshot.Snapshot(sys.argv[2]))
+    else:
+        #run in standalone mode
+        app = web.application(urls, globals())
+        app.run(compressMiddleware)
\ No newline at end of file
@@ -26,20 +26,32 @@ This is a very simple crawler for OPDS feeds.
 It fetches one feed per provider, and pages through each feed using rel=next links.
 
 It stores the fetched data in warc files, and addes new books to a solr search engine.
+
+Run with --test to run the doctests instead of crawling.
 '''
 
 # Configuration
 #_______________________________________________________________________________
 
 config = {'warc_dir':              '/2/crawler/data',
-          'default_sleep_seconds': 5,  #TODO: set this per domain from robots.txt
+          'default_sleep_seconds': 5,  #between requests to a host whose robots.txt sets no Crawl-delay
+          'max_fetches':           4,  #concurrent fetches, across all hosts
+          'max_fetches_per_host':  2,  #concurrent fetches to one host
+          'seen_max_exact':        100*1000,       #urls kept in an exact seen-set
+          'seen_capacity':         10*1000*1000,   #urls in the bloom filter that replaces it
+          'seen_error_rate':       0.001,          #chance that a new url is skipped as seen
+          'dns_ttl_seconds':       300,  #how long a host's address is reused for warc records
           'max_warc_size':         1000*1024*1024,
          }
 
-#sorted_by_date is to enable early-exit of the crawl.
+userAgent = 'Internet Archive OPDS Crawler +http://bookserver.archive.org'
+
+#sorted_by_date is to enable early-exit of the crawl: set it for feeds whose
+#entries are sorted newest first, like /new, and the crawl stops following
+#links once it reaches entries older than the newest one of the last crawl.
 
 feeds = (
-         {'domain':'IA', 'url':'http://bookserver.archive.org/catalog/crawlable', 'sorted_by_date':False},
+         {'domain':'IA', 'url':'http://bookserver.archive.org/catalog/crawlable', 'sorted_by_date':True},
          #{'domain':'OReilly', 'url':'http://catalog.oreilly.com/stanza/alphabetical.xml', 'sorted_by_date':False},
          #{'domain':'Feedbooks', 'url':'http://www.feedbooks.com/discover/authors.atom', 'sorted_by_date':False},
         )
@@ -47,7 +59,7 @@ feeds = (
 
 import feedparser #import feedparser before eventlet
 
-from eventlet import coros, httpc, util
+from eventlet import api, coros, httpc, tpool, util
 
 ## From the eventlet examples page:
 # replace socket with a cooperative coroutine socket because httpc
@@ -61,8 +73,17 @@ import time
 import glob
 import re
 import tempfile
-import Queue
 import string
+import collections
+import robotparser
+import hashlib
+import math
+import struct
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
 
 import datetime
 import xml.utils.iso8601
@@ -154,10 +175,9 @@ def urlInWarc(url, warcFileName, tempdir):
 
 # addToWarc()
 #_______________________________________________________________________________
-def addToWarc(w, uri, data, f, mime):
-    o  = urlparse.urlparse(uri)
-    ip = socket.gethostbyname(o.hostname)
-
+# ip is the address of the host the data came from, for the WARC-IP-Address
+# field
+def addToWarc(w, uri, data, f, mime, ip):
     r = WRecord()
     r.setRecordType(warc.WARC_RESOURCE_RECORD)
     r.setTargetUri(uri, len(uri)) 
@@ -277,26 +297,538 @@ def addToSolr(feed, f, tempdir):
         
         os.unlink(solr_import_xml)
 
+# parseCrawlDelay()
+#_______________________________________________________________________________
+# Returns the number of seconds robots.txt asks us to wait between requests,
+# from a Crawl-delay or Request-rate line, or None. A group for our user agent
+# takes precedence over the group for '*', as in robotparser.
+def parseCrawlDelay(lines, userAgent):
+    """
+    >>> parseCrawlDelay(['User-agent: *', 'Crawl-delay: 10'], userAgent)
+    10.0
+    >>> parseCrawlDelay(['User-agent: *', 'Crawl-delay: 10', '',
+    ...                  'User-agent: Internet', 'Request-rate: 1/2m # one every two minutes'], userAgent)
+    120.0
+    >>> print parseCrawlDelay(['User-agent: Googlebot', 'Crawl-delay: 10'], userAgent)
+    None
+
+    A blank line ends a group, and an empty User-agent names no one:
+    >>> print parseCrawlDelay(['User-agent: *', '', 'Crawl-delay: 10'], userAgent)
+    None
+    >>> print parseCrawlDelay(['User-agent:', 'Crawl-delay: 10'], userAgent)
+    None
+    """
+    robotName = userAgent.split('/')[0].lower()
+    delays    = {}
+    agents    = []
+    inAgents  = False
+    for line in lines:
+        if not line:
+            agents   = []
+            inAgents = False
+            continue
+
+        line = line.split('#')[0].strip()
+        if ':' not in line:
+            continue
+
+        (key, value) = line.split(':', 1)
+        key   = key.strip().lower()
+        value = value.strip()
+
+        if 'user-agent' == key:
+            if not inAgents:
+                agents = []
+            if value:
+                agents.append(value.lower())
+            inAgents = True
+            continue
+
+        inAgents = False
+        delay    = None
+        try:
+            if 'crawl-delay' == key:
+                delay = float(value)
+            elif 'request-rate' == key:
+                (requests, seconds) = value.split('/')
+                unit = {'s': 1, 'm': 60, 'h': 3600}.get(seconds[-1:].lower())
+                if unit is None:
+                    unit = 1
+                else:
+                    seconds = seconds[:-1]
+                delay = float(seconds) * unit / float(requests)
+        except (ValueError, ZeroDivisionError):
+            continue
+
+        if delay is not None:
+            for agent in agents:
+                delays.setdefault(agent, delay)
+
+    for (agent, delay) in delays.iteritems():
+        if '*' != agent and agent in robotName:
+            return delay
+    return delays.get('*')
+
+# canonicalUrl()
+#_______________________________________________________________________________
+# Returns the form of url that is used to recognize pages that were already
+# queued: scheme and host in lower case, no default port, no fragment, dot
+# segments removed, and percent escapes in upper case, with unreserved
+# characters unescaped. The query is kept in its order.
+def canonicalUrl(url):
+    """
+    >>> canonicalUrl('HTTP://Bookserver.Archive.org:80/catalog/./alpha/../new?start=50#top')
+    'http://bookserver.archive.org/catalog/new?start=50'
+    >>> canonicalUrl('http://www.feedbooks.com/%7euser/books.atom?q=a%2fb')
+    'http://www.feedbooks.com/~user/books.atom?q=a%2Fb'
+    >>> canonicalUrl('https://catalog.oreilly.com:443')
+    'https://catalog.oreilly.com/'
+    """
+    (scheme, netloc, path, query, fragment) = urlparse.urlsplit(url)
+    scheme = scheme.lower()
+
+    (userinfo, at, hostport) = netloc.rpartition('@')
+    hostport = hostport.lower()
+    for (defaultScheme, defaultPort) in (('http', ':80'), ('https', ':443')):
+        if defaultScheme == scheme and hostport.endswith(defaultPort):
+            hostport = hostport[:-len(defaultPort)]
+    netloc = userinfo + at + hostport
+
+    if '/.' in path:
+        segments = path.split('/')
+        kept     = []
+        for segment in segments:
+            if '..' == segment:
+                if len(kept) > 1:
+                    kept.pop()
+            elif '.' != segment:
+                kept.append(segment)
+        if segments[-1] in ('.', '..'):
+            kept.append('')
+        path = '/'.join(kept)
+    if not path:
+        path = '/'
+
+    path  = percentEscape.sub(normalizeEscape, path)
+    query = percentEscape.sub(normalizeEscape, query)
+    return urlparse.urlunsplit((scheme, netloc, path, query, ''))
+
+percentEscape = re.compile('%[0-9a-fA-F]{2}')
+unreserved    = frozenset(string.ascii_letters + string.digits + '-._~')
+
+# normalizeEscape()
+#_______________________________________________________________________________
+def normalizeEscape(m):
+    c = chr(int(m.group(0)[1:], 16))
+    if c in unreserved:
+        return c
+    return m.group(0).upper()
+
+# BloomFilter
+#_______________________________________________________________________________
+# A set of strings in a fixed number of bits. Membership tests can give false
+# positives, at errorRate while fewer than capacity strings were added, but
+# never false negatives.
+class BloomFilter(object):
+
+    def __init__(self, capacity, errorRate):
+        self.numBits   = int(math.ceil(-capacity * math.log(errorRate) / math.log(2) ** 2))
+        self.numHashes = max(1, int(round(self.numBits * math.log(2) / capacity)))
+        self.bits      = bytearray((self.numBits + 7) // 8)
+
+    # positions()
+    #___________________________________________________________________________
+    # The bits of key, from two halves of its md5 (double hashing)
+    def positions(self, key):
+        (h1, h2) = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(h1 + i * h2) % self.numBits for i in xrange(self.numHashes)]
+
+    def add(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            bits[p >> 3] |= 1 << (p & 7)
+
+    def __contains__(self, key):
+        bits = self.bits
+        for p in self.positions(key):
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+# SeenSet
+#_______________________________________________________________________________
+# The canonical urls that a crawl has queued. Small crawls keep them in a set.
+# Once there are more than maxExact of them, they are moved to a bloom filter,
+# so memory stays bounded at the cost of skipping a few new urls as seen.
+class SeenSet(object):
+    """
+    >>> seen = SeenSet(maxExact = 2, capacity = 100, errorRate = 0.01)
+    >>> [seen.add(url) for url in ('a', 'b', 'a', 'c', 'b', 'd')]
+    [True, True, False, True, False, True]
+    >>> seen.bloom is not None, len(seen)
+    (True, 4)
+    """
+
+    def __init__(self, maxExact, capacity, errorRate):
+        self.maxExact  = maxExact
+        self.capacity  = capacity
+        self.errorRate = errorRate
+        self.urls      = set()
+        self.bloom     = None
+        self.numUrls   = 0
+
+    def __len__(self):
+        return self.numUrls
+
+    # add()
+    #___________________________________________________________________________
+    # Adds url and returns True, or returns False if it was (probably) added
+    # before.
+    def add(self, url):
+        if self.bloom is None:
+            if url in self.urls:
+                return False
+            self.urls.add(url)
+            if len(self.urls) > self.maxExact:
+                self.bloom = BloomFilter(self.capacity, self.errorRate)
+                for u in self.urls:
+                    self.bloom.add(u)
+                self.urls = None
+        else:
+            if url in self.bloom:
+                return False
+            self.bloom.add(url)
+
+        self.numUrls += 1
+        return True
+
+# Host
+#_______________________________________________________________________________
+# The frontier of one host: the urls waiting to be fetched from it, and how
+# often and how many at once they can be fetched. Up to maxFetches worker
+# coroutines take urls from the queue; each fetch starts at least delay
+# seconds after the one before it.
+class Host(object):
+
+    def __init__(self, netloc, robots, delay, maxFetches):
+        self.netloc     = netloc
+        self.robots     = robots
+        self.delay      = delay
+        self.maxFetches = maxFetches
+        self.queue      = collections.deque()
+        self.workers    = 0
+        self.nextFetch  = 0.0
+
+    def add(self, frontier, crawl, url):
+        self.queue.append((crawl, url))
+        if self.workers < self.maxFetches:
+            self.workers += 1
+            api.spawn(self.work, frontier)
+
+    def work(self, frontier):
+        try:
+            while self.queue:
+                (crawl, url) = self.queue.popleft()
+
+                #reserve the next start time before sleeping, so that the
+                #other workers of this host wait for the one after it
+                now  = time.time()
+                wait = self.nextFetch - now
+                self.nextFetch = max(now, self.nextFetch) + self.delay
+                if wait > 0:
+                    api.sleep(wait)
+
+                print "<- %s fetching %s for domain %s" % (time.asctime(), url, crawl.feed['domain'])
+                try:
+                    previous = crawl.state.get(canonicalUrl(url))
+                    (status, headers, data) = frontier.fetch(url, conditionalHeaders(previous))
+                    crawlFeedOnePage(crawl, url, status, headers, data)
+                except Exception, e:
+                    print "!! %s failed to crawl %s for domain %s: %s" % (time.asctime(), url, crawl.feed['domain'], e)
+                    crawl.failures += 1
+                crawl.pageDone()
+        finally:
+            self.workers -= 1
+
+# Resolver
+#_______________________________________________________________________________
+# Looks up the addresses of hosts, for warc records, and keeps them for ttl
+# seconds. gethostbyname() blocks, and eventlet does not make it cooperative,
+# so lookups run in eventlet's thread pool instead of stalling every fetch.
+# Coroutines that want a host that is already being looked up wait for that
+# lookup rather than starting another.
+class Resolver(object):
+
+    def __init__(self, ttl):
+        self.ttl       = ttl
+        self.addresses = {}
+        self.lookups   = {}
+
+    # resolve()
+    #___________________________________________________________________________
+    def resolve(self, hostname):
+        cached = self.addresses.get(hostname)
+        if cached is not None and cached[1] > time.time():
+            return cached[0]
+
+        lookup = self.lookups.get(hostname)
+        if lookup is not None:
+            return lookup.wait()
+
+        lookup = coros.event()
+        self.lookups[hostname] = lookup
+        try:
+            ip = tpool.execute(socket.gethostbyname, hostname)
+        except Exception, e:
+            del self.lookups[hostname]
+            lookup.send(exc=e)
+            raise
+
+        del self.lookups[hostname]
+        self.addresses[hostname] = (ip, time.time() + self.ttl)
+        lookup.send(ip)
+        return ip
+
+# Frontier
+#_______________________________________________________________________________
+# The urls of all running crawls, queued per host. Politeness is per host,
+# so feeds on the same host share its Crawl-delay; at most maxFetches
+# fetches run at once over all hosts.
+class Frontier(object):
+
+    def __init__(self, maxFetches):
+        self.hosts = {}
+        self.slots = coros.semaphore(maxFetches)
+        self.resolver = Resolver(config['dns_ttl_seconds'])
+
+    # getHost()
+    #___________________________________________________________________________
+    # Returns the Host for url, reading its robots.txt the first time.
+    def getHost(self, url):
+        o    = urlparse.urlparse(url)
+        host = self.hosts.get(o.netloc)
+        if host is None:
+            robotsUrl = '%s://%s/robots.txt' % (o.scheme, o.netloc)
+            robots    = robotparser.RobotFileParser(robotsUrl)
+            delay     = None
+            try:
+                lines = self.fetch(robotsUrl)[2].splitlines()
+                robots.parse(lines)
+                delay = parseCrawlDelay(lines, userAgent)
+            except Exception, e:
+                print "no robots.txt for %s (%s), crawling everything" % (o.netloc, e)
+                robots.parse([])
+
+            if delay is None:
+                delay = config['default_sleep_seconds']
+            print "crawling %s with %.1f seconds between requests" % (o.netloc, delay)
+
+            #getHost() may have been called for the same host while we were
+            #fetching robots.txt
+            if o.netloc not in self.hosts:
+                self.hosts[o.netloc] = Host(o.netloc, robots, delay, config['max_fetches_per_host'])
+            host = self.hosts[o.netloc]
+
+        return host
+
+    # add()
+    #___________________________________________________________________________
+    # Queues url for crawl. Returns False if robots.txt disallows it.
+    def add(self, crawl, url):
+        host = self.getHost(url)
+        if not host.robots.can_fetch(userAgent, url):
+            print "robots.txt disallows %s" % (url)
+            return False
+
+        host.add(self, crawl, url)
+        return True
+
+    # fetch()
+    #___________________________________________________________________________
+    # Returns (status, headers, body). A 304 is returned rather than raised.
+    def fetch(self, url, headers = {}):
+        headers = dict(headers)
+        headers['User-Agent'] = userAgent
+        self.slots.acquire()
+        try:
+            return httpc.get_(url, headers = headers, ok = (200, 203, 304))
+        finally:
+            self.slots.release()
+
+# FeedCrawl
+#_______________________________________________________________________________
+# The state of the crawl of one feed. Its pages are written to one warc, and
+# it is finished when there are no more of its pages queued or being fetched.
+class FeedCrawl(object):
+
+    def __init__(self, feed, frontier, crawlDateTime, warc, warcDateTime, tempdir, state):
+        self.feed           = feed
+        self.frontier       = frontier
+        self.crawlDateTime  = crawlDateTime
+        self.warc           = warc
+        self.warcDateTime   = warcDateTime
+        self.latestDateTime = warcDateTime
+        self.tempdir        = tempdir
+        self.pending        = 0
+        self.finished       = coros.event()
+        self.seen           = SeenSet(config['seen_max_exact'], config['seen_capacity'], config['seen_error_rate'])
+        self.duplicates     = 0
+        self.state          = state
+        self.changed        = 0
+        self.unchanged      = 0
+        self.pruned         = 0
+        self.failures       = 0
+
+    # add()
+    #___________________________________________________________________________
+    # Queues url, unless this crawl has queued it before
+    def add(self, url):
+        if not self.seen.add(canonicalUrl(url)):
+            self.duplicates += 1
+            return
+
+        self.pending += 1
+        if not self.frontier.add(self, url):
+            self.pageDone()
+
+    def pageDone(self):
+        self.pending -= 1
+        if 0 == self.pending:
+            self.finished.send()
+
+    def wait(self):
+        self.finished.wait()
+
+# CrawlState
+#_______________________________________________________________________________
+# What the last crawl of a domain found at each url: its ETag and
+# Last-Modified headers, a hash of its entries, the feed's updated date, and
+# the urls it links to. The next crawl sends conditional requests, and for a
+# page that has not changed, it queues the stored links instead of parsing
+# the page, and does not write the page to its warc again.
+#
+# The state is read at the start of a crawl, and replaced at the end by the
+# urls that crawl reached, so pages that are no longer linked are dropped.
+# Being keyed by url, it can't help with cursor paginated feeds like our
+# /crawlable: a new book changes the cursor, and so the url, of every page
+# after it.
+#
+# The watermark is the updated date of the newest entry of the last crawl.
+# Feeds sorted by date are only crawled down to it.
+class CrawlState(object):
+
+    def __init__(self, path):
+        self.path         = path
+        self.urls         = {}
+        self.newUrls      = {}
+        self.watermark    = None
+        self.newWatermark = None
+        if os.path.exists(path):
+            f = open(path, 'rb')
+            try:
+                state = json.load(f)
+            finally:
+                f.close()
+            self.urls      = state.get('urls', {})
+            self.watermark = state.get('watermark')
+
+    # get()
+    #___________________________________________________________________________
+    # Returns the state of a canonical url from the last crawl, or None
+    def get(self, url):
+        return self.urls.get(url)
+
+    def set(self, url, record):
+        self.newUrls[url] = record
+        newest = record.get('newest')
+        if newest is not None and (self.newWatermark is None or newest > self.newWatermark):
+            self.newWatermark = newest
+
+    # save()
+    #___________________________________________________________________________
+    # write to a temp file and rename, so a crash never leaves half a state
+    #
+    # The watermark only moves forward after a complete crawl: if a page of a
+    # sorted feed failed, the entries on it are newer than the last watermark
+    # but older than the newest entry seen, and the next crawl has to reach
+    # them.
+    def save(self, complete = True):
+        watermark = self.watermark
+        if complete and self.newWatermark is not None:
+            watermark = self.newWatermark
+
+        (fd, tempPath) = tempfile.mkstemp(dir=os.path.dirname(self.path))
+        f = os.fdopen(fd, 'wb')
+        try:
+            json.dump({'urls':      self.newUrls,
+                       'watermark': watermark,
+                      }, f)
+        finally:
+            f.close()
+        os.rename(tempPath, self.path)
+
+# conditionalHeaders()
+#_______________________________________________________________________________
+def conditionalHeaders(previous):
+    headers = {}
+    if previous is not None:
+        if previous.get('etag'):
+            headers['If-None-Match'] = previous['etag']
+        if previous.get('lastModified'):
+            headers['If-Modified-Since'] = previous['lastModified']
+    return headers
+
+# getHeader()
+#_______________________________________________________________________________
+def getHeader(headers, name):
+    for (key, value) in headers.items():
+        if name == key.lower():
+            return value
+    return None
+
+# contentHash()
+#_______________________________________________________________________________
+# A hash of what the indexer needs from a parsed feed page: the id and updated
+# date of each of its entries. The rest of the page changes without anything
+# to reindex: our feeds put the feed's date and numFound in every page, and
+# fabricate content with download counts.
+def contentHash(f):
+    """
+    >>> page = '<feed xmlns="http://www.w3.org/2005/Atom"><title>%s</title><updated>%s</updated>%s</feed>'
+    >>> a = '<entry><id>a</id><title>A</title><updated>2009-01-01T00:00:00Z</updated></entry>'
+    >>> b = '<entry><id>b</id><title>B</title><updated>2009-01-02T00:00:00Z</updated></entry>'
+    >>> h = contentHash(feedparser.parse(page % ('1 to 2 of 10', '2009-02-01T00:00:00Z', a + b)))
+    >>> h == contentHash(feedparser.parse(page % ('1 to 2 of 11', '2009-02-02T00:00:00Z', b + a)))
+    True
+    >>> h == contentHash(feedparser.parse(page % ('1 to 2 of 10', '2009-02-01T00:00:00Z', a + b.replace('01-02', '01-03'))))
+    False
+    """
+    entries = sorted([(e.get('id', ''), e.get('updated', '')) for e in f.entries])
+    data    = '\n'.join(['%s %s' % entry for entry in entries])
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
 # addToQueue()
 #_______________________________________________________________________________
-def addToQueue(nexturl, feedurl, queue):
+def addToQueue(nexturl, pageurl, links):
     #feedparser automatically resolves relative links in link['href'],
     #but only if we have feedparser pull the url. We use httpc.get()
     #to pull the url, because we want to archive the raw data. Since
     #we call feedparser.parse() with a string and not a url, the 
     #url in link['href'] remains a relative url.
 
-    absurl = urlparse.urljoin(feedurl, nexturl)
-    queue.put(str(absurl))
+    absurl = urlparse.urljoin(pageurl, nexturl)
+    links.append(str(absurl))
     #print 'adding ' + absurl
 
 # parseLinks()
 #_______________________________________________________________________________
-def parseLinks(f, feedurl, queue):
+# Returns the absolute urls of the pages to crawl that f links to
+def parseLinks(f, pageurl):
+    links = []
     if f.feed.has_key('links'):
         for link in f.feed.links:
             if 'next' == link['rel']:
-                addToQueue(link['href'], feedurl, queue)
+                addToQueue(link['href'], pageurl, links)
 
     dont_crawl=('related', 'replies')
     for e in f.entries:
@@ -305,51 +837,98 @@ def parseLinks(f, feedurl, queue):
                 if l.rel in dont_crawl:
                     continue;
                 
-                addToQueue(l.href, feedurl, queue)
+                addToQueue(l.href, pageurl, links)
+
+    return links
+
+# entryDates()
+#_______________________________________________________________________________
+# Returns the updated dates of the oldest and the newest entry of a feed page,
+# or (None, None) if it has no dated entries.
+def entryDates(f):
+    dates = []
+    for e in f.entries:
+        if e.has_key('updated_parsed') and e.updated_parsed:
+            dates.append(time.strftime("%Y-%m-%dT%H:%M:%SZ", e.updated_parsed))
+    if not dates:
+        return (None, None)
+    return (min(dates), max(dates))
+
+# queueLinks()
+#_______________________________________________________________________________
+# Queues the links of a page, unless the feed is sorted by date and the page
+# already reaches back past the watermark: the pages after it hold only
+# entries that the last crawl has seen.
+def queueLinks(crawl, url, record):
+    watermark = crawl.state.watermark
+    if crawl.feed.get('sorted_by_date') and watermark is not None:
+        oldest = record.get('oldest')
+        if oldest is not None and oldest < watermark:
+            print "   %s reaches back to %s, older than the last crawl; not following its links" % (url, oldest)
+            crawl.pruned += 1
+            return
+
+    for link in record['links']:
+        crawl.add(str(link))
 
 # crawlFeedOnePage()
 #_______________________________________________________________________________
-# fetches the feed, adds it to a warc (if necessary), updates solr, and then,
-# if present, fetches the rel=next link
-def crawlFeedOnePage(feed, queue, crawlDateTime, latestWarc, warcDateTime, latestDateTime, tempdir):
+# adds a fetched page of the feed to a warc if it changed since the last crawl,
+# and queues the pages it links to, like its rel=next link
+def crawlFeedOnePage(crawl, url, status, headers, data):
+    feed     = crawl.feed
+    key      = canonicalUrl(url)
+    previous = crawl.state.get(key)
+
+    if 304 == status and previous is not None:
+        print "-> %s not modified %s for domain %s" % (time.asctime(), url, feed['domain'])
+        crawl.unchanged += 1
+        crawl.state.set(key, previous)
+        queueLinks(crawl, url, previous)
+        return
 
-    url = queue.get()
-    print "<- %s fetching %s for domain %s" % (time.asctime(), url, feed['domain'])
-    data = httpc.get(url, headers = {"User-Agent": "Internet Archive OPDS Crawler +http://bookserver.archive.org",})
     print "-> %s fetched %s for domain %s" % (time.asctime(), url, feed['domain'])
 
     f     = feedparser.parse(data)
     t     = f.feed.updated_parsed
     dt    = datetime.datetime(t.tm_year, t.tm_mon, t.tm_mday, t.tm_hour, t.tm_min, t.tm_sec)
-    delta = crawlDateTime - dt
+    delta = crawl.crawlDateTime - dt
 
     #if delta.days < 1:
     #     print 'feed update date less than one day since previous crawl'
 
     #TODO: make new warc if our warc file is too big
-    #TODO: only add to warc if not already there.
 
-    ###turn off addToWarc while debugging
-    #if (warcDateTime < dt):
-    #    print "Feed updated date is newer than warc date. Adding to warc"
-    if True:
-        addToWarc(latestWarc, url, data, f, 'application/atom+xml')
-        latestDateTime = dt
+    (oldest, newest) = entryDates(f)
+    record = {'etag':         getHeader(headers, 'etag'),
+              'lastModified': getHeader(headers, 'last-modified'),
+              'hash':         contentHash(f),
+              'updated':      dt.strftime("%Y-%m-%dT%H:%M:%SZ"),
+              'oldest':       oldest,
+              'newest':       newest,
+              'links':        parseLinks(f, url),
+             }
+
+    if previous is not None and previous['hash'] == record['hash']:
+        crawl.unchanged += 1
+    else:
+        ip = crawl.frontier.resolver.resolve(urlparse.urlparse(url).hostname)
+        addToWarc(crawl.warc, url, data, f, 'application/atom+xml', ip)
+        crawl.changed += 1
+        #pages are fetched concurrently, so they don't arrive in feed order
+        crawl.latestDateTime = max(crawl.latestDateTime, dt)
 
     #just archive, no longer feed solr from this script
-    #addToSolr(feed, f, tempdir)
-
-    parseLinks(f, feed['url'], queue)
-    
+    #addToSolr(feed, f, crawl.tempdir)
 
-
-    time.sleep(config['default_sleep_seconds'])
-
-    return latestDateTime
+    crawl.state.set(key, record)
+    queueLinks(crawl, url, record)
 
 # crawlDomain()
 #_______________________________________________________________________________
-def crawlDomain(feed, crawlDateTime):
+# Crawls a feed, with its pages fetched by the frontier's workers, and
+# returns when all of them have been fetched.
+def crawlDomain(feed, crawlDateTime, frontier):
         
     
     print "%s fetching %s" % (time.asctime(), feed['domain'])
@@ -369,35 +948,50 @@ def crawlDomain(feed, crawlDateTime):
     #    (latestWarc, warcFileName, warcDateTime) = createNewWarc(feed['domain'], domain_warc_dir, tempdir)
     (latestWarc, warcFileName, warcDateTime) = createNewWarc(feed['domain'], domain_warc_dir, tempdir, crawlDateTime)
 
-    queue = Queue.Queue() #a Queue might be overkill here; could probably use a list
-    queue.put(feed['url'])
-    
-    while not queue.empty():
-        latestDateTime = crawlFeedOnePage(feed, queue, crawlDateTime, latestWarc, warcDateTime, warcDateTime, tempdir)
+    state = CrawlState('%s/%s_state.json' % (domain_warc_dir, feed['domain']))
+    crawl = FeedCrawl(feed, frontier, crawlDateTime, latestWarc, warcDateTime, tempdir, state)
+    crawl.add(feed['url'])
+    crawl.wait()
     
-    print "Finished crawling %s, whose feed was last updated on %s" % (feed['domain'], latestDateTime.isoformat())
+    print "Finished crawling %s, whose feed was last updated on %s" % (feed['domain'], crawl.latestDateTime.isoformat())
+    print "Queued %d urls for %s, skipped %d links to urls already queued" % (len(crawl.seen), feed['domain'], crawl.duplicates)
+    print "%d pages changed since the last crawl, %d unchanged, %d failed" % (crawl.changed, crawl.unchanged, crawl.failures)
+    if feed.get('sorted_by_date'):
+        print "Stopped at %d pages older than %s" % (crawl.pruned, state.watermark)
         
     os.rmdir(tempdir)
     latestWarc.destroy()
+    state.save(complete = 0 == crawl.failures)
+
+    #nothing new to index
+    if 0 == crawl.changed:
+        print 'removing empty warc file ' + warcFileName
+        os.remove(warcFileName)
 
     ### Create a new warc everytime instead of adding to an old one
-    #renameWarc(warcFileName, feed['domain'], domain_warc_dir, latestDateTime)
+    #renameWarc(warcFileName, feed['domain'], domain_warc_dir, crawl.latestDateTime)
     
 # __main__
 #_______________________________________________________________________________
 
-assert os.path.exists(config['warc_dir'])    
-writeLockFile(config['warc_dir'])
+if __name__ == '__main__':
+    if '--test' in sys.argv:
+        import doctest
+        doctest.testmod()
+        sys.exit(0)
 
-crawlDateTime = datetime.datetime.utcnow()
-pool = coros.CoroutinePool(max_size=4)
-waiters = []
-for feed in feeds:
-    waiters.append(pool.execute(crawlDomain, feed, crawlDateTime))
-    
+    assert os.path.exists(config['warc_dir'])    
+    writeLockFile(config['warc_dir'])
 
-#wait until all feeds have been fetched
-for waiter in waiters:
-    waiter.wait()
-    
-rmLockFile(config['warc_dir'])    
\ No newline at end of file
+    crawlDateTime = datetime.datetime.utcnow()
+    frontier = Frontier(config['max_fetches'])
+    waiters = []
+    for feed in feeds:
+        waiters.append(coros.execute(crawlDomain, feed, crawlDateTime, frontier))
+        
+
+    #wait until all feeds have been fetched
+    for waiter in waiters:
+        waiter.wait()
+        
+    rmLockFile(config['warc_dir'])
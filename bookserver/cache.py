@@ -0,0 +1,359 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Response cache for pages built from solr queries.
+
+Cached values are (contentType, body) tuples. Each backend expires values
+after a per-entry TTL and evicts the least recently used values once the
+total size of the cached bodies goes over maxBytes.
+
+>>> class Clock:
+...     now = 1000000000.0
+...     def __call__(self):
+...         return self.now
+>>> clock = Clock()
+>>> m = MemoryCache(maxBytes = 10, clock = clock)
+>>> m.set('a', ('text/html', '12345'), 60)
+>>> m.set('b', ('text/html', '12345'), 60)
+>>> m.get('a')
+('text/html', '12345')
+
+'b' is now the least recently used value, so it goes first:
+
+>>> m.set('c', ('text/html', '123'), 60)
+>>> print m.get('b')
+None
+>>> m.get('c')
+('text/html', '123')
+
+Values expire after their TTL:
+
+>>> clock.now += 61
+>>> print m.get('a')
+None
+
+ResponseCache adds per-route TTLs and builds keys from the solr url and
+output mode. Query parameters are sorted, so equivalent urls share a key:
+
+>>> r = ResponseCache(MemoryCache(clock = clock), ttls = {'alpha': 3600})
+>>> k1 = r.makeKey('http://solr/select?q=a&rows=50', 'xml')
+>>> k2 = r.makeKey('http://solr/select?rows=50&q=a', 'xml')
+>>> k1 == k2
+True
+>>> k1 == r.makeKey('http://solr/select?q=a&rows=50', 'html')
+False
+>>> r.set('alpha', k1, ('application/atom+xml', '<feed/>'))
+>>> r.get('alpha', k1)
+('application/atom+xml', '<feed/>')
+
+Routes with a zero TTL are not cached:
+
+>>> r.set('opensearch', k1, ('application/atom+xml', '<feed/>'))
+>>> print r.get('opensearch', k1)
+None
+
+getMaxBytes() tells how big a page a route can cache, so that pages too
+big to cache need not be collected:
+
+>>> r.getMaxBytes('alpha'), r.getMaxBytes('opensearch')
+(67108864, 0)
+
+FragmentCache holds parts of pages, such as rendered entries, which are
+strings. It counts hits and misses for metrics:
+
+>>> f = FragmentCache(maxBytes = 100, ttl = 60, clock = clock)
+>>> f.set(('urn:a', '2009-01-01T00:00:00Z'), '<entry/>')
+>>> f.get(('urn:a', '2009-01-01T00:00:00Z'))
+'<entry/>'
+>>> print f.get(('urn:b', '2009-01-01T00:00:00Z'))
+None
+>>> stats = f.getStats()
+>>> stats['hits'], stats['misses'], stats['hitRate'], stats['numValues'], stats['numBytes']
+(1, 1, 0.5, 1, 8)
+"""
+
+import cPickle
+import hashlib
+import os
+import tempfile
+import threading
+import time
+import urllib
+import urlparse
+
+from collections import OrderedDict
+
+# MemoryCache
+#_______________________________________________________________________________
+class MemoryCache:
+    """In-process LRU cache, shared by all threads of one process"""
+
+    def __init__(self, maxBytes = 64*1024*1024, clock = time.time):
+        self.maxBytes = maxBytes
+        self.clock    = clock
+        self.numBytes = 0
+        self.hits     = 0
+        self.misses   = 0
+        self._values  = OrderedDict()
+        self._lock    = threading.Lock()
+
+    def sizeOf(self, value):
+        #size of the body of a (contentType, body) tuple
+        return len(value[1])
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            if not key in self._values:
+                self.misses += 1
+                return None
+
+            (expires, size, value) = self._values.pop(key)
+            if expires < self.clock():
+                self.numBytes -= size
+                self.misses += 1
+                return None
+
+            #re-insert to mark as most recently used
+            self._values[key] = (expires, size, value)
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value, ttl):
+        size = self.sizeOf(value)
+        if size > self.maxBytes:
+            return
+
+        self._lock.acquire()
+        try:
+            if key in self._values:
+                self.numBytes -= self._values.pop(key)[1]
+
+            self._values[key] = (self.clock() + ttl, size, value)
+            self.numBytes += size
+
+            while self.numBytes > self.maxBytes:
+                (oldKey, (expires, oldSize, oldValue)) = self._values.popitem(last=False)
+                self.numBytes -= oldSize
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {
+                'hits'      : self.hits,
+                'misses'    : self.misses,
+                'hitRate'   : (float(self.hits) / lookups) if lookups else 0.0,
+                'numValues' : len(self._values),
+                'numBytes'  : self.numBytes,
+                'maxBytes'  : self.maxBytes,
+            }
+        finally:
+            self._lock.release()
+
+
+# FragmentCache
+#_______________________________________________________________________________
+class FragmentCache(MemoryCache):
+    """
+    In-process LRU cache of rendered parts of pages, which are strings.
+    Values expire after ttl seconds, so that parts of a value that are not
+    in its key, like download counts, are refreshed.
+    """
+
+    def __init__(self, maxBytes = 16*1024*1024, ttl = 3600, clock = time.time):
+        MemoryCache.__init__(self, maxBytes, clock)
+        self.ttl = ttl
+
+    def sizeOf(self, value):
+        return len(value)
+
+    def set(self, key, value, ttl = None):
+        if ttl is None:
+            ttl = self.ttl
+        MemoryCache.set(self, key, value, ttl)
+
+
+# DiskCache
+#_______________________________________________________________________________
+class DiskCache:
+    """
+    On-disk LRU cache, which can be shared by all frontend processes on a host.
+    Each value is stored in its own file, named by the md5 of its key. The
+    file mtime records when the value was last used.
+    """
+
+    suffix = '.cache'
+
+    def __init__(self, directory, maxBytes = 1024*1024*1024, clock = time.time):
+        self.directory = directory
+        self.maxBytes  = maxBytes
+        self.clock     = clock
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0700)
+
+        self.numBytes  = self.getDirectorySize()
+        self._lock     = threading.Lock()
+
+    def getPath(self, key):
+        return os.path.join(self.directory, hashlib.md5(key).hexdigest() + self.suffix)
+
+    def getDirectorySize(self):
+        size = 0
+        for name in os.listdir(self.directory):
+            if name.endswith(self.suffix):
+                try:
+                    size += os.path.getsize(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+        return size
+
+    def get(self, key):
+        path = self.getPath(key)
+        try:
+            f = open(path, 'rb')
+            try:
+                (expires, storedKey, value) = cPickle.load(f)
+            finally:
+                f.close()
+        except (IOError, EOFError, cPickle.UnpicklingError):
+            return None
+
+        #guard against md5 collisions
+        if storedKey != key:
+            return None
+
+        if expires < self.clock():
+            self.remove(path)
+            return None
+
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+
+        return value
+
+    def set(self, key, value, ttl):
+        data = cPickle.dumps((self.clock() + ttl, key, value), cPickle.HIGHEST_PROTOCOL)
+        if len(data) > self.maxBytes:
+            return
+
+        #write to a temp file and rename, so readers never see a partial file
+        (fd, tempPath) = tempfile.mkstemp(dir=self.directory)
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tempPath, self.getPath(key))
+
+        self._lock.acquire()
+        try:
+            self.numBytes += len(data)
+            if self.numBytes > self.maxBytes:
+                self.evict()
+        finally:
+            self._lock.release()
+
+    def remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def evict(self):
+        # Other processes write to the same directory, so rescan it
+        # instead of trusting our running total.
+        files = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, path))
+
+        files.sort()
+        self.numBytes = sum([size for (mtime, size, path) in files])
+
+        #evict down to 90% so that we don't rescan on every set()
+        target = self.maxBytes * 0.9
+        for (mtime, size, path) in files:
+            if self.numBytes <= target:
+                break
+            self.remove(path)
+            self.numBytes -= size
+
+
+# ResponseCache
+#_______________________________________________________________________________
+class ResponseCache:
+    """
+    Caches rendered pages per route. ttls maps route names to a TTL in
+    seconds; routes missing from ttls are not cached.
+    """
+
+    def __init__(self, backend, ttls):
+        self.backend = backend
+        self.ttls    = ttls
+
+    @classmethod
+    def normalizeUrl(cls, url):
+        o = urlparse.urlsplit(url)
+        params = urlparse.parse_qsl(o.query, keep_blank_values=True)
+        params.sort()
+        return urlparse.urlunsplit((o.scheme, o.netloc.lower(), o.path, urllib.urlencode(params), ''))
+
+    @classmethod
+    def makeKey(cls, url, mode):
+        return '%s %s' % (mode, cls.normalizeUrl(url))
+
+    def getTTL(self, route):
+        return self.ttls.get(route, 0)
+
+    def getMaxBytes(self, route):
+        if not self.getTTL(route):
+            return 0
+        return self.backend.maxBytes
+
+    def get(self, route, key):
+        if not self.getTTL(route):
+            return None
+        return self.backend.get(route + ' ' + key)
+
+    def set(self, route, key, value):
+        ttl = self.getTTL(route)
+        if ttl:
+            self.backend.set(route + ' ' + key, value, ttl)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
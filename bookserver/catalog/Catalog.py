@@ -37,6 +37,7 @@ class Catalog:
                  crawlableUrl = None
                 ):
         self._entries    = []
+        self._entrySummary = None
         self._opensearch = None
         self._navigation = None
         self._title      = title
@@ -58,3 +59,23 @@ class Catalog:
 
     def getEntries(self):
         return self._entries
+
+    # entries can be any iterable, e.g. a generator that builds each entry
+    # only when a renderer asks for it. A generator can only be rendered
+    # once. summary is an optional list of (urn, updated, downloadsPerMonth)
+    # for the entries, so they don't have to be built to find the catalog's
+    # validator.
+    def setEntries(self, entries, summary = None):
+        self._entries      = entries
+        self._entrySummary = summary
+
+    # Returns a list of (urn, updated, downloadsPerMonth) for the entries.
+    # Lazy entries without a summary are built, and kept in a list, to make
+    # one.
+    def getEntrySummary(self):
+        if self._entrySummary is not None:
+            return self._entrySummary
+
+        if not isinstance(self._entries, list):
+            self._entries = list(self._entries)
+        return [(e.get('urn'), e.get('updated'), e.get('downloadsPerMonth')) for e in self._entries]
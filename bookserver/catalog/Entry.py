@@ -61,13 +61,50 @@ KeyError: 'requested key foo is not valid in Entry'
 Traceback (most recent call last):
     ...
 KeyError: 'invalid key in bookserver.catalog.Entry: foo'
+
+#fast path for ingestors that build a fresh dict for every entry:
+#the values are not copied, and all keys are checked in a single pass
+
+>>> d = {'urn': 'urn:x-internet-archive:item:itemid', 'title': 'itemid', 'authors': ['Twain']}
+>>> e = Entry.Entry.fromTrusted(d, links = [l])
+>>> e._entry == d
+True
+>>> e.get('authors') is d['authors']
+True
+>>> e = Entry.Entry.fromTrusted({'urn': 'urn:x', 'title': 't', 'authors': 'Twain'}, links = [l])
+Traceback (most recent call last):
+    ...
+ValueError: invalid value in bookserver.catalog.Entry: authors=Twain should have type <type 'list'>, but got type <type 'str'>
+
+#trusted validation can be switched off globally, e.g. in production
+
+>>> Entry.Entry.validate_trusted = False
+>>> e = Entry.Entry.fromTrusted({'urn': 'urn:x', 'title': 't', 'authors': 'Twain'}, links = [l])
+>>> Entry.Entry.validate_trusted = True
 """
 
 import copy
 
-class Entry():
+# compileTypes()
+#_______________________________________________________________________________
+# Precomputes the types accepted for each key: unicode keys also accept
+# str and int, which we can convert to unicode if needed.
+def compileTypes(valid_keys):
+    acceptedTypes = {}
+    for key, wantedType in valid_keys.iteritems():
+        if unicode == wantedType:
+            acceptedTypes[key] = (unicode, str, int)
+        else:
+            acceptedTypes[key] = (wantedType,)
+    return acceptedTypes
+
+class Entry(object):
 
     """
+    Each valid key is stored in its own slot instead of a per-instance
+    dict, which keeps large catalogs small in memory. Keys added to
+    valid_keys by subclasses are kept in the _extra dict.
+
     valid_keys can be str or list
     TODO: These key names come from the IA solr keys.
           We should rename them to be similar to feedparser keys
@@ -99,7 +136,15 @@ class Entry():
     }
         
     required_keys = ('urn', 'title')
-    
+
+    accepted_types = compileTypes(valid_keys)
+
+    slot_keys = frozenset(valid_keys)
+    __slots__ = tuple(valid_keys) + ('_links', '_extra')
+
+    # Set to False to skip type checking of entries created by fromTrusted()
+    validate_trusted = True
+
     def validate(self, key, value):
         if key not in self.valid_keys:
             raise KeyError("invalid key in bookserver.catalog.Entry: %s" % (key))
@@ -116,7 +161,17 @@ class Entry():
             
             if error:
                 raise ValueError("invalid value in bookserver.catalog.Entry: %s=%s should have type %s, but got type %s" % (key, value, wantedType, gotType))
-    
+
+    @classmethod
+    def validateAll(cls, obj):
+        accepted_types = cls.accepted_types
+        for key, value in obj.iteritems():
+            types = accepted_types.get(key)
+            if types is None:
+                raise KeyError("invalid key in bookserver.catalog.Entry: %s" % (key))
+            if type(value) not in types:
+                raise ValueError("invalid value in bookserver.catalog.Entry: %s=%s should have type %s, but got type %s" % (key, value, cls.valid_keys[key], type(value)))
+
 
     def __init__(self, obj, links=None):
 
@@ -137,25 +192,82 @@ class Entry():
         if not links:
             raise KeyError("links not supplied!")
 
-        self._entry = copy.deepcopy(obj)
+        self.setFields(copy.deepcopy(obj))
         self._links = links
-                
+
+    @classmethod
+    def fromTrusted(cls, obj, links):
+        """
+        Creates an Entry that takes ownership of obj instead of copying it.
+        For ingestors that build a new dict for each entry.
+        """
+        if cls.validate_trusted:
+            cls.validateAll(obj)
+
+        if 'title' not in obj:
+            obj['title'] = '(no title)' #special case for IA test items
+
+        for req_key in cls.required_keys:
+            if not req_key in obj:
+                raise KeyError("required key %s not supplied!" % (req_key))
+
+        if not links:
+            raise KeyError("links not supplied!")
+
+        e = cls.__new__(cls)
+        e.setFields(obj)
+        e._links = links
+        return e
+
+    def setFields(self, obj):
+        self._extra = None
+        slot_keys = Entry.slot_keys
+        for key, value in obj.iteritems():
+            if key in slot_keys:
+                setattr(self, key, value)
+            else:
+                if self._extra is None:
+                    self._extra = {}
+                self._extra[key] = value
+
+    # _entry
+    #___________________________________________________________________________
+    # dict of all keys that have been set, used by the renderers
+    @property
+    def _entry(self):
+        d = {}
+        for key in Entry.slot_keys:
+            value = getattr(self, key, None)
+            if value is not None:
+                d[key] = value
+        if self._extra:
+            d.update(self._extra)
+        return d
 
     def get(self, key):
-        if key in self._entry:
-            return self._entry[key]
-        else:
-            if key in self.valid_keys:
-                if list == self.valid_keys[key]:
-                    return []
-                else:
-                    return None
+        if key in Entry.slot_keys:
+            value = getattr(self, key, None)
+            if value is not None:
+                return value
+        elif self._extra and key in self._extra:
+            return self._extra[key]
+
+        if key in self.valid_keys:
+            if list == self.valid_keys[key]:
+                return []
             else:
-                raise KeyError("requested key %s is not valid in Entry" % key)
+                return None
+        else:
+            raise KeyError("requested key %s is not valid in Entry" % key)
 
     def set(self, key, value):
         self.validate(key, value)
-        self._entry[key] = value
+        if key in Entry.slot_keys:
+            setattr(self, key, value)
+        else:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[key] = value
 
 
     def getLinks(self):
@@ -166,9 +278,12 @@ class IAEntry(Entry):
     """
     Catalog entry with extra keys specific tothe Internet Archive.
     """
+    __slots__ = ()
+
     # Add our IA-specific "formats" key
     valid_keys = Entry.valid_keys.copy()
     valid_keys['formats'] = list
+    accepted_types = compileTypes(valid_keys)
 
 if __name__ == '__main__':
     import doctest
@@ -21,9 +21,38 @@ This file is part of bookserver.
     The bookserver source is hosted at http://github.com/internetarchive/bookserver/
 """
 
-class Link:
+class Link(object):
+    """
+    Link fields are stored in slots rather than a per-instance dict, since
+    every catalog entry carries several links.
+
+    >>> l = Link(url = 'http://archive.org/download/itemid/itemid.pdf', type = 'application/pdf', price = '1.00')
+    >>> l.get('currencycode')
+    'USD'
+    >>> print l.get('rel')
+    None
+    >>> l.set('rel', Link.buying)
+    >>> l.get('rel')
+    'http://opds-spec.org/acquisition/buying'
+    >>> l.set('foo', 'bar')
+    Traceback (most recent call last):
+        ...
+    KeyError: 'invalid key in bookserver.catalog.Link: foo'
+
+    Links may be shared by catalogs that are rendered for several requests
+    at once, so code that formats a link for output makes a changed copy
+    instead of calling set():
+
+    >>> epub = l.copy(url = 'epub://archive.org/download/itemid/itemid.epub')
+    >>> epub.get('url'), epub.get('price'), l.get('url')
+    ('epub://archive.org/download/itemid/itemid.epub', '1.00', 'http://archive.org/download/itemid/itemid.pdf')
+    """
+
     valid_keys = ('url', 'type', 'rel', 'price', 'currencycode', 'formats')
     required_keys = ('url', 'type')
+
+    __slots__ = valid_keys
+    key_set   = frozenset(valid_keys)
     
     acquisition ='http://opds-spec.org/acquisition'                 # Free acquisition
     buying = 'http://opds-spec.org/acquisition/buying'
@@ -37,7 +66,7 @@ class Link:
     acquisition_types = (acquisition, buying, lending, subscription, sample)
     
     def validate(self, key, value):
-        if key not in Link.valid_keys:
+        if key not in Link.key_set:
             raise KeyError("invalid key in bookserver.catalog.Link: %s" % (key))
         
     def __init__(self, **kwargs):
@@ -51,12 +80,32 @@ class Link:
         if 'price' in kwargs:
             if not 'currencycode' in kwargs:
                 kwargs['currencycode'] = 'USD'
-                
-        self._data = kwargs    
+
+        for key, val in kwargs.iteritems():
+            setattr(self, key, val)
 
     def get(self, key):
-        return self._data.get(key, None)
+        if key in Link.key_set:
+            return getattr(self, key, None)
+        return None
 
     def set(self, key, value):
         self.validate(key, value)
-        self._data[key] = value
+        setattr(self, key, value)
+
+    # copy()
+    #___________________________________________________________________________
+    # Returns a new Link with the fields of this one, and changes applied
+    def copy(self, **changes):
+        l = Link.__new__(Link)
+        for key in Link.valid_keys:
+            if hasattr(self, key):
+                setattr(l, key, getattr(self, key))
+        for key, val in changes.iteritems():
+            l.set(key, val)
+        return l
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
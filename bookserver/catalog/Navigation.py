@@ -19,8 +19,39 @@ This file is part of bookserver.
     along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
     
     The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Offset pagination links to page numbers:
+
+>>> n = Navigation.initWithBaseUrl(1, 50, 2345, '/catalog/new/')
+>>> n.prevLink, n.nextLink
+('/catalog/new/0', '/catalog/new/2')
+
+Keyset pagination links to an opaque cursor made from the sort key of the
+last entry on the page, so every page costs the same to fetch:
+
+>>> cursor = Navigation.encodeCursor(('2009-12-01T00:00:00Z', 'abuenosairesviaj00gonz'))
+>>> Navigation.decodeCursor(cursor)
+[u'2009-12-01T00:00:00Z', u'abuenosairesviaj00gonz']
+>>> n = Navigation.initWithCursor(None, 50, 50, cursor, '/catalog/new/')
+>>> print n.prevLink
+None
+>>> n.nextLink == '/catalog/new/c/' + cursor
+True
+
+There is no next page once a page comes back short:
+
+>>> n = Navigation.initWithCursor(None, 50, 49, cursor, '/catalog/new/')
+>>> print n.nextLink
+None
+>>> Navigation.decodeCursor('not a cursor!')
+Traceback (most recent call last):
+    ...
+ValueError: invalid cursor: not a cursor!
 """
 
+import base64
+import binascii
+
 class Navigation:
 
     @classmethod
@@ -56,7 +87,41 @@ class Navigation:
         (nextLink, nextTitle) = cls.getNext(start, numRows, numFound, urlBase)
         (prevLink, prevTitle) = cls.getPrev(start, numRows, numFound, urlBase)
         return cls(nextLink, nextTitle, prevLink, prevTitle)
-    
+
+    # encodeCursor()
+    #___________________________________________________________________________
+    # Makes a url-safe token from the values of the sort key
+    @classmethod
+    def encodeCursor(cls, values):
+        s = '\n'.join([unicode(v).encode('utf-8') for v in values])
+        return base64.urlsafe_b64encode(s).rstrip('=')
+
+    # decodeCursor()
+    #___________________________________________________________________________
+    @classmethod
+    def decodeCursor(cls, cursor):
+        try:
+            s = base64.urlsafe_b64decode(str(cursor) + '=' * (-len(cursor) % 4))
+            return [v.decode('utf-8') for v in s.split('\n')]
+        except (TypeError, binascii.Error, UnicodeError):
+            raise ValueError('invalid cursor: %s' % (cursor))
+
+    # initWithCursor()
+    #___________________________________________________________________________
+    # For keyset pagination. nextCursor encodes the sort key of the last
+    # entry on this page, and the next link is urlBase + 'c/' + nextCursor.
+    # Pass start for a page reached by offset, to keep its prev link.
+    @classmethod
+    def initWithCursor(cls, start, numRows, numOnPage, nextCursor, urlBase):
+        nextLink  = None
+        nextTitle = None
+        if (nextCursor is not None) and (numOnPage >= numRows):
+            nextLink  = '%sc/%s' % (urlBase, nextCursor)
+            nextTitle = 'Next results'
+
+        (prevLink, prevTitle) = cls.getPrev(start, numRows, None, urlBase)
+        return cls(nextLink, nextTitle, prevLink, prevTitle)
+
 
     def __init__(self, nextLink, nextTitle, prevLink, prevTitle):
         self.nextLink  = nextLink
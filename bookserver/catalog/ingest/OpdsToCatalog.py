@@ -185,7 +185,7 @@ class OpdsToCatalog():
             
             self.scalarToList(bookDict, ('languages','publishers', 'authors'))
             
-            e = Entry(bookDict, links=links)
+            e = Entry.fromTrusted(bookDict, links=links)
             self.c.addEntry(e)
             
             
@@ -0,0 +1,202 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Decoding of Solr JSON responses.
+
+A whole response body is decoded with the fastest JSON module installed:
+ujson if it is available, otherwise simplejson (which uses its C speedups
+when they are compiled) or the standard library json module.
+
+>>> decoder = SolrDecoder()
+>>> (numFound, docs) = decoder.decode('{"response":{"numFound":2,"start":0,"docs":[{"identifier":"a"},{"identifier":"b"}]}}')
+>>> numFound, [doc['identifier'] for doc in docs]
+(2, [u'a', u'b'])
+
+A response that can't be decoded is an empty result, as Solr returns an
+empty body for some malformed queries:
+
+>>> decoder.decode('')
+(0, [])
+
+A response can also be read from a file object. If the ijson module is
+installed, docs are then parsed one at a time, as they are read, so the
+first entries can be built before the whole response has arrived.
+Otherwise the file is read and decoded at once. Streaming takes more CPU
+than decoding a whole body, so bodies that have already been read are
+always decoded at once.
+
+>>> import StringIO
+>>> (numFound, docs) = decoder.stream(StringIO.StringIO('{"response":{"numFound":1,"docs":[{"identifier":"a","price":1.5}]}}'))
+>>> numFound
+1
+>>> [(doc['identifier'], doc['price']) for doc in docs]
+[(u'a', 1.5)]
+
+KeyMap renames the keys of a doc. The list of new names is worked out once
+for each distinct set of keys, instead of once for every key of every doc:
+
+>>> keyMap = KeyMap({'identifier': 'identifier', 'creator': 'authors'})
+>>> sorted(keyMap.translate({'identifier': 'a', 'creator': ['b']}).items())
+[('authors', ['b']), ('identifier', 'a')]
+>>> keyMap.translate({'format': ['PDF']})
+Traceback (most recent call last):
+    ...
+KeyError: 'format'
+"""
+
+import decimal
+from itertools import izip
+
+import sys
+sys.path.append("/petabox/sw/lib/python")
+
+# python-cjson is not used: it decodes escaped slashes ("\/") wrongly
+try:
+    import ujson as json
+    jsonModule = 'ujson'
+except ImportError:
+    try:
+        import simplejson as json
+        jsonModule = 'simplejson'
+    except ImportError:
+        import json
+        jsonModule = 'json'
+
+# ijson is optional. Its yajl backends are much faster than the pure
+# python one.
+ijson = None
+for backend in ('yajl2_c', 'yajl2_cffi', 'yajl2', 'python'):
+    try:
+        ijson = __import__('ijson.backends.' + backend, fromlist = [backend])
+        break
+    except Exception:
+        pass
+
+if ijson is not None:
+    from ijson.common import ObjectBuilder, JSONError
+
+
+# KeyMap
+#_______________________________________________________________________________
+class KeyMap:
+
+    # once a response has this many distinct sets of keys, something is wrong
+    maxCached = 1024
+
+    # KeyMap()
+    #___________________________________________________________________________
+    def __init__(self, keymap):
+        self.keymap = keymap
+        self.names  = {}
+
+    # translate()
+    #___________________________________________________________________________
+    # Returns a copy of d with its keys renamed. Raises KeyError for a key
+    # that is not in the keymap.
+    def translate(self, d):
+        keys  = tuple(d)
+        names = self.names.get(keys)
+        if names is None:
+            names = tuple([self.keymap[key] for key in keys])
+            if len(self.names) >= KeyMap.maxCached:
+                self.names.clear()
+            self.names[keys] = names
+
+        #keys() and values() of an unchanged dict are in the same order
+        return dict(izip(names, d.itervalues()))
+
+
+# SolrDecoder
+#_______________________________________________________________________________
+class SolrDecoder:
+
+    # loads()
+    #___________________________________________________________________________
+    def loads(self, data):
+        return json.loads(data)
+
+    # decode()
+    #___________________________________________________________________________
+    # Returns (numFound, docs) for a response body.
+    def decode(self, data):
+        try:
+            obj = self.loads(data)
+        except ValueError:
+            # No search results
+            return (0, [])
+
+        return (int(obj['response']['numFound']), obj['response']['docs'])
+
+    # stream()
+    #___________________________________________________________________________
+    # Returns (numFound, docs) for a response read from f. docs is an
+    # iterator if ijson is installed. Solr writes numFound before docs, so
+    # only the response header is parsed before this returns.
+    def stream(self, f):
+        if ijson is None:
+            return self.decode(f.read())
+
+        events   = ijson.parse(f)
+        numFound = 0
+        try:
+            for (prefix, event, value) in events:
+                if 'response.numFound' == prefix:
+                    numFound = int(value)
+                elif 'response.docs' == prefix and 'start_array' == event:
+                    return (numFound, self.iterDocs(events))
+        except JSONError:
+            return (0, [])
+
+        return (numFound, [])
+
+    # iterDocs()
+    #___________________________________________________________________________
+    def iterDocs(self, events):
+        builder = None
+        for (prefix, event, value) in events:
+            if 'response.docs' == prefix and 'end_array' == event:
+                break
+
+            if builder is None:
+                builder = ObjectBuilder()
+            builder.event(event, value)
+
+            if 'response.docs.item' == prefix and 'end_map' == event:
+                yield self.floatValues(builder.value)
+                builder = None
+
+    # floatValues()
+    #___________________________________________________________________________
+    # ijson returns decimals for non-integer numbers; the json modules
+    # return floats.
+    def floatValues(self, doc):
+        for (key, value) in doc.iteritems():
+            if isinstance(value, decimal.Decimal):
+                doc[key] = float(value)
+            elif isinstance(value, list):
+                doc[key] = [(float(v) if isinstance(v, decimal.Decimal) else v) for v in value]
+        return doc
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
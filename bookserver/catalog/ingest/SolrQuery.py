@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+The SolrQuery class builds solr select urls. A query is compiled once, at
+startup, with the parameters that are the same for every request: the
+fields to return, filter queries, sort order, and response format. Only
+the per-request query clause and paging are added for each request.
+
+Query clauses are plain solr syntax; SolrQuery does the url encoding.
+
+>>> q = SolrQuery('http://localhost:8983/solr/select?fl=identifier,title&wt=json',
+...               q = 'mediatype:texts', sort = 'titleSorter asc',
+...               fields = ('identifier', 'title', 'creator'))
+>>> q.getUrl('firstTitle:A', start = 50, rows = 50)
+'http://localhost:8983/solr/select?fl=identifier%2Ctitle%2Ccreator&wt=json&json.nl=map&omitHeader=true&sort=titleSorter+asc&q=mediatype%3Atexts+AND+%28firstTitle%3AA%29&rows=50&start=50'
+
+Constant restrictions can be sent as filter queries, which solr caches
+separately from the main query:
+
+>>> q = SolrQuery('http://localhost:8983/solr/select', filterQueries = ('mediatype:texts',))
+>>> q.getUrl('twain', rows = 10)
+'http://localhost:8983/solr/select?wt=json&json.nl=map&omitHeader=true&fq=mediatype%3Atexts&q=twain&rows=10'
+>>> q.getUrl()
+'http://localhost:8983/solr/select?wt=json&json.nl=map&omitHeader=true&fq=mediatype%3Atexts&q=%2A%3A%2A'
+
+A constant query can be split into filter queries at its top-level ANDs:
+
+>>> SolrQuery.splitClauses('format:pdf AND NOT ocr:"language AND not" AND (a OR b)')
+['format:pdf', '-ocr:"language AND not"', '(a OR b)']
+"""
+
+import urllib
+import urlparse
+
+class SolrQuery:
+
+    # parameters that SolrQuery sets itself, and removes from solrBase
+    managedParams = ('q', 'fq', 'fl', 'sort', 'rows', 'start', 'wt', 'json.nl', 'omitHeader')
+
+    # SolrQuery()
+    #___________________________________________________________________________
+    # solrBase is the select url, optionally with default parameters (e.g.
+    # pubInfo['solr_base']). q is ANDed with the clause passed to getUrl().
+    # fields limits the returned fields (fl); None returns all stored fields.
+    def __init__(self, solrBase, q=None, filterQueries=(), sort=None, fields=None, rows=None, omitHeader=True):
+        o = urlparse.urlsplit(solrBase)
+        baseParams = urlparse.parse_qsl(o.query, keep_blank_values=True)
+
+        params = []
+        for (key, value) in baseParams:
+            if 'fl' == key and fields is None:
+                params.append((key, value))
+            elif key not in SolrQuery.managedParams:
+                params.append((key, value))
+
+        if fields is not None:
+            params.insert(0, ('fl', ','.join(fields)))
+
+        params.append(('wt', 'json'))
+        params.append(('json.nl', 'map'))
+        if omitHeader:
+            params.append(('omitHeader', 'true'))
+
+        for fq in filterQueries:
+            params.append(('fq', fq))
+
+        if sort is not None:
+            params.append(('sort', sort))
+
+        self.prefix = urlparse.urlunsplit((o.scheme, o.netloc, o.path, urllib.urlencode(params), ''))
+        self.q      = q
+        self.rows   = rows
+
+    # splitClauses()
+    #___________________________________________________________________________
+    # Splits a query into its top-level AND clauses, to be sent as separate
+    # filter queries, which solr caches one by one. NOT clauses become pure
+    # negative queries.
+    @classmethod
+    def splitClauses(cls, q):
+        clauses = []
+        depth   = 0
+        quoted  = False
+        begin   = 0
+        i       = 0
+        while i < len(q):
+            c = q[i]
+            if '"' == c:
+                quoted = not quoted
+            elif not quoted and '(' == c:
+                depth += 1
+            elif not quoted and ')' == c:
+                depth -= 1
+            elif not quoted and 0 == depth and q.startswith(' AND ', i):
+                clauses.append(q[begin:i])
+                i += len(' AND ')
+                begin = i
+                continue
+            i += 1
+        clauses.append(q[begin:])
+
+        filters = []
+        for clause in clauses:
+            clause = clause.strip()
+            if clause.startswith('NOT '):
+                clause = '-' + clause[len('NOT '):].strip()
+            if clause:
+                filters.append(clause)
+        return filters
+
+    # getQuery()
+    #___________________________________________________________________________
+    def getQuery(self, q=None):
+        if self.q and q:
+            return '%s AND (%s)' % (self.q, q)
+        return self.q or q or '*:*'
+
+    # getUrl()
+    #___________________________________________________________________________
+    # start is the offset of the first row, as in solr
+    def getUrl(self, q=None, start=None, rows=None):
+        url = self.prefix + '&q=' + urllib.quote_plus(self.getQuery(q))
+
+        if rows is None:
+            rows = self.rows
+        if rows is not None:
+            url += '&rows=%d' % (rows)
+
+        if start:
+            url += '&start=%d' % (start)
+
+        return url
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -21,19 +21,16 @@ This file is part of bookserver.
     The bookserver source is hosted at http://github.com/internetarchive/bookserver/
 """
 
-import urllib
 import time
 
-import sys
-sys.path.append("/petabox/sw/lib/python")
-import simplejson as json
-
 from .. import Catalog
 from ..Entry import IAEntry, Entry
 from .. import Navigation
 from .. import OpenSearch
 from .. import Link
 import bookserver.util.language
+from SolrTransport import getDefaultTransport
+from SolrDecoder import SolrDecoder, KeyMap
 
 class SolrToCatalog:
 
@@ -65,6 +62,9 @@ class SolrToCatalog:
               'format'         : 'formats',
 
              }
+    compiledKeymap = KeyMap(keymap)
+
+    decoder = SolrDecoder()
 
     # removeKeys()
     #___________________________________________________________________________        
@@ -76,8 +76,7 @@ class SolrToCatalog:
     # entryFromSolrResult()
     #___________________________________________________________________________        
     def entryFromSolrResult(self, item, pubInfo):
-        #use generator expression to map dictionary key names
-        bookDict = dict( (SolrToCatalog.keymap[key], val) for key, val in item.iteritems() )
+        bookDict = SolrToCatalog.compiledKeymap.translate(item)
 
         links = []
         if 'price' in bookDict:
@@ -138,32 +137,47 @@ class SolrToCatalog:
                 bookDict['rights'] = rightsStr
             
         self.removeKeys(bookDict, ('links','price', 'currencyCode')) 
-        e = Entry(bookDict, links=links)
+        e = Entry.fromTrusted(bookDict, links=links)
 
         return e
 
     # SolrToCatalog()
     #___________________________________________________________________________    
-    def __init__(self, pubInfo, url, urn, start=None, numRows=None, urlBase=None, titleFragment=None):
+    # Pass in the response body to build a catalog from a result that was
+    # already fetched, e.g. by SolrTransport.getMany(), or a file object to
+    # read it from. Otherwise the url is fetched here.
+    #
+    # For keyset pagination, pass the solr fields of the sort key as
+    # cursorFields. The next link is then a cursor made from the last doc,
+    # and start may be None for pages reached by cursor.
+    #
+    # If lazy is set, entries are built one at a time as the catalog is
+    # rendered, so a streaming renderer never holds the whole page.
+    def __init__(self, pubInfo, url, urn, start=None, numRows=None, urlBase=None, titleFragment=None, transport=None, response=None, cursorFields=None, lazy=False):
                     
         self.url = url
-        f = urllib.urlopen(self.url)
-        contents = f.read()
-        f.close()
-        try:
-            obj = json.loads(contents)
-        except ValueError:
-            # No search results - fake response object
-            obj = { 'response': {
-                'docs': [],
-                'numFound': 0,
-            }}
-
-        numFound = int(obj['response']['numFound'])
+        if None == response:
+            if None == transport:
+                transport = getDefaultTransport()
+            contents = transport.get(self.url)
+        else:
+            contents = response
+
+        if hasattr(contents, 'read'):
+            (numFound, docs) = self.decoder.stream(contents)
+        else:
+            (numFound, docs) = self.decoder.decode(contents)
+        self.numFound = numFound
         
         title = pubInfo['name'] + ' Catalog'        
 
-        if None != start:
+        #a page reached by cursor only finds the books after the cursor
+        if None == start and None != cursorFields:
+            if 0 == numFound:
+                title += ' - no more '
+            else:
+                title += " - %d more " % (numFound)
+        elif None != start:
             if 0 == numFound:
                 title += ' - no '
             else:
@@ -185,18 +199,68 @@ class SolrToCatalog:
                          datestr   = self.getDateString(),                                 
                         )
 
+        #the next link of a cursor page is made from the last doc
+        if None != cursorFields and not isinstance(docs, list):
+            docs = list(docs)
 
-        nav = Navigation.initWithBaseUrl(start, numRows, numFound, urlBase)
+        if lazy:
+            summary = None
+            if isinstance(docs, list):
+                summary = [self.entrySummary(item, pubInfo) for item in docs]
+            self.c.setEntries(self.iterEntries(docs, pubInfo), summary)
+        else:
+            for item in docs:
+                entry = self.entryFromSolrResult(item, pubInfo)
+                self.c.addEntry(entry)
+
+        if None != cursorFields:
+            nextCursor = None
+            if docs and (None == start or (start+1)*numRows < numFound):
+                values = [docs[-1].get(field) for field in cursorFields]
+                if None not in values:
+                    nextCursor = Navigation.encodeCursor(values)
+            nav = Navigation.initWithCursor(start, numRows, len(docs), nextCursor, urlBase)
+        else:
+            nav = Navigation.initWithBaseUrl(start, numRows, numFound, urlBase)
         self.c.addNavigation(nav)
 
         osDescriptionDoc = pubInfo['opdsroot'] + '/opensearch.xml'
         o = OpenSearch(osDescriptionDoc)
         self.c.addOpenSearch(o)
-
-        for item in obj['response']['docs']:
-            entry = self.entryFromSolrResult(item, pubInfo)
-            self.c.addEntry(entry)
   
+    # iterEntries()
+    #___________________________________________________________________________
+    def iterEntries(self, docs, pubInfo):
+        for item in docs:
+            yield self.entryFromSolrResult(item, pubInfo)
+
+    # entrySummary()
+    #___________________________________________________________________________
+    # Returns the (urn, updated, downloadsPerMonth) of the entry for a solr
+    # doc, without building the entry.
+    def entrySummary(self, item, pubInfo):
+        if 'updated' in item:
+            return (item.get('urn'), item['updated'], item.get('month'))
+        return (item.get('urn'), self.getDateString(), item.get('month'))
+
+    # createMany()
+    #___________________________________________________________________________
+    # Runs several solr queries concurrently, so that a page built from many
+    # queries waits for the slowest one instead of their sum. Each query is a
+    # dict of keyword arguments for the constructor, including url and urn.
+    # Returns one ingestor per query, in order.
+    @classmethod
+    def createMany(cls, pubInfo, queries, transport=None):
+        if None == transport:
+            transport = getDefaultTransport()
+
+        responses = transport.getMany([query['url'] for query in queries])
+
+        ingestors = []
+        for query, response in zip(queries, responses):
+            ingestors.append(cls(pubInfo, transport=transport, response=response, **query))
+        return ingestors
+
     # getCatalog()
     #___________________________________________________________________________    
     def getCatalog(self):        
@@ -225,9 +289,14 @@ class SolrToCatalog:
 # recommended for a bookserver installation.
 
 class IASolrToCatalog(SolrToCatalog):
+    def entrySummary(self, item, pubInfo):
+        urn = pubInfo['urnroot'] + ':item:' + item['identifier']
+        if 'publicdate' in item:
+            return (urn, item['publicdate'], item.get('month'))
+        return (urn, self.getDateString(), item.get('month'))
+
     def entryFromSolrResult(self, item, pubInfo):
-        #use generator expression to map dictionary key names
-        bookDict = dict( (SolrToCatalog.keymap[key], val) for key, val in item.iteritems() )
+        bookDict = SolrToCatalog.compiledKeymap.translate(item)
 
         if 'publicdate' in item:
             bookDict['updated'] = item['publicdate']
@@ -258,6 +327,6 @@ class IASolrToCatalog(SolrToCatalog):
         thumbLink = Link(url  = "http://www.archive.org/download/%s/page/cover_thumb.jpg" % (item['identifier']),
                        type = 'image/jpeg', rel = 'http://opds-spec.org/image/thumbnail')
                        
-        e = IAEntry(bookDict, links=(pdfLink, epubLink, coverLink, thumbLink))
+        e = IAEntry.fromTrusted(bookDict, links=(pdfLink, epubLink, coverLink, thumbLink))
         
         return e
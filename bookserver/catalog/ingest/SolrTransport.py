@@ -0,0 +1,281 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+The SolrTransport class fetches Solr query urls over persistent HTTP/1.1
+connections. Each Solr host gets a bounded pool of keep-alive connections,
+so a busy frontend does not pay a new TCP handshake for every page.
+
+Transient failures (connection errors, timeouts, and 502/503/504
+responses) are retried with exponential backoff. An idle keep-alive
+connection that the server has closed in the meantime is not a failure:
+the request is sent again at once on a new connection. Any other status
+than 200 is an error, so that Solr error pages are never taken for empty
+results.
+
+>>> SolrTransport.splitUrl('http://se.us.archive.org:8983/solr/select?q=a&wt=json')
+(('http', 'se.us.archive.org', 8983), '/solr/select?q=a&wt=json')
+>>> SolrTransport.splitUrl('https://example.com/solr/select')
+(('https', 'example.com', 443), '/solr/select')
+"""
+
+import errno
+import httplib
+import socket
+import threading
+import time
+import urlparse
+import Queue
+
+class SolrTransportError(IOError):
+    pass
+
+class SolrTransport:
+
+    transientStatus = (502, 503, 504)
+
+    # errors from a reused connection that mean the server closed it while
+    # it was idle
+    staleErrors = (errno.ECONNRESET, errno.EPIPE)
+
+    # SolrTransport()
+    #___________________________________________________________________________
+    def __init__(self, maxConnections = 8,
+                       connectTimeout = 2.0,
+                       readTimeout    = 10.0,
+                       retries        = 2,
+                       backoff        = 0.1,
+                       poolTimeout    = 10.0,
+                       userAgent      = 'Internet Archive Bookserver'):
+        self.maxConnections = maxConnections
+        self.connectTimeout = connectTimeout
+        self.readTimeout    = readTimeout
+        self.retries        = retries
+        self.backoff        = backoff
+        self.poolTimeout    = poolTimeout
+        self.userAgent      = userAgent
+
+        self._pools = {}
+        self._lock  = threading.Lock()
+
+    # splitUrl()
+    #___________________________________________________________________________
+    @classmethod
+    def splitUrl(cls, url):
+        o = urlparse.urlsplit(url)
+        if 'https' == o.scheme:
+            port = o.port or 443
+        else:
+            port = o.port or 80
+
+        path = o.path or '/'
+        if o.query:
+            path += '?' + o.query
+
+        return (o.scheme, o.hostname, port), path
+
+    # getPool()
+    #___________________________________________________________________________
+    # Returns (idle connection queue, semaphore) for a host. The semaphore
+    # bounds the number of connections open to that host at once.
+    def getPool(self, hostKey):
+        self._lock.acquire()
+        try:
+            if not hostKey in self._pools:
+                self._pools[hostKey] = (Queue.Queue(),
+                                        threading.BoundedSemaphore(self.maxConnections))
+            return self._pools[hostKey]
+        finally:
+            self._lock.release()
+
+    # connect()
+    #___________________________________________________________________________
+    def connect(self, hostKey):
+        (scheme, host, port) = hostKey
+        if 'https' == scheme:
+            conn = httplib.HTTPSConnection(host, port, timeout=self.connectTimeout)
+        else:
+            conn = httplib.HTTPConnection(host, port, timeout=self.connectTimeout)
+
+        conn.connect()
+        conn.sock.settimeout(self.readTimeout)
+        return conn
+
+    # acquire()
+    #___________________________________________________________________________
+    # Waits at most poolTimeout seconds for one of the host's connections to
+    # be free. threading semaphores can't time out in python 2, so this polls.
+    def acquire(self, semaphore, hostKey):
+        deadline = time.time() + self.poolTimeout
+        delay    = 0.001
+        while not semaphore.acquire(False):
+            if time.time() >= deadline:
+                raise SolrTransportError('no connection to %s:%d free after %.1f seconds' % (hostKey[1], hostKey[2], self.poolTimeout))
+            time.sleep(delay)
+            delay = min(delay * 2, 0.05)
+
+    # isStale()
+    #___________________________________________________________________________
+    # True if e, raised before a status line arrived, means the server had
+    # closed the connection.
+    @classmethod
+    def isStale(cls, e):
+        if isinstance(e, httplib.BadStatusLine):
+            return True
+        return isinstance(e, socket.error) and e.errno in SolrTransport.staleErrors
+
+    # request()
+    #___________________________________________________________________________
+    # Makes a single attempt. Returns (status, body).
+    def request(self, hostKey, path):
+        (idle, semaphore) = self.getPool(hostKey)
+
+        self.acquire(semaphore, hostKey)
+        conn = None
+        try:
+            try:
+                conn   = idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                conn   = self.connect(hostKey)
+                reused = False
+
+            try:
+                while True:
+                    try:
+                        conn.request('GET', path, headers = {'User-Agent': self.userAgent,
+                                                             'Connection': 'keep-alive'})
+                        response = conn.getresponse()
+                        break
+                    except (socket.error, httplib.HTTPException), e:
+                        if not (reused and self.isStale(e)):
+                            raise
+                        #closed while idle: try again on a new connection
+                        conn.close()
+                        conn   = self.connect(hostKey)
+                        reused = False
+
+                body = response.read()
+            except:
+                conn.close()
+                conn = None
+                raise
+
+            if response.will_close:
+                conn.close()
+            else:
+                idle.put(conn)
+            conn = None
+
+            return response.status, body
+        finally:
+            if conn is not None:
+                conn.close()
+            semaphore.release()
+
+    # get()
+    #___________________________________________________________________________
+    def get(self, url):
+        (hostKey, path) = self.splitUrl(url)
+
+        attempt = 0
+        while True:
+            try:
+                (status, body) = self.request(hostKey, path)
+                if 200 == status:
+                    return body
+                if status not in SolrTransport.transientStatus:
+                    raise SolrTransportError('could not fetch %s (HTTP status %d)' % (url, status))
+                error = 'HTTP status %d' % (status)
+            except (socket.error, httplib.HTTPException), e:
+                error = '%s: %s' % (e.__class__.__name__, e)
+
+            if attempt >= self.retries:
+                raise SolrTransportError('could not fetch %s after %d attempts (%s)' % (url, attempt+1, error))
+
+            time.sleep(self.backoff * (2 ** attempt))
+            attempt += 1
+
+    # getMany()
+    #___________________________________________________________________________
+    # Fetches several urls concurrently, using at most maxConnections threads.
+    # Returns the bodies in the same order as urls. If any fetch fails, the
+    # first error is raised after all threads have finished.
+    def getMany(self, urls):
+        results = [None] * len(urls)
+        errors  = []
+        todo    = Queue.Queue()
+        for i, url in enumerate(urls):
+            todo.put((i, url))
+
+        def worker():
+            while True:
+                try:
+                    (i, url) = todo.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[i] = self.get(url)
+                except Exception, e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=worker) for i in range(min(len(urls), self.maxConnections))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        if errors:
+            raise errors[0]
+
+        return results
+
+    # close()
+    #___________________________________________________________________________
+    def close(self):
+        self._lock.acquire()
+        try:
+            for (idle, semaphore) in self._pools.itervalues():
+                while True:
+                    try:
+                        idle.get_nowait().close()
+                    except Queue.Empty:
+                        break
+            self._pools = {}
+        finally:
+            self._lock.release()
+
+
+# getDefaultTransport()
+#_______________________________________________________________________________
+# Shared transport for callers that do not configure their own.
+_defaultTransport = None
+
+def getDefaultTransport():
+    global _defaultTransport
+    if _defaultTransport is None:
+        _defaultTransport = SolrTransport()
+    return _defaultTransport
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
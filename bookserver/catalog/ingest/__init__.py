@@ -28,3 +28,6 @@ This file is part of bookserver.
 from OpdsToCatalog import OpdsToCatalog
 from SolrToCatalog import SolrToCatalog
 from SolrToCatalog import IASolrToCatalog
+from SolrTransport import SolrTransport, SolrTransportError
+from SolrQuery     import SolrQuery
+from SolrDecoder   import SolrDecoder, KeyMap
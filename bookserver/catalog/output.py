@@ -35,22 +35,98 @@ import sys
 sys.path.append("/petabox/sw/lib/python")
 import feedparser #for _parse_date()
 import datetime
+import itertools
 import string
 import opensearch
 
 class CatalogRenderer:
     """Base class for catalog renderers"""
 
+    # values that escapeText() and escapeAttribute() return unchanged, and
+    # characters lxml refuses
+    plainText    = re.compile(r'[^&<>\x00-\x08\x0b-\x1f\x80-\xff]*\Z')
+    plainUnicode = re.compile(u'[^&<>\x00-\x08\x0b-\x1f\x80-\uffff]*\Z')
+    plainAttribute = re.compile(r'[^&<>"\x00-\x1f\x80-\xff]*\Z')
+    plainUnicodeAttribute = re.compile(u'[^&<>"\x00-\x1f\x80-\uffff]*\Z')
+    invalidChars = re.compile(u'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+
+    # FragmentCache of rendered entries, or None
+    entryCache = None
+
     def __init__(self):
         pass
         
     def toString(self):
         return ''
+
+    # cachedEntry()
+    #___________________________________________________________________________
+    # Returns render(entry), from entryCache if this version of the entry has
+    # been rendered before by this renderer, with the same options. Download
+    # counts are rendered, and change without changing the updated date, so
+    # they are part of the version.
+    def cachedEntry(self, entry, options, render):
+        cache = self.entryCache
+        urn = entry.get('urn')
+        updated = entry.get('updated')
+        if cache is None or urn is None or updated is None:
+            return render(entry)
+
+        key = (urn, updated, entry.get('downloadsPerMonth'), self.__class__.__name__, options)
+        s = cache.get(key)
+        if s is None:
+            s = render(entry)
+            cache.set(key, s)
+        return s
         
     def prettyPrintET(self, etNode):
         return ET.tostring(etNode, pretty_print=True)
 
-class CatalogToAtom(CatalogRenderer):
+    # The helpers below write text and attribute values as lxml serializes
+    # them, for renderers that assemble their output from string templates.
+
+    # escapeText()
+    #___________________________________________________________________________
+    # Most values are plain ascii text, and are returned unchanged
+    @classmethod
+    def escapeText(cls, value):
+        if isinstance(value, str):
+            if cls.plainText.match(value):
+                return value
+            value = value.decode('utf-8')
+        elif cls.plainUnicode.match(value):
+            return value.encode('ascii')
+        if cls.invalidChars.search(value):
+            raise ValueError('All strings must be XML compatible: Unicode or ASCII, no NULL bytes or control characters')
+        value = value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('\r', '&#13;')
+        return value.encode('ascii', 'xmlcharrefreplace')
+
+    # escapeAttribute()
+    #___________________________________________________________________________
+    @classmethod
+    def escapeAttribute(cls, value):
+        if isinstance(value, str):
+            if cls.plainAttribute.match(value):
+                return value
+        elif cls.plainUnicodeAttribute.match(value):
+            return value.encode('ascii')
+        value = cls.escapeText(value)
+        return value.replace('"', '&quot;').replace('\n', '&#10;').replace('\t', '&#9;')
+
+    # textElement()
+    #___________________________________________________________________________
+    # Returns an element with text, written as lxml does when text is None
+    @classmethod
+    def textElement(cls, startTag, text, endTag):
+        if text is None:
+            return startTag[:-1] + '/>'
+        return startTag + cls.escapeText(text) + endTag
+
+class AtomBuilder(CatalogRenderer):
+    """
+    Builds the lxml elements of an OPDS feed. CatalogToAtom puts them all
+    in one tree; CatalogToAtomStream serializes them an entry at a time.
+    """
 
     #some xml namespace constants
     #___________________________________________________________________________
@@ -111,15 +187,20 @@ class CatalogToAtom(CatalogRenderer):
         
         self.createRelLink(opds, 'self', c._url, '')
         
-        author = ET.SubElement(opds, 'author')
-        self.createTextElement(author, 'name',  c._author)
-        self.createTextElement(author, 'uri',   c._authorUri)
+        self.createAuthor(opds, c)
         
         if c._crawlableUrl:
             self.createRelLink(opds, 'http://opds-spec.org/crawlable', c._crawlableUrl, '', 'Crawlable feed')
             
         return opds
 
+    # createAuthor()
+    #___________________________________________________________________________
+    def createAuthor(self, opds, c):
+        author = ET.SubElement(opds, 'author')
+        self.createTextElement(author, 'name',  c._author)
+        self.createTextElement(author, 'uri',   c._authorUri)
+
     # createOpdsLink()
     #___________________________________________________________________________
     def createOpdsLink(self, entry, link):
@@ -179,49 +260,54 @@ class CatalogToAtom(CatalogRenderer):
             self.createTextElement(entry, 'content',  obj['content'])
         elif fabricateContentElement:
             ### fabricate an atom:content element if asked to
-            ### FireFox won't show the content element if it contains nested html elements
-            contentText=''
-        
-            if 'authors' in obj:
-                if 1 == len(obj['authors']):
-                    authorStr = '<b>Author: </b>'
-                else:
-                    authorStr = '<b>Authors: </b>'
-                
-                authorStr += ', '.join(obj['authors'])
-                contentText += authorStr + '<br/>'
-        
-            #TODO: refactor
-            if 'subjects' in obj:
-                contentText += '<b>Subject </b>' + ', '.join(obj['subjects']) + '<br/>'
-        
-            if 'publishers' in obj:
-                contentText += '<b>Publisher: </b>' + ', '.join(obj['publishers']) + '<br/>'
-                
-            if 'date' in obj:
-                contentText += '<b>Year published: </b>' + obj['date'][0:4] + '<br/>'
-        
-            if 'contributors' in obj:
-                contentText += '<b>Book contributor: </b>' + ', '.join(obj['contributors']) + '<br/>'
-        
-            if 'languages' in obj:
-                contentText += '<b>Language: </b>' + ', '.join(obj['languages']) + '<br/>'
-        
-            if 'downloadsPerMonth' in obj:
-                contentText += str(obj['downloadsPerMonth']) + ' downloads in the last month' + '<br/>'
+            element = self.createTextElement(entry, 'content',  self.fabricateContent(obj, downloadLinks))
+            element.attrib['type'] = 'html'        
 
-            if 'provider' in obj:
-                contentText += '<b>Provider: </b>' + obj['provider'] + '<br/>'
+    # fabricateContent()
+    #___________________________________________________________________________
+    # Returns the html for the atom:content element of an entry that has none
+    def fabricateContent(self, obj, downloadLinks):
+        ### FireFox won't show the content element if it contains nested html elements
+        contentText=''
+    
+        if 'authors' in obj:
+            if 1 == len(obj['authors']):
+                authorStr = '<b>Author: </b>'
+            else:
+                authorStr = '<b>Authors: </b>'
+            
+            authorStr += ', '.join(obj['authors'])
+            contentText += authorStr + '<br/>'
+    
+        #TODO: refactor
+        if 'subjects' in obj:
+            contentText += '<b>Subject </b>' + ', '.join(obj['subjects']) + '<br/>'
+    
+        if 'publishers' in obj:
+            contentText += '<b>Publisher: </b>' + ', '.join(obj['publishers']) + '<br/>'
+            
+        if 'date' in obj:
+            contentText += '<b>Year published: </b>' + obj['date'][0:4] + '<br/>'
+    
+        if 'contributors' in obj:
+            contentText += '<b>Book contributor: </b>' + ', '.join(obj['contributors']) + '<br/>'
+    
+        if 'languages' in obj:
+            contentText += '<b>Language: </b>' + ', '.join(obj['languages']) + '<br/>'
+    
+        if 'downloadsPerMonth' in obj:
+            contentText += str(obj['downloadsPerMonth']) + ' downloads in the last month' + '<br/>'
 
-            if len(downloadLinks):
-                contentText += '<b>Download Ebook: </b>'
-                for link in downloadLinks:
-                    (start, sep, ext) = link.get('url').rpartition('.')
-                    contentText += '(<a href="%s">%s</a>) '%(link.get('url'), ext.upper())
+        if 'provider' in obj:
+            contentText += '<b>Provider: </b>' + obj['provider'] + '<br/>'
 
-        
-            element = self.createTextElement(entry, 'content',  contentText)
-            element.attrib['type'] = 'html'        
+        if len(downloadLinks):
+            contentText += '<b>Download Ebook: </b>'
+            for link in downloadLinks:
+                (start, sep, ext) = link.get('url').rpartition('.')
+                contentText += '(<a href="%s">%s</a>) '%(link.get('url'), ext.upper())
+
+        return contentText
 
     # createOpenSearchDescription()
     #___________________________________________________________________________
@@ -237,6 +323,9 @@ class CatalogToAtom(CatalogRenderer):
         if nav.nextLink:
             self.createRelLink(opds, 'next', '', nav.nextLink, nav.nextTitle)
 
+
+class CatalogToAtom(AtomBuilder):
+
     # __init__()
     #___________________________________________________________________________    
     def __init__(self, c, fabricateContentElement=False):
@@ -262,7 +351,297 @@ class CatalogToAtom(CatalogRenderer):
     #___________________________________________________________________________    
     def toElementTree(self):
         return self.opds
-        
+
+
+class CatalogToAtomStream(AtomBuilder):
+    """
+    Serializes the feed one entry at a time, without ever building the
+    lxml tree for the whole catalog. Iterating over the renderer yields
+    the feed in chunks, so it can be returned as a WSGI iterable. The
+    output is byte-identical to CatalogToAtom.toString().
+
+    Each entry is built inside an empty <feed> element with the same
+    nsmap as the real feed root, so it is serialized with the same
+    namespace prefixes and indentation as in the full tree. It is not a
+    CatalogToAtom, and has no toElementTree().
+
+        >>> a = CatalogToAtom(testCatalog, fabricateContentElement=True)
+        >>> s = CatalogToAtomStream(testCatalog, fabricateContentElement=True)
+        >>> ''.join(s) == a.toString()
+        True
+        >>> s = CatalogToAtomStream(testCatalog, prettyPrint=False)
+        >>> s.toString() == ET.tostring(CatalogToAtom(testCatalog).toElementTree())
+        True
+        >>> hasattr(s, 'toElementTree')
+        False
+    """
+
+    def __init__(self, c, fabricateContentElement=False, prettyPrint=True):
+        CatalogRenderer.__init__(self)
+        self.catalog = c
+        self.fabricateContentElement = fabricateContentElement
+        self.prettyPrint = prettyPrint
+
+    # createFeedHead()
+    #___________________________________________________________________________
+    def createFeedHead(self, c):
+        opds = self.createOpdsRoot(c)
+
+        if c._opensearch:
+            self.createOpenSearchDescription(opds, c._opensearch)
+
+        if c._navigation:
+            self.createNavLinks(opds, c._navigation)
+
+        return opds
+
+    # splitFeed()
+    #___________________________________________________________________________
+    # Serializes a <feed> element, and returns its start tag, children, and
+    # end tag as three strings
+    def splitFeed(self, opds):
+        s = ET.tostring(opds, pretty_print=self.prettyPrint)
+        endTag = '</feed>'
+        if self.prettyPrint:
+            endTag += '\n'
+            startTagEnd = s.index('>\n') + 2
+        else:
+            startTagEnd = s.index('>') + 1
+        assert s.endswith(endTag)
+        return s[:startTagEnd], s[startTagEnd:-len(endTag)], endTag
+
+    # __iter__()
+    #___________________________________________________________________________
+    def __iter__(self):
+        c = self.catalog
+        (startTag, head, endTag) = self.splitFeed(self.createFeedHead(c))
+        yield startTag + head
+
+        wrapper = ET.Element(CatalogToAtom.atom + "feed", nsmap=CatalogToAtom.nsmap)
+        for e in c._entries:
+            self.createOpdsEntry(wrapper, e._entry, e._links, self.fabricateContentElement)
+            yield self.splitFeed(wrapper)[1]
+            wrapper.clear()
+
+        yield endTag
+
+    # toString()
+    #___________________________________________________________________________
+    def toString(self):
+        return ''.join(self)
+
+
+class TemplateCatalogToAtom(CatalogToAtomStream):
+    """
+    Streams the same feed as CatalogToAtomStream, from string templates
+    instead of lxml elements. The parts of the feed that are the same on
+    every page (the <feed> start tag with its namespaces, the author block,
+    the opensearch link) are serialized by lxml once and cached. Entry links
+    are templated on their type and rel, so the links of an archive.org
+    book, which differ only in the identifier in their urls, cost one
+    substitution each.
+
+        >>> a = CatalogToAtom(testCatalog, fabricateContentElement=True)
+        >>> t = TemplateCatalogToAtom(testCatalog, fabricateContentElement=True)
+        >>> t.toString() == a.toString()
+        True
+        >>> ''.join(TemplateCatalogToAtom(testCatalog)) == CatalogToAtom(testCatalog).toString()
+        True
+
+    Entries with links that don't fit the template are built with lxml.
+
+    Rendered entries are kept in entryCache, if it is set, keyed by urn,
+    updated date, download count and fabricateContentElement:
+
+        >>> from bookserver.cache import FragmentCache
+        >>> cache = FragmentCache()
+        >>> t = TemplateCatalogToAtom(testCatalog, entryCache=cache)
+        >>> t.toString() == TemplateCatalogToAtom(testCatalog, entryCache=cache).toString()
+        True
+        >>> cache.getStats()['hits'], cache.getStats()['misses']
+        (1, 1)
+
+        >>> e = Entry({'urn': 'x-internet-archive:item:counted', 'title': u'counted',
+        ...            'updated': '2009-01-01T00:00:00Z', 'downloadsPerMonth': u'5'},
+        ...           links=testEntry.getLinks())
+        >>> counted = Catalog(title='Counted')
+        >>> counted.addEntry(e)
+        >>> before = TemplateCatalogToAtom(counted, True, entryCache=cache).toString()
+        >>> e.set('downloadsPerMonth', u'6')
+        >>> '6 downloads' in TemplateCatalogToAtom(counted, True, entryCache=cache).toString()
+        True
+    """
+
+    # serialized feed fragments, by name and values
+    fragments = {}
+
+    # the end of a link element after its href, by (type, rel)
+    linkSuffixes = {}
+
+    # the fragments depend on the catalog's values; if there are this many,
+    # something is wrong
+    maxCached = 1024
+
+    def __init__(self, c, fabricateContentElement=False, entryCache=None):
+        CatalogToAtomStream.__init__(self, c, fabricateContentElement)
+        self.entryCache = entryCache
+
+    # cache()
+    #___________________________________________________________________________
+    @classmethod
+    def cache(cls, d, key, value):
+        if len(d) >= cls.maxCached:
+            d.clear()
+        d[key] = value
+        return value
+
+    # fragment()
+    #___________________________________________________________________________
+    # Returns the serialized children that createChildren(feed, *args) adds
+    # to a <feed>, built the first time they are needed for key
+    def fragment(self, key, createChildren, *args):
+        s = self.fragments.get(key)
+        if s is None:
+            opds = ET.Element(CatalogToAtom.atom + "feed", nsmap=CatalogToAtom.nsmap)
+            createChildren(opds, *args)
+            s = self.cache(self.fragments, key, self.splitFeed(opds)[1])
+        return s
+
+    # feedStartTag()
+    #___________________________________________________________________________
+    def feedStartTag(self):
+        s = self.fragments.get('startTag')
+        if s is None:
+            opds = ET.Element(CatalogToAtom.atom + "feed", nsmap=CatalogToAtom.nsmap)
+            ET.SubElement(opds, 'id')
+            s = self.cache(self.fragments, 'startTag', self.splitFeed(opds)[0])
+        return s
+
+    # renderRelLink()
+    #___________________________________________________________________________
+    def renderRelLink(self, rel, url, title=None, type='application/atom+xml'):
+        s = '  <link rel="%s" type="%s" href="%s"' % (self.escapeAttribute(rel),
+                                                     self.escapeAttribute(type),
+                                                     self.escapeAttribute(url))
+        if title:
+            s += ' title="%s"' % (self.escapeAttribute(title))
+        return s + '/>\n'
+
+    # renderFeedHead()
+    #___________________________________________________________________________
+    def renderFeedHead(self, c):
+        head = [self.feedStartTag(),
+                self.textElement('  <title>', c._title, '</title>\n'),
+                self.textElement('  <id>', c._urn, '</id>\n'),
+                self.textElement('  <updated>', c._datestr, '</updated>\n'),
+                self.renderRelLink('self', c._url),
+                self.fragment(('author', c._author, c._authorUri), self.createAuthor, c),
+               ]
+
+        if c._crawlableUrl:
+            head.append(self.renderRelLink('http://opds-spec.org/crawlable', c._crawlableUrl, 'Crawlable feed'))
+
+        if c._opensearch:
+            head.append(self.fragment(('search', c._opensearch.osddUrl), self.createOpenSearchDescription, c._opensearch))
+
+        nav = c._navigation
+        if nav:
+            if nav.prevLink:
+                head.append(self.renderRelLink('prev', nav.prevLink, nav.prevTitle))
+            if nav.nextLink:
+                head.append(self.renderRelLink('next', nav.nextLink, nav.nextTitle))
+
+        return ''.join(head)
+
+    # renderLink()
+    #___________________________________________________________________________
+    # Returns None for links that don't fit the template: priced links, or
+    # links that list formats, as in feeds from other bookservers
+    def renderLink(self, link):
+        url  = link.get('url')
+        type = link.get('type')
+        if url is None or type is None or link.get('price') or link.get('formats'):
+            #lxml raises an error for a missing url or type
+            return None
+
+        key = (type, link.get('rel'))
+        suffix = self.linkSuffixes.get(key)
+        if suffix is None:
+            suffix = '" type="%s"' % (self.escapeAttribute(type))
+            if key[1]:
+                suffix += ' rel="%s"' % (self.escapeAttribute(key[1]))
+            suffix = self.cache(self.linkSuffixes, key, suffix + '/>\n')
+
+        return '    <link href="' + self.escapeAttribute(url) + suffix
+
+    # renderEntry()
+    #___________________________________________________________________________
+    # Returns None if the entry has to be built with lxml
+    def renderEntry(self, obj, links):
+        textElement = self.textElement
+        entry = ['  <entry>\n',
+                 textElement('    <title>', obj['title'], '</title>\n'),
+                 textElement('    <id>', obj['urn'], '</id>\n'),
+                 textElement('    <updated>', obj['updated'], '</updated>\n'),
+                ]
+
+        downloadLinks = []
+        for link in links:
+            s = self.renderLink(link)
+            if s is None:
+                return None
+            entry.append(s)
+            if link.get('type') in CatalogToAtom.ebookTypes:
+                downloadLinks.append(link)
+
+        if 'date' in obj:
+            entry.append(textElement('    <dcterms:issued>', obj['date'][0:4], '</dcterms:issued>\n'))
+
+        if 'authors' in obj:
+            for author in obj['authors']:
+                entry.append(textElement('    <author>\n      <name>', author, '</name>\n    </author>\n'))
+
+        if 'subjects' in obj:
+            for subject in obj['subjects']:
+                entry.append('    <category term="%s"/>\n' % (self.escapeAttribute(subject)))
+
+        if 'publishers' in obj:
+            for publisher in obj['publishers']:
+                entry.append(textElement('    <dcterms:publisher>', publisher, '</dcterms:publisher>\n'))
+
+        if 'languages' in obj:
+            for language in obj['languages']:
+                entry.append(textElement('    <dcterms:language>', language, '</dcterms:language>\n'))
+
+        if 'content' in obj:
+            entry.append(textElement('    <content>', obj['content'], '</content>\n'))
+        elif self.fabricateContentElement:
+            entry.append(textElement('    <content type="html">', self.fabricateContent(obj, downloadLinks), '</content>\n'))
+
+        entry.append('  </entry>\n')
+        return ''.join(entry)
+
+    # __iter__()
+    #___________________________________________________________________________
+    def __iter__(self):
+        c = self.catalog
+        yield self.renderFeedHead(c)
+
+        for e in c._entries:
+            yield self.cachedEntry(e, self.fabricateContentElement, self.renderOpdsEntry)
+
+        yield '</feed>\n'
+
+    # renderOpdsEntry()
+    #___________________________________________________________________________
+    def renderOpdsEntry(self, e):
+        s = self.renderEntry(e._entry, e._links)
+        if s is None:
+            wrapper = ET.Element(CatalogToAtom.atom + "feed", nsmap=CatalogToAtom.nsmap)
+            self.createOpdsEntry(wrapper, e._entry, e._links, self.fabricateContentElement)
+            s = self.splitFeed(wrapper)[1]
+        return s
+
 
 class CatalogToHtml(CatalogRenderer):
     """
@@ -276,6 +655,34 @@ class CatalogToHtml(CatalogRenderer):
         
         >>> h = CatalogToHtml(testCatalog)
         >>> # print(h.toString())
+
+    With stream set, the page is built when it is iterated over, one entry
+    at a time, and yielded in chunks. Only the current entry is held in
+    memory, so the catalog's entries can come from a generator. The output
+    is byte-identical to toString():
+
+        >>> s = ArchiveCatalogToHtml(testCatalog, stream=True)
+        >>> ''.join(s) == ArchiveCatalogToHtml(testCatalog).toString()
+        True
+
+    A streamed page keeps its rendered entries in entryCache, if it is set,
+    keyed by urn, updated date, download count and device variant, so the
+    next page with the same entries reuses them:
+
+        >>> from bookserver.cache import FragmentCache
+        >>> cache = FragmentCache()
+        >>> first = ''.join(ArchiveCatalogToHtml(testCatalog, stream=True, entryCache=cache))
+        >>> ''.join(ArchiveCatalogToHtml(testCatalog, stream=True, entryCache=cache)) == first
+        True
+        >>> cache.getStats()['hits'], cache.getStats()['misses']
+        (1, 1)
+
+    A catalog with no entries is streamed too:
+
+        >>> empty = Catalog(title='Empty')
+        >>> empty.addOpenSearch(testCatalog._opensearch)
+        >>> ''.join(CatalogToHtml(empty, stream=True)) == CatalogToHtml(empty).toString()
+        True
     """
     
     entryDisplayKeys = [
@@ -311,14 +718,26 @@ class CatalogToHtml(CatalogRenderer):
         'text/html': 'Website',
     }
         
-    def __init__(self, catalog, device = None, query = None, provider = None):
+    # marks where the entries go when the page is streamed
+    entryListSentinel = 'opds-entry-list-sentinel'
+
+    def __init__(self, catalog, device = None, query = None, provider = None, stream = False, entryCache = None):
         CatalogRenderer.__init__(self)
         self.device = device
         self.query = query
         self.provider = provider
-        self.processCatalog(catalog)
+        self.stream = stream
+        self.entryCache = entryCache
+        if stream:
+            self.catalog = catalog
+        else:
+            self.processCatalog(catalog)
         
     def processCatalog(self, catalog):
+        self.html = self.createPage(catalog, self.createEntryList(catalog._entries))
+        return self
+
+    def createPage(self, catalog, entryList):
         html = self.createHtml(catalog)
         html.append(self.createHead(catalog))
         body = self.createBody(catalog)
@@ -327,12 +746,80 @@ class CatalogToHtml(CatalogRenderer):
         body.append(self.createSearch(catalog._opensearch, query = self.query))
         body.append(self.createCatalogHeader(catalog))
         body.append(self.createNavigation(catalog._navigation))
-        body.append(self.createEntryList(catalog._entries))
+        body.append(entryList)
         body.append(self.createNavigation(catalog._navigation))
         body.append(self.createFooter(catalog))
-        
-        self.html = html
-        return self
+        return html
+
+    # splitAtSentinel()
+    #___________________________________________________________________________
+    # Serializes root, and returns the text before and after the line of
+    # the sentinel element
+    def splitAtSentinel(self, root):
+        s = self.prettyPrintET(root)
+        i = s.index(self.entryListSentinel)
+        lineStart = s.rindex('\n', 0, i) + 1
+        lineEnd   = s.index('\n', i) + 1
+        return s[:lineStart], s[lineEnd:]
+
+    # __iter__()
+    #___________________________________________________________________________
+    def __iter__(self):
+        if not self.stream:
+            yield self.toString()
+            return
+
+        catalog = self.catalog
+        entries = iter(catalog._entries)
+        try:
+            first = entries.next()
+        except StopIteration:
+            #an empty list is serialized as <ul/>
+            self.processCatalog(catalog)
+            yield self.prettyPrintET(self.html)
+            return
+
+        entryList = self.createEntryList([])
+        ET.SubElement(entryList, 'li').text = self.entryListSentinel
+        (pageHead, pageTail) = self.splitAtSentinel(self.createPage(catalog, entryList))
+        yield pageHead
+
+        #each entry is serialized at the same depth as in the page, so
+        #that it is indented the same way
+        wrapper = ET.Element('html')
+        for ancestor in list(entryList.iterancestors())[1:]:
+            wrapper = ET.SubElement(wrapper, 'div')
+        wrapper = ET.SubElement(wrapper, 'ul')
+        ET.SubElement(wrapper, 'li').text = self.entryListSentinel
+        root = wrapper.getroottree().getroot()
+        (wrapperHead, wrapperTail) = self.splitAtSentinel(root)
+        wrapper.clear()
+
+        def renderEntry(entry):
+            wrapper.extend(list(self.createEntryList([entry])))
+            s = self.prettyPrintET(root)
+            wrapper.clear()
+            assert s.startswith(wrapperHead) and s.endswith(wrapperTail)
+            return s[len(wrapperHead):len(s)-len(wrapperTail)]
+
+        options = self.entryOptions()
+        for entry in itertools.chain([first], entries):
+            yield self.cachedEntry(entry, options, renderEntry)
+
+        yield pageTail
+
+    # entryOptions()
+    #___________________________________________________________________________
+    # Returns what the rendering of an entry depends on, besides the entry
+    def entryOptions(self):
+        if self.device:
+            return self.device.variant
+        return None
+
+    def toString(self):
+        if self.stream:
+            return ''.join(self)
+        return self.prettyPrintET(self.html)
         
     def createHtml(self, catalog):
         return ET.Element('html')
@@ -421,15 +908,9 @@ class CatalogToHtml(CatalogRenderer):
         <a href="a/0.html" class="opds-navigation-anchor" rel="prev" title="Previous">Previous</a>
         """
         
-        # Munge URL
-        if url.endswith('.xml'):
-            url = url[:-4]
-        if not url.endswith('.html'):
-            url += '.html'
-        
         attribs = {'class':'opds-navigation-anchor',
             'rel': rel,
-            'href': url}
+            'href': self.navigationUrl(url)}
         if title is not None:
             attribs['title'] = title    
         a = ET.Element('a', attribs)
@@ -437,6 +918,16 @@ class CatalogToHtml(CatalogRenderer):
         if title is not None:
             a.text = title
         return a
+
+    # navigationUrl()
+    #___________________________________________________________________________
+    # Navigation links point at the html version of a page
+    def navigationUrl(self, url):
+        if url.endswith('.xml'):
+            url = url[:-4]
+        if not url.endswith('.html'):
+            url += '.html'
+        return url
         
     def createSearch(self, opensearchObj, query = None):
         div = ET.Element( 'div', {'class':'opds-search'} )
@@ -502,15 +993,25 @@ class CatalogToHtml(CatalogRenderer):
             <span class="opds-entry-item"><em class="opds-entry-key">Buy:</em> <a href="http://archive.org/download/itemid.pdf" class="opds-entry-link">PDF</a></span>
           </div>
         </p>
+
+        The entry is left unchanged, so that it can be rendered again, or by
+        another renderer at the same time:
+        >>> sub = Entry({'urn': 'x-internet-archive:bookserver:catalog:sub', 'title': u'Sub'},
+        ...             links=[Link(url='/catalog/sub', type=Link.opds), testEntry.getLinks()[0]])
+        >>> ET.tostring(testToHtml.createEntry(sub)) == ET.tostring(testToHtml.createEntry(sub))
+        True
+        >>> len(sub.getLinks())
+        2
         """
         
         e = ET.Element('p', { 'class':'opds-entry'} )
         
         elem = e        
         # Look for link to catalog, and if so, make the title of this entry a link
-        catalogLink = self.findCatalogLink(entry._links)
+        links = entry._links
+        catalogLink = self.findCatalogLink(links)
         if catalogLink:
-            entry._links.remove(catalogLink)
+            links = [link for link in links if link is not catalogLink]
             a = ET.SubElement(e, 'a', { 'class':'opds-entry-title', 'href':catalogLink.get('url') } )
             elem = a
         
@@ -530,8 +1031,8 @@ class CatalogToHtml(CatalogRenderer):
                 itemValue.text = unicode(displayValue)
                 ET.SubElement(entryItem, 'br')
 
-        if entry._links:
-            e.append(self.createEntryLinks(entry._links))
+        if links:
+            e.append(self.createEntryLinks(links))
                                 
         # TODO sort for display order
         # for key in Entry.valid_keys.keys():
@@ -572,6 +1073,29 @@ class CatalogToHtml(CatalogRenderer):
         </div>
         """
         
+        d = ET.Element('div', {'class':'opds-entry-links'} )
+
+        for (linkList, listTitle) in self.groupEntryLinks(links):
+            if len(linkList) > 0:
+                s = ET.Element('span', { 'class':'opds-entry-item' } )
+                title = ET.SubElement(s, 'em', {'class':'opds-entry-key'} )
+                title.text = listTitle
+                title.tail = ' '
+                
+                linkElems = [self.createEntryLink(aLink) for aLink in linkList]
+                for linkElem in linkElems:
+                    s.append(linkElem)
+                    if linkElem != linkElems[-1]:
+                        linkElem.tail = ', '
+                        
+                d.append(s)
+                        
+        return d
+
+    # groupEntryLinks()
+    #___________________________________________________________________________
+    # Returns a list of (links, title) for each kind of link, in display order
+    def groupEntryLinks(self, links):
         free = []
         buy = []
         lend = []
@@ -580,8 +1104,6 @@ class CatalogToHtml(CatalogRenderer):
         opds = [] # XXX munge link for HTML proxy - make entry title the link
         html = []
         
-        d = ET.Element('div', {'class':'opds-entry-links'} )
-        
         for link in links:
             try:
                 rel = link.get('rel')
@@ -607,24 +1129,7 @@ class CatalogToHtml(CatalogRenderer):
                 html.append(link)
             # XXX output uncaught links
                 
-        linkTuples = [(free, 'Free:'), (buy, 'Buy:'), (subscribe, 'Subscribe:'), (sample, 'Sample:'), (opds, 'Catalog:'), (html, 'HTML:')]
-
-        for (linkList, listTitle) in linkTuples:
-            if len(linkList) > 0:
-                s = ET.Element('span', { 'class':'opds-entry-item' } )
-                title = ET.SubElement(s, 'em', {'class':'opds-entry-key'} )
-                title.text = listTitle
-                title.tail = ' '
-                
-                linkElems = [self.createEntryLink(aLink) for aLink in linkList]
-                for linkElem in linkElems:
-                    s.append(linkElem)
-                    if linkElem != linkElems[-1]:
-                        linkElem.tail = ', '
-                        
-                d.append(s)
-                        
-        return d
+        return [(free, 'Free:'), (buy, 'Buy:'), (subscribe, 'Subscribe:'), (sample, 'Sample:'), (opds, 'Catalog:'), (html, 'HTML:')]
         
     def createEntryLink(self, link):
         """
@@ -639,16 +1144,10 @@ class CatalogToHtml(CatalogRenderer):
         <a href="/blah.epub" class="opds-entry-link">ePub</a>
         """
         
-        if self.device:
-            link = self.device.formatLink(link)
-        
-        if self.entryLinkTitles.has_key(link.get('type')):
-            title = self.entryLinkTitles[link.get('type')]
-        else:
-            title = link.get('url')
+        (url, title) = self.formatEntryLink(link)
             
         attribs = {'class':'opds-entry-link',
-            'href' : link.get('url')
+            'href' : url
         }
         
         #try:
@@ -659,6 +1158,20 @@ class CatalogToHtml(CatalogRenderer):
         a = ET.Element('a', attribs)
         a.text = title
         return a
+
+    # formatEntryLink()
+    #___________________________________________________________________________
+    # Returns the (url, title) of a link, as formatted for the device
+    def formatEntryLink(self, link):
+        if self.device:
+            link = self.device.formatLink(link)
+        
+        if self.entryLinkTitles.has_key(link.get('type')):
+            title = self.entryLinkTitles[link.get('type')]
+        else:
+            title = link.get('url')
+
+        return (link.get('url'), title)
         
     def createEntryKey(self, key, value):
         # $$$ legacy
@@ -711,10 +1224,7 @@ class CatalogToHtml(CatalogRenderer):
                     return link
         return None
         
-    def toString(self):
-        return self.prettyPrintET(self.html)
-        
-        
+
 class ArchiveCatalogToHtml(CatalogToHtml):
     """
     Used to create an HTML catalog with Archive specific data and formatting
@@ -837,6 +1347,295 @@ class ArchiveCatalogToHtml(CatalogToHtml):
         return link
 
 #_______________________________________________________________________________
+
+class TemplateArchiveCatalogToHtml(ArchiveCatalogToHtml):
+    """
+    Renders the same page as ArchiveCatalogToHtml, from string templates
+    instead of an lxml tree. Constant parts of the page are serialized by
+    ArchiveCatalogToHtml once and cached, and each entry is assembled from
+    the templates below with its values escaped as lxml would.
+
+    Like CatalogToHtml with stream set, iterating over the renderer yields
+    the page one entry at a time. Rendered entries are kept in entryCache,
+    if it is set, keyed by urn, updated date, download count and device
+    variant.
+
+        >>> t = TemplateArchiveCatalogToHtml(testCatalog)
+        >>> t.toString() == ArchiveCatalogToHtml(testCatalog).toString()
+        True
+        >>> ''.join(t) == t.toString()
+        True
+
+    Values are escaped, and non-ascii characters written as character
+    references:
+
+        >>> TemplateArchiveCatalogToHtml.escapeText(u'<b> & caf\\xe9 "')
+        '&lt;b&gt; &amp; caf&#233; "'
+        >>> TemplateArchiveCatalogToHtml.escapeAttribute(u'a"b\\n')
+        'a&quot;b&#10;'
+    """
+
+    # constant page fragments, serialized once by fragment()
+    fragments = {}
+
+    # opensearch descriptions, loaded once per url
+    descriptions = {}
+
+    pageHeadTemplate = (
+        '<html>\n'
+        '  <head>\n'
+        '    %(titleElement)s\n'
+        '    <link href="/static/catalog.css" rel="stylesheet" type="text/css"/>\n'
+        '    <link href="/stylesheets/catalog.css" rel="stylesheet" type="text/css"/>\n'
+        '    <meta content="width = %(viewPortWidth)s" name="viewport"/>\n'
+        '  </head>\n'
+        '  <body>\n'
+        '%(header)s'
+        '%(search)s'
+        '    <div class="opds-catalog-header">\n'
+        '      %(headerTitleElement)s\n'
+        '    </div>\n'
+        '%(navigation)s')
+
+    pageTailTemplate = (
+        '%(navigation)s'
+        '%(footer)s'
+        '  </body>\n'
+        '</html>\n')
+
+    searchTemplate = (
+        '    <div class="opds-search">\n'
+        '      <form action="/bookserver/catalog/search" class="opds-search-form" method="get">\n'
+        '        %(labelElement)s\n'
+        '        <br/>\n'
+        '        <input class="opds-search-terms" id="opds-search-terms" name="q" size="40" type="text"%(value)s/>\n'
+        '        <input class="opds-search-submit" name="submit" type="submit" value="Search"/>\n'
+        '%(extraButtons)s'
+        '      </form>\n'
+        '    </div>\n')
+
+    navigationAnchorTemplate = '      <a class="opds-navigation-anchor" href="%s" rel="%s" title="%s">%s</a>\n'
+    untitledNavigationAnchorTemplate = '      <a class="opds-navigation-anchor" href="%s" rel="%s"/>\n'
+
+    entryTemplate = (
+        '      <li class="opds-entry-list-item">\n'
+        '        <p class="opds-entry">\n'
+        '%(title)s'
+        '%(items)s'
+        '%(links)s'
+        '%(moreInfo)s'
+        '        </p>\n'
+        '      </li>\n')
+
+    entryTitleLinkTemplate = (
+        '          <a class="opds-entry-title" href="%s">\n'
+        '            %s\n'
+        '          </a>\n')
+
+    entryItemTemplate = '          <span class="opds-entry-item"><em class="opds-entry-key">%s</em> <span class="opds-entry-value">%s</span><br/></span>\n'
+
+    entryLinkGroupTemplate = '            <span class="opds-entry-item"><em class="opds-entry-key">%s</em> %s</span>\n'
+    entryLinkTemplate = '<a class="opds-entry-link" href="%s">%s</a>'
+
+    moreInfoTemplate = (
+        '          <span>\n'
+        '            <br/>\n'
+        '            <a href="http://www.archive.org/details/%s">More information about this book</a>\n'
+        '            <br/>\n'
+        '%s'
+        '          </span>\n')
+
+    readOnlineTemplate = (
+        '            <span>\n'
+        '              <a href="%s" title="Read online">Read online</a>\n'
+        '              <br/>\n'
+        '            </span>\n')
+
+    def __init__(self, catalog, device = None, query = None, provider = None, stream = False, entryCache = None):
+        CatalogRenderer.__init__(self)
+        self.catalog = catalog
+        self.device = device
+        self.query = query
+        self.provider = provider
+        self.stream = stream
+        self.entryCache = entryCache
+
+    # serialize()
+    #___________________________________________________________________________
+    # Serializes an element as a child of <body>, indented as in the page
+    def serialize(self, element):
+        root = ET.Element('html')
+        ET.SubElement(root, 'body').append(element)
+        s = self.prettyPrintET(root)
+
+        head = '<html>\n  <body>\n'
+        tail = '  </body>\n</html>\n'
+        assert s.startswith(head) and s.endswith(tail)
+        return s[len(head):-len(tail)]
+
+    # fragment()
+    #___________________________________________________________________________
+    # Returns a constant part of the page, built by ArchiveCatalogToHtml the
+    # first time it is needed
+    def fragment(self, name, createElement):
+        key = (self.__class__, name)
+        if key not in self.fragments:
+            self.fragments[key] = self.serialize(createElement())
+        return self.fragments[key]
+
+    # getDescription()
+    #___________________________________________________________________________
+    def getDescription(self, osUrl):
+        desc = self.descriptions.get(osUrl)
+        if desc is None:
+            desc = opensearch.Description(osUrl)
+            if desc.get_url_by_type('application/atom+xml') is not None:
+                self.descriptions[osUrl] = desc
+        return desc
+
+    # renderSearch()
+    #___________________________________________________________________________
+    def renderSearch(self, opensearchObj, query = None):
+        desc = self.getDescription(opensearchObj.osddUrl)
+        if desc.get_url_by_type('application/atom+xml') is None:
+            return self.serialize(self.createSearch(opensearchObj, query))
+
+        value = ''
+        if query:
+            value = ' value="%s"' % (self.escapeAttribute(query))
+
+        extraButtons = ''
+        if self.device and self.device.name == 'Kindle':
+            extraButtons += '        <input class="opds-search-submit" name="device" type="submit" value="Search for Kindle"/>\n'
+        if self.provider:
+            extraButtons += '        <input class="opds-search-submit" name="provider" type="submit" value="%s"/>\n' % (self.escapeAttribute('Search %s' % self.provider))
+
+        return self.searchTemplate % {
+            'labelElement' : self.textElement('<label for="opds-search-terms">', desc.shortname, '</label>'),
+            'value'        : value,
+            'extraButtons' : extraButtons,
+        }
+
+    # renderNavigation()
+    #___________________________________________________________________________
+    def renderNavigation(self, navigation):
+        anchors = []
+        if navigation:
+            if navigation.prevLink:
+                anchors.append(self.renderNavigationAnchor('prev', navigation.prevLink, navigation.prevTitle))
+            if navigation.nextLink:
+                anchors.append(self.renderNavigationAnchor('next', navigation.nextLink, navigation.nextTitle))
+
+        if not anchors:
+            return '    <div class="opds-navigation"/>\n'
+        return '    <div class="opds-navigation">\n' + ''.join(anchors) + '    </div>\n'
+
+    # renderNavigationAnchor()
+    #___________________________________________________________________________
+    def renderNavigationAnchor(self, rel, url, title = None):
+        url = self.navigationUrl(url)
+        if url.startswith(self.bookserverBase):
+            url = self.catalogBase + url[len(self.bookserverBase):]
+
+        if title is None:
+            return self.untitledNavigationAnchorTemplate % (self.escapeAttribute(url), rel)
+        return self.navigationAnchorTemplate % (self.escapeAttribute(url), rel,
+                                                self.escapeAttribute(title), self.escapeText(title))
+
+    # renderEntry()
+    #___________________________________________________________________________
+    def renderEntry(self, entry):
+        title = self.textElement('<h2 class="opds-entry-title">', entry.get('title'), '</h2>')
+
+        links = entry._links
+        catalogLink = self.findCatalogLink(links)
+        if catalogLink:
+            links = [link for link in links if link is not catalogLink]
+            title = self.entryTitleLinkTemplate % (self.escapeAttribute(catalogLink.get('url')), title)
+        else:
+            title = '          %s\n' % (title)
+
+        items = []
+        for key in self.entryDisplayKeys:
+            value = entry.get(key)
+            if value:
+                displayTitle, displayValue = self.formatEntryValue(key, value)
+                items.append(self.entryItemTemplate % (self.escapeText(displayTitle + ':'),
+                                                       self.escapeText(unicode(displayValue))))
+
+        renderedLinks = ''
+        if links:
+            renderedLinks = self.renderEntryLinks(links)
+
+        moreInfo = ''
+        identifier = entry.get('identifier')
+        if identifier:
+            readOnline = ''
+            if self.canReadOnline(entry):
+                readOnline = self.readOnlineTemplate % (self.escapeAttribute(self.readOnlineUrl(entry)))
+            moreInfo = self.moreInfoTemplate % (self.escapeAttribute(identifier), readOnline)
+
+        return self.entryTemplate % {
+            'title'    : title,
+            'items'    : ''.join(items),
+            'links'    : renderedLinks,
+            'moreInfo' : moreInfo,
+        }
+
+    # renderEntryLinks()
+    #___________________________________________________________________________
+    def renderEntryLinks(self, links):
+        groups = []
+        for (linkList, listTitle) in self.groupEntryLinks(links):
+            if len(linkList) > 0:
+                anchors = []
+                for link in linkList:
+                    (url, title) = self.formatEntryLink(link)
+                    anchors.append(self.entryLinkTemplate % (self.escapeAttribute(url), self.escapeText(title)))
+                groups.append(self.entryLinkGroupTemplate % (self.escapeText(listTitle), ', '.join(anchors)))
+
+        if not groups:
+            return '          <div class="opds-entry-links"/>\n'
+        return '          <div class="opds-entry-links">\n' + ''.join(groups) + '          </div>\n'
+
+    # __iter__()
+    #___________________________________________________________________________
+    def __iter__(self):
+        catalog = self.catalog
+        navigation = self.renderNavigation(catalog._navigation)
+
+        pageHead = self.pageHeadTemplate % {
+            'titleElement'       : self.textElement('<title>', catalog._title, '</title>'),
+            'viewPortWidth'      : self.viewPortWidth,
+            'header'             : self.fragment('header', lambda: self.createHeader(catalog)),
+            'search'             : self.renderSearch(catalog._opensearch, query = self.query),
+            'headerTitleElement' : self.textElement('<h1 class="opds-catalog-header-title">', catalog._title, '</h1>'),
+            'navigation'         : navigation,
+        }
+        pageTail = self.pageTailTemplate % {
+            'navigation' : navigation,
+            'footer'     : self.fragment('footer', lambda: self.createFooter(catalog)),
+        }
+
+        entries = iter(catalog._entries)
+        try:
+            first = entries.next()
+        except StopIteration:
+            yield pageHead + '    <ul class="opds-entry-list"/>\n' + pageTail
+            return
+
+        options = self.entryOptions()
+        yield pageHead + '    <ul class="opds-entry-list">\n'
+        for entry in itertools.chain([first], entries):
+            yield self.cachedEntry(entry, options, self.renderEntry)
+        yield '    </ul>\n' + pageTail
+
+    # toString()
+    #___________________________________________________________________________
+    def toString(self):
+        return ''.join(self)
+
+#_______________________________________________________________________________
         
 class CatalogToSolr(CatalogRenderer):
     '''
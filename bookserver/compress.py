@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+WSGI middleware that compresses responses with gzip or deflate.
+
+The body is compressed chunk by chunk as the application produces it, so
+streamed feeds stay streamed. Responses smaller than minSize are sent
+uncompressed. Compressed responses get their own ETag (the application's
+ETag with an encoding suffix). If a cache is given, compressed bodies are
+cached by a hash of the uncompressed body, so that a page is only
+compressed once. Only bodies of up to maxCacheSize bytes are cached.
+
+>>> def app(environ, start_response):
+...     start_response('200 OK', [('Content-Type', 'application/atom+xml'),
+...                               ('ETag', '"abc"')])
+...     return ['<feed>', 'x' * 2000, '</feed>']
+>>> def request(app, **environ):
+...     response = {}
+...     def start_response(status, headers, exc_info=None):
+...         response['status']  = status
+...         response['headers'] = dict(headers)
+...     response['body'] = ''.join(app(environ, start_response))
+...     return response
+>>> m = CompressMiddleware(app, minSize = 1024)
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip, deflate')
+>>> r['headers']['Content-Encoding'], r['headers']['ETag'], r['headers']['Vary']
+('gzip', '"abc-gzip"', 'Accept-Encoding')
+>>> len(r['body']) < 100
+True
+>>> gzip.GzipFile(fileobj=cStringIO.StringIO(r['body'])).read() == '<feed>' + 'x'*2000 + '</feed>'
+True
+
+Compressed bodies are cached by the hash of the uncompressed body:
+
+>>> class Cache(dict):
+...     def set(self, key, value, ttl):
+...         self[key] = value
+>>> m = CompressMiddleware(app, minSize = 1024, cache = Cache())
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip')
+>>> key = 'gzip ' + hashlib.md5('<feed>' + 'x'*2000 + '</feed>').hexdigest()
+>>> m.cache.get(key) == ('gzip', r['body'])
+True
+
+so a body that changes under the same ETag is not served from the cache:
+
+>>> def changed(environ, start_response):
+...     start_response('200 OK', [('Content-Type', 'application/atom+xml'),
+...                               ('ETag', '"abc"')])
+...     return ['<feed>', 'y' * 2000, '</feed>']
+>>> m.app = changed
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip')
+>>> gzip.GzipFile(fileobj=cStringIO.StringIO(r['body'])).read() == '<feed>' + 'y'*2000 + '</feed>'
+True
+>>> m.app = app
+
+Bodies larger than maxCacheSize are streamed without being cached:
+
+>>> m = CompressMiddleware(app, minSize = 1024, cache = Cache(), maxCacheSize = 1024)
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip')
+>>> len(m.cache)
+0
+
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'deflate')
+>>> r['headers']['Content-Encoding'], r['headers']['ETag']
+('deflate', '"abc-deflate"')
+>>> len(zlib.decompress(r['body']))
+2013
+
+Clients that don't accept compression get the response as it is:
+
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip;q=0, identity')
+>>> 'Content-Encoding' in r['headers'], r['headers']['ETag'], r['headers']['Vary']
+(False, '"abc"', 'Accept-Encoding')
+>>> len(r['body'])
+2013
+
+and so do small responses:
+
+>>> m = CompressMiddleware(app, minSize = 4096)
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip')
+>>> 'Content-Encoding' in r['headers']
+False
+
+The encoding suffix is removed from If-None-Match before it is passed to
+the application:
+
+>>> def notModified(environ, start_response):
+...     if '"abc"' == environ.get('HTTP_IF_NONE_MATCH'):
+...         start_response('304 Not Modified', [('ETag', '"abc"')])
+...         return ['']
+...     return app(environ, start_response)
+>>> m = CompressMiddleware(notModified)
+>>> r = request(m, HTTP_ACCEPT_ENCODING = 'gzip', HTTP_IF_NONE_MATCH = '"abc-gzip"')
+>>> r['status'], r['headers']['ETag']
+('304 Not Modified', '"abc-gzip"')
+
+>>> environ = {'HTTP_IF_NONE_MATCH': '"abc-gzip", W/"def-gzip"'}
+>>> CompressMiddleware.stripETagSuffix(environ, 'gzip')
+>>> environ['HTTP_IF_NONE_MATCH']
+'"abc", W/"def"'
+
+>>> CompressMiddleware.chooseEncoding('deflate;q=0.5, gzip;q=0.8')
+'gzip'
+>>> CompressMiddleware.chooseEncoding('deflate, gzip;q=0.5')
+'deflate'
+>>> print CompressMiddleware.chooseEncoding('identity')
+None
+"""
+
+import cStringIO
+import gzip
+import hashlib
+import re
+import zlib
+
+# ClosingIterator
+#_______________________________________________________________________________
+# Iterates over chunks and calls the application's close() when the server
+# closes the response, as WSGI requires.
+class ClosingIterator:
+    def __init__(self, chunks, result):
+        self.chunks = chunks
+        self.result = result
+
+    def __iter__(self):
+        return iter(self.chunks)
+
+    def close(self):
+        if hasattr(self.result, 'close'):
+            self.result.close()
+
+
+# CompressMiddleware
+#_______________________________________________________________________________
+class CompressMiddleware:
+
+    compressibleTypes = re.compile(r'^(text/|application/([\w.-]+\+)?(xml|json|javascript))')
+
+    # CompressMiddleware()
+    #___________________________________________________________________________
+    # cache can be a bookserver.cache.MemoryCache or DiskCache. Compressed
+    # bodies are kept for the response's Cache-Control max-age, or for
+    # cacheTTL seconds if it has none. Up to maxCacheSize bytes of a body
+    # are buffered to hash it for the cache; larger bodies are not cached.
+    def __init__(self, app, minSize = 1024, level = 6, cache = None, cacheTTL = 3600,
+                 maxCacheSize = 256*1024):
+        self.app          = app
+        self.minSize      = minSize
+        self.level        = level
+        self.cache        = cache
+        self.cacheTTL     = cacheTTL
+        self.maxCacheSize = maxCacheSize
+
+    # chooseEncoding()
+    #___________________________________________________________________________
+    # Returns 'gzip', 'deflate', or None from an Accept-Encoding header.
+    # gzip wins ties.
+    @classmethod
+    def chooseEncoding(cls, acceptEncoding):
+        if not acceptEncoding:
+            return None
+
+        qualities = {}
+        for coding in acceptEncoding.split(','):
+            params = coding.strip().split(';')
+            name = params[0].strip().lower()
+            q = 1.0
+            for param in params[1:]:
+                param = param.strip()
+                if param.startswith('q='):
+                    try:
+                        q = float(param[2:])
+                    except ValueError:
+                        q = 0.0
+            qualities[name] = q
+
+        best = None
+        for encoding in ('gzip', 'deflate'):
+            q = qualities.get(encoding, qualities.get('*', 0.0))
+            if q > 0 and (best is None or q > qualities.get(best, qualities.get('*', 0.0))):
+                best = encoding
+        return best
+
+    # stripETagSuffix()
+    #___________________________________________________________________________
+    # Our compressed responses have ETags ending in -gzip or -deflate; the
+    # application only knows its own ETags.
+    @classmethod
+    def stripETagSuffix(cls, environ, encoding):
+        ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH')
+        if ifNoneMatch:
+            environ['HTTP_IF_NONE_MATCH'] = ifNoneMatch.replace('-%s"' % (encoding), '"')
+
+    # getHeader()
+    #___________________________________________________________________________
+    @classmethod
+    def getHeader(cls, headers, name):
+        name = name.lower()
+        for (key, value) in headers:
+            if key.lower() == name:
+                return value
+        return None
+
+    # setHeader()
+    #___________________________________________________________________________
+    @classmethod
+    def setHeader(cls, headers, name, value):
+        headers[:] = [(key, val) for (key, val) in headers if key.lower() != name.lower()]
+        if value is not None:
+            headers.append((name, value))
+
+    # addVary()
+    #___________________________________________________________________________
+    @classmethod
+    def addVary(cls, headers):
+        vary = cls.getHeader(headers, 'Vary')
+        if vary is None:
+            cls.setHeader(headers, 'Vary', 'Accept-Encoding')
+        elif 'accept-encoding' not in vary.lower():
+            cls.setHeader(headers, 'Vary', vary + ', Accept-Encoding')
+
+    # getMaxAge()
+    #___________________________________________________________________________
+    def getMaxAge(self, headers):
+        cacheControl = self.getHeader(headers, 'Cache-Control') or ''
+        m = re.search(r'max-age=(\d+)', cacheControl)
+        if m:
+            return int(m.group(1))
+        return self.cacheTTL
+
+    # isCompressible()
+    #___________________________________________________________________________
+    def isCompressible(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        if self.getHeader(headers, 'Content-Encoding') is not None:
+            return False
+
+        contentType = self.getHeader(headers, 'Content-Type') or ''
+        return self.compressibleTypes.match(contentType) is not None
+
+    # compressor()
+    #___________________________________________________________________________
+    def compressor(self, encoding):
+        if 'gzip' == encoding:
+            #wbits > 15 makes zlib write a gzip header and trailer
+            return zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        else:
+            return zlib.compressobj(self.level, zlib.DEFLATED, zlib.MAX_WBITS)
+
+    # compress()
+    #___________________________________________________________________________
+    def compress(self, encoding, chunks, cacheKey, ttl):
+        compressor = self.compressor(encoding)
+        if cacheKey is not None:
+            body = []
+
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                if cacheKey is not None:
+                    body.append(data)
+                yield data
+
+        data = compressor.flush()
+        if cacheKey is not None:
+            body.append(data)
+            self.cache.set(cacheKey, (encoding, ''.join(body)), ttl)
+        yield data
+
+    # __call__()
+    #___________________________________________________________________________
+    def __call__(self, environ, start_response):
+        encoding = self.chooseEncoding(environ.get('HTTP_ACCEPT_ENCODING'))
+        suffixed = False
+        if encoding is not None:
+            suffixed = ('-%s"' % (encoding)) in environ.get('HTTP_IF_NONE_MATCH', '')
+            self.stripETagSuffix(environ, encoding)
+
+        response = {}
+        pending  = []
+        def captureStartResponse(status, headers, exc_info=None):
+            response['status']   = status
+            response['headers']  = list(headers)
+            response['exc_info'] = exc_info
+            return pending.append
+
+        result = self.app(environ, captureStartResponse)
+        chunks = iter(result)
+
+        #WSGI applications may call start_response() on their first chunk
+        done = False
+        while 'status' not in response:
+            try:
+                pending.append(chunks.next())
+            except StopIteration:
+                done = True
+                break
+
+        status   = response['status']
+        headers  = response['headers']
+        exc_info = response['exc_info']
+
+        compressible = self.isCompressible(status, headers)
+        if compressible:
+            self.addVary(headers)
+
+            #buffer up to minSize bytes to find out if the response is tiny
+            size = sum([len(chunk) for chunk in pending])
+            while not done and size < self.minSize:
+                try:
+                    chunk = chunks.next()
+                except StopIteration:
+                    done = True
+                    break
+                pending.append(chunk)
+                size += len(chunk)
+
+            if done and size < self.minSize:
+                compressible = False
+
+        if suffixed and status.startswith('304'):
+            #the client's copy is the compressed variant
+            etag = self.getHeader(headers, 'ETag')
+            if etag is not None:
+                self.setHeader(headers, 'ETag', etag[:-1] + '-' + encoding + '"')
+            self.addVary(headers)
+
+        if encoding is None or not compressible:
+            start_response(status, headers, exc_info)
+            return ClosingIterator(self.chain(pending, chunks, done), result)
+
+        etag = self.getHeader(headers, 'ETag')
+        if etag is not None:
+            self.setHeader(headers, 'ETag', etag[:-1] + '-' + encoding + '"')
+        self.setHeader(headers, 'Content-Length', None)
+        self.setHeader(headers, 'Content-Encoding', encoding)
+        start_response(status, headers, exc_info)
+
+        #the ETag may stay the same when the bytes of the body change (catalog
+        #ETags only cover the entries), so the cache is keyed on the body
+        cacheKey = None
+        ttl      = self.getMaxAge(headers)
+        if self.cache is not None and ttl > 0:
+            size = sum([len(chunk) for chunk in pending])
+            while not done and size <= self.maxCacheSize:
+                try:
+                    chunk = chunks.next()
+                except StopIteration:
+                    done = True
+                    break
+                pending.append(chunk)
+                size += len(chunk)
+
+            if done and size <= self.maxCacheSize:
+                body     = ''.join(pending)
+                pending  = [body]
+                cacheKey = '%s %s' % (encoding, hashlib.md5(body).hexdigest())
+                cached = self.cache.get(cacheKey)
+                if cached is not None:
+                    return ClosingIterator([cached[1]], result)
+
+        return ClosingIterator(self.compress(encoding, self.chain(pending, chunks, done), cacheKey, ttl), result)
+
+    # chain()
+    #___________________________________________________________________________
+    def chain(self, pending, chunks, done):
+        for chunk in pending:
+            yield chunk
+        if not done:
+            for chunk in chunks:
+                yield chunk
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Validators for conditional GET requests.
+
+A catalog's validator is computed from the catalog itself, before it is
+rendered, so a client that already has the page can be answered with a
+304 without rendering anything. The ETag covers the catalog title (which
+includes numFound for solr results), its date, and the urn, updated date
+and download count of each entry. Lazy catalogs provide the summary
+without building their entries.
+
+The ETag is the only validator. Download counts, the order of the
+entries, and numFound all change without changing any date in the
+catalog, so a Last-Modified date made from the catalog would answer 304
+for pages that have changed.
+
+>>> class Catalog:
+...     _title   = 'Internet Archive Catalog - 1 to 50 of 2345 books'
+...     _datestr = '2009-12-01T00:00:00Z'
+...     downloads = 10
+...     def getEntrySummary(self):
+...         return [('urn:x-internet-archive:item:itemid', '2009-12-02T10:00:00Z', self.downloads)]
+>>> c = Catalog()
+>>> etag = catalogValidator(c, 'xml http://solr/select?q=a')
+
+New download counts make a new ETag, and If-Modified-Since alone never
+gets a 304:
+
+>>> c.downloads = 11
+>>> newETag = catalogValidator(c, 'xml http://solr/select?q=a')
+>>> etag == newETag
+False
+>>> isNotModified({'HTTP_IF_NONE_MATCH': etag}, newETag)
+False
+>>> isNotModified({'HTTP_IF_MODIFIED_SINCE': 'Wed, 02 Dec 2009 10:00:00 GMT'}, newETag)
+False
+>>> c.downloads = 10
+
+The same catalog rendered in another mode has a different ETag:
+
+>>> etag == catalogValidator(c, 'html http://solr/select?q=a')
+False
+
+>>> isNotModified({'HTTP_IF_NONE_MATCH': etag}, etag)
+True
+>>> isNotModified({'HTTP_IF_NONE_MATCH': '"abc", W/' + etag}, etag)
+True
+>>> isNotModified({'HTTP_IF_NONE_MATCH': '"abc"'}, etag)
+False
+"""
+
+import hashlib
+
+# makeETag()
+#_______________________________________________________________________________
+def makeETag(data):
+    return '"%s"' % (hashlib.md5(data).hexdigest())
+
+# catalogValidator()
+#_______________________________________________________________________________
+# Returns the ETag for a catalog. key identifies the page and its
+# rendering, e.g. a ResponseCache key.
+def catalogValidator(c, key):
+    parts = [key, c._title, c._datestr]
+    for (urn, updated, downloads) in c.getEntrySummary():
+        parts.append('%s %s %s' % (urn, updated, downloads))
+
+    data = '\n'.join(parts)
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    return makeETag(data)
+
+# isNotModified()
+#_______________________________________________________________________________
+# Returns True if the client's cached copy of the page is still current.
+def isNotModified(environ, etag):
+    ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH')
+    if ifNoneMatch is None:
+        return False
+
+    tags = [tag.strip() for tag in ifNoneMatch.split(',')]
+    return ('*' in tags) or (etag in tags) or ('W/' + etag in tags)
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
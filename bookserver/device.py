@@ -23,45 +23,171 @@ This file is part of bookserver.
 """
 
 import re
+import threading
 
 import catalog
 
 class Device:
     name = "Generic device"
 
+    # Pages are cached per variant. Devices that get the same pages as a
+    # desktop browser have no variant of their own; a device that changes
+    # formatLink() or the page layout needs one.
+    variant = None
 
     def formatLink(self, link):
         """
-        Formats a Link appropriately for device.
+        Formats a Link appropriately for device. Returns the link itself
+        or a changed copy; the link passed in is never modified.
         """
         return link
                 
 class iPhone(Device):
     name = "iPhone and iPod Touch"
+    variant = 'iPhone'
 
     def formatLink(self, link):
         """
-        Does not copy object.
+        Copies links that have to be changed.
         >>> l = catalog.Link(url = 'http://www.archive.org/download/item.epub', type = 'application/epub+zip')
         >>> i = iPhone()
-        >>> l = i.formatLink(l)
-        >>> print l.get('url')
+        >>> formatted = i.formatLink(l)
+        >>> print formatted.get('url')
         epub://www.archive.org/download/item.epub
+        >>> print l.get('url')
+        http://www.archive.org/download/item.epub
+        >>> pdf = catalog.Link(url = 'http://www.archive.org/download/item.pdf', type = 'application/pdf')
+        >>> i.formatLink(pdf) is pdf
+        True
         """
         if 'application/epub+zip' == link.get('type'):
             newUrl = re.sub('^http', 'epub', link.get('url'))
-            link.set('url', newUrl)
+            return link.copy(url = newUrl)
         return link
         
 class Kindle(Device):
     name = 'Kindle'
+    variant = 'Kindle'
+
+class Kobo(Device):
+    name = 'Kobo'
+
+class Nook(Device):
+    name = 'Nook'
+
+class Android(Device):
+    name = 'Android'
     
 
 class Detect:
-    detectPatterns = {
-        iPhone: [ 'Apple.*Mobile.*Safari' ],
-        Kindle: [ 'Kindle/' ],
-    }
+    """
+    Detects the reading device from a User-Agent string.
+
+    Devices are tried in the order they were registered, and the first one
+    with a matching pattern wins. Android based readers are registered
+    before Android, and Android before iPhone, since their user agents
+    also match the iPhone pattern.
+
+    The patterns are compiled once, and the device found for each user
+    agent is remembered, since most requests come from a few user agents.
+
+    >>> d = Detect.createFromUserAgent('Mozilla/5.0 (Linux; U; Android 2.2; en-us; Nexus One Build/FRF91) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1')
+    >>> print d.name
+    Android
+    >>> d = Detect.createFromUserAgent('Mozilla/5.0 (Linux; U; Android 2.0; en-us;) AppleWebKit/533.1 (KHTML, like Gecko) Version/4.0 Mobile Safari/533.1 (Kobo Touch)')
+    >>> print d.name, d.variant
+    Kobo None
+
+    More devices can be added with register():
+
+    >>> class Sony(Device):
+    ...     name = 'Sony Reader'
+    >>> Detect.register(Sony, ['Sony/COM2', 'PRS-T1'], before = Android)
+    >>> print Detect.createFromUserAgent('Mozilla/5.0 (Linux; U; en-us; PRS-T1 Build/1.0) AppleWebKit/533.1 Mobile Safari/533.1').name
+    Sony Reader
+    >>> Detect.unregister(Sony)
+    """
+
+    # [(device class, patterns)], in order of precedence
+    devices = []
+
+    # device class (or None) by user agent. Cleared when it holds maxCached
+    # user agents; the few common ones are back after a few requests.
+    maxCached = 4096
+    _cache    = {}
+
+    # compile() result, rebuilt when the devices change
+    _compiled = None
+    _lock     = threading.Lock()
+
+    # register()
+    #___________________________________________________________________________
+    # Adds a device class, detected by any of patterns (regular expressions
+    # searched for in the user agent). If before is given, the device takes
+    # precedence over that registered device class.
+    @classmethod
+    def register(cls, device, patterns, before = None):
+        cls._lock.acquire()
+        try:
+            i = len(cls.devices)
+            if before is not None:
+                i = [d for (d, p) in cls.devices].index(before)
+            cls.devices.insert(i, (device, list(patterns)))
+            cls._compiled = None
+            cls._cache.clear()
+        finally:
+            cls._lock.release()
+
+    # unregister()
+    #___________________________________________________________________________
+    @classmethod
+    def unregister(cls, device):
+        cls._lock.acquire()
+        try:
+            cls.devices = [(d, p) for (d, p) in cls.devices if d is not device]
+            cls._compiled = None
+            cls._cache.clear()
+        finally:
+            cls._lock.release()
+
+    # compile()
+    #___________________________________________________________________________
+    # Returns [(device class, regular expression)], in order of precedence.
+    # Each device's patterns are searched separately from the others':
+    # the re module finds a pattern that starts with a literal, like
+    # 'Kindle/', much faster on its own than in an alternation.
+    @classmethod
+    def compile(cls):
+        return [(device, re.compile('|'.join(['(?:%s)' % (p) for p in patterns])))
+                for (device, patterns) in cls.devices]
+
+    # findDevice()
+    #___________________________________________________________________________
+    # Returns the device class for a user agent, or None
+    @classmethod
+    def findDevice(cls, userAgent):
+        device = cls._cache.get(userAgent, cls)
+        if device is not cls:
+            return device
+
+        cls._lock.acquire()
+        try:
+            if cls._compiled is None:
+                cls._compiled = cls.compile()
+
+            device = None
+            for (deviceClass, regex) in cls._compiled:
+                if regex.search(userAgent):
+                    device = deviceClass
+                    break
+
+            if len(cls._cache) >= cls.maxCached:
+                cls._cache.clear()
+            cls._cache[userAgent] = device
+        finally:
+            cls._lock.release()
+
+        return device
 
     @classmethod
     def createFromUserAgent(cls, userAgent):
@@ -77,13 +203,17 @@ class Detect:
         >>> print d.name
         Kindle
         """
-        # $$$ list comprehension or reduce might be more efficient
-        for device, patterns in cls.detectPatterns.items():
-            for pattern in patterns:
-                if re.search(pattern, userAgent):
-                    return device() # return new instance
-                    
-        return None
+        device = cls.findDevice(userAgent)
+        if device is None:
+            return None
+        return device() # return new instance
+
+
+Detect.register(Kindle,  [ 'Kindle/' ])
+Detect.register(Kobo,    [ 'Kobo' ])
+Detect.register(Nook,    [ 'NOOK', 'Nook', 'BNRV\\d', 'BNTV\\d' ])
+Detect.register(Android, [ 'Android' ])
+Detect.register(iPhone,  [ 'Apple.*Mobile.*Safari' ])
 
                 
 if __name__ == "__main__":
@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Static snapshots of navigation feeds.
+
+The navigation feeds (index, alpha list, provider list) only change when
+their updated date changes, so they can be rendered ahead of time, e.g.
+from cron, and served as static files. Each page is written next to
+precompressed .gz (and .br, if the brotli module is installed) copies,
+which a front web server can send directly (nginx gzip_static).
+
+>>> import shutil, tempfile
+>>> d = tempfile.mkdtemp()
+>>> s = Snapshot(d, encodings = ('gzip',))
+>>> s.write('alpha.xml', '<feed/>')
+>>> sorted(os.listdir(d))
+['alpha.xml', 'alpha.xml.gz']
+>>> s.read('alpha.xml')
+'<feed/>'
+>>> gzip.GzipFile(s.getPath('alpha.xml') + '.gz').read()
+'<feed/>'
+
+Snapshots older than notBefore are ignored, so that a stale snapshot is
+never served if the cron job stops running:
+
+>>> print s.read('alpha.xml', notBefore = time.time() + 60)
+None
+>>> print s.read('index.html')
+None
+
+Page names can't escape the snapshot directory:
+
+>>> s.write('../index.html', '<html/>')
+Traceback (most recent call last):
+    ...
+ValueError: invalid snapshot page name: ../index.html
+
+>>> shutil.rmtree(d)
+"""
+
+import cStringIO
+import gzip
+import os
+import tempfile
+import time
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+class Snapshot:
+
+    # Snapshot()
+    #___________________________________________________________________________
+    def __init__(self, directory, encodings = ('gzip', 'br')):
+        self.directory = directory
+        self.encodings = encodings
+
+        if not os.path.exists(directory):
+            os.makedirs(directory, 0755)
+
+    # getPath()
+    #___________________________________________________________________________
+    def getPath(self, name):
+        if os.path.isabs(name) or '..' in name.split('/'):
+            raise ValueError('invalid snapshot page name: ' + name)
+        return os.path.join(self.directory, name)
+
+    # writeFile()
+    #___________________________________________________________________________
+    # write to a temp file and rename, so readers never see a partial file
+    def writeFile(self, path, data):
+        (fd, tempPath) = tempfile.mkstemp(dir=os.path.dirname(path))
+        f = os.fdopen(fd, 'wb')
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.chmod(tempPath, 0644)
+        os.rename(tempPath, path)
+
+    # gzipData()
+    #___________________________________________________________________________
+    def gzipData(self, data):
+        buf = cStringIO.StringIO()
+        f = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=9, mtime=0)
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        return buf.getvalue()
+
+    # write()
+    #___________________________________________________________________________
+    def write(self, name, body):
+        path = self.getPath(name)
+        if not os.path.exists(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path), 0755)
+
+        #write the compressed copies first, so they are never older than path
+        if 'gzip' in self.encodings:
+            self.writeFile(path + '.gz', self.gzipData(body))
+
+        if 'br' in self.encodings and brotli is not None:
+            self.writeFile(path + '.br', brotli.compress(body))
+
+        self.writeFile(path, body)
+
+    # read()
+    #___________________________________________________________________________
+    # Returns the page body, or None if the page is missing or was written
+    # before notBefore (a unix timestamp).
+    def read(self, name, notBefore = None):
+        path = self.getPath(name)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+
+        try:
+            if notBefore is not None and os.fstat(f.fileno()).st_mtime < notBefore:
+                return None
+            return f.read()
+        finally:
+            f.close()
+
+
+if __name__ == '__main__':
+    import doctest
+    doctest.testmod()
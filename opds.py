@@ -11,13 +11,19 @@ sys.path.append("/petabox/sw/lib/python")
 
 import web
 import time
+import calendar
 import string
 import cgi
 import urllib
+import re
 
 import bookserver.catalog as catalog
 import bookserver.catalog.output as output
 import bookserver.device
+import bookserver.cache
+import bookserver.conditional
+import bookserver.snapshot
+import bookserver.compress
 
 numRows = 50
 
@@ -29,10 +35,126 @@ pubInfo = {
     'mimetype'   : 'application/atom+xml;profile=opds',
     'url_base'   : '/catalog',
     'urnroot'    : 'urn:x-internet-archive:bookserver:catalog',
-    'solr_base'  : 'http://se.us.archive.org:8983/solr/select?fl=identifier,title,creator,publicdate,date,contributor,publisher,subject,language,format,month&wt=json',
-    'query_base' : 'format%3Aabbyy+AND+format%3Ascandata+AND+format%3Apdf+AND+NOT+ocr%3A%22language+not%22+AND+NOT+collection%3Alendinglibrary+AND+NOT+collection%3Aopensource+AND+NOT+collection%3Aprintdisabled+AND+NOT+collection%3Arosettaproject'
+    'solr_base'  : 'http://se.us.archive.org:8983/solr/select',
+    # Restrictions applied to every query. Each clause is sent as its own
+    # solr filter query (fq), which solr caches separately from the search,
+    # so they are evaluated once rather than for every request.
+    'filter_queries' : ['format:abbyy AND format:scandata AND format:pdf',
+                        '-ocr:"language not"',
+                        '-collection:(lendinglibrary OR opensource OR printdisabled OR rosettaproject)'],
 }
 
+types = {
+    'xml'  : pubInfo['mimetype'],
+    'html' : 'text/html',
+}
+
+# /new and /crawlable use keyset pagination: pages are sorted by
+# cursorFields, and next links carry a cursor made from the last book on
+# the page instead of an offset, so deep pages cost solr the same as the
+# first one. Numbered pages are still served for existing links.
+cursorFields = ('publicdate', 'identifier')
+cursorSort   = 'publicdate desc,identifier desc'
+
+# Solr fields used by the renderer for each output mode. The atom feed
+# doesn't show formats, and the html page doesn't show subjects.
+solrFields = {
+    'xml'  : ('identifier', 'title', 'creator', 'publicdate', 'date', 'contributor',
+              'publisher', 'subject', 'language', 'month'),
+    'html' : ('identifier', 'title', 'creator', 'publicdate', 'date', 'contributor',
+              'publisher', 'language', 'format', 'month'),
+}
+
+# compileQueries()
+#______________________________________________________________________________
+# Builds the solr query for each route and output mode. Called once at
+# startup; call it again after changing pubInfo.
+# An old-style pubInfo['query_base'] (a url-encoded query) is still
+# accepted, and is split into filter queries at its top-level ANDs.
+def compileQueries():
+    if 'filter_queries' in pubInfo:
+        filterQueries = tuple(pubInfo['filter_queries'])
+    else:
+        queryBase = urllib.unquote_plus(pubInfo['query_base'])
+        filterQueries = tuple(catalog.ingest.SolrQuery.splitClauses(queryBase))
+
+    def compileQuery(**kwargs):
+        return dict((mode, catalog.ingest.SolrQuery(pubInfo['solr_base'], fields=fields,
+                                                    filterQueries=filterQueries, **kwargs))
+                    for (mode, fields) in solrFields.iteritems())
+
+    return {
+        'alpha'       : compileQuery(sort='titleSorter asc', rows=numRows),
+        'downloads'   : compileQuery(sort='month desc', rows=numRows),
+        'newest'      : compileQuery(sort=cursorSort),
+        'crawlable'   : compileQuery(sort=cursorSort),
+        'opensearch'  : compileQuery(sort='month desc', rows=numRows),
+        'htmlsearch'  : compileQuery(rows=numRows),
+        #only the date of the newest book for each letter is used
+        'alphaLatest' : {'xml' : catalog.ingest.SolrQuery(pubInfo['solr_base'], filterQueries=filterQueries,
+                                                          sort='publicdate desc', rows=1,
+                                                          fields=('identifier', 'publicdate'))},
+    }
+
+queries = compileQueries()
+
+# One keep-alive connection pool to solr, shared by all request threads
+solrTransport = catalog.ingest.SolrTransport(maxConnections = 8,
+                                             connectTimeout = 2.0,
+                                             readTimeout    = 10.0,
+                                             retries        = 2)
+
+# Rendered pages are cached per route, for this many seconds.
+# Routes not listed here are never cached. Clients and proxies are
+# allowed to cache pages for the same time (Cache-Control: max-age).
+cacheTTL = {
+    'index'      : 3600,
+    'alphaList'  : 3600,
+    'alpha'      : 3600,
+    'downloads'  : 3600,
+    'newest'     : 600,
+    'crawlable'  : 3600,
+    'opensearch' : 300,
+    'htmlsearch' : 300,
+}
+
+# Use bookserver.cache.DiskCache('/var/cache/bookserver') instead to share
+# the cache between all frontend processes on this host.
+responseCache = bookserver.cache.ResponseCache(bookserver.cache.MemoryCache(maxBytes = 64*1024*1024),
+                                               cacheTTL)
+
+# Rendered entries are also cached, per output mode, since the same book
+# appears on /downloads, /new, /alpha and in search results. Entries are
+# keyed by urn and updated date, so the download counts in a cached entry
+# can be up to ttl seconds old.
+entryCaches = {
+    'xml'  : bookserver.cache.FragmentCache(maxBytes = 16*1024*1024, ttl = 3600),
+    'html' : bookserver.cache.FragmentCache(maxBytes = 16*1024*1024, ttl = 3600),
+}
+
+# Cache statistics are served on /stats to these addresses only
+statsClients = ('127.0.0.1',)
+
+# HTML renderer for each route. TemplateArchiveCatalogToHtml renders the
+# same pages as ArchiveCatalogToHtml, from string templates instead of an
+# lxml tree; it is used for the long lists of books. Routes not listed
+# here use ArchiveCatalogToHtml.
+htmlRenderers = {
+    'alpha'      : output.TemplateArchiveCatalogToHtml,
+    'downloads'  : output.TemplateArchiveCatalogToHtml,
+    'newest'     : output.TemplateArchiveCatalogToHtml,
+    'crawlable'  : output.TemplateArchiveCatalogToHtml,
+    'htmlsearch' : output.TemplateArchiveCatalogToHtml,
+}
+
+# The navigation feeds can be rendered ahead of time to static files by
+# running `opds.py --snapshot DIR` from cron. Set snapshot to
+# bookserver.snapshot.Snapshot(DIR) to serve them from there, or point the
+# front web server at DIR. Snapshots older than snapshotMaxAge seconds, or
+# written before the last midnight, are ignored.
+snapshot       = None
+snapshotMaxAge = 2*3600
+
 urls = (
     '/(.*)/',                       'redirect',
     '/alpha.(xml|html)',            'alphaList',
@@ -43,11 +165,20 @@ urls = (
     '/opensearch(.*)',              'opensearch',
     '/search(.*)',                  'htmlsearch',
     '/crawlable(?:/(.*))?(|.html)', 'crawlable',
+    '/stats',                       'stats',
     '/(|index.html)',               'index',
     '/(.*)',                        'indexRedirect',
     )
 
-application = web.application(urls, globals()).wsgifunc()
+# Responses over minSize bytes are gzipped for clients that accept it.
+# Compressed pages are cached by a hash of the page, so each page is
+# compressed once.
+compressedCache = bookserver.cache.MemoryCache(maxBytes = 16*1024*1024)
+
+def compressMiddleware(app):
+    return bookserver.compress.CompressMiddleware(app, minSize = 1024, cache = compressedCache)
+
+application = web.application(urls, globals()).wsgifunc(compressMiddleware)
 
 
 
@@ -68,24 +199,202 @@ def getEnv(key, default = None):
     else:
         return default
 
+# getDevice()
+#______________________________________________________________________________
+# Returns the device for the request's User-Agent, or None if it gets the
+# same pages as a desktop browser. Pages rendered for None can be served to
+# any client, from the caches and the snapshot.
 def getDevice():
     userAgent = getEnv('HTTP_USER_AGENT')
     if userAgent is not None:
         device = bookserver.device.Detect.createFromUserAgent(userAgent)
+        if device is not None and device.variant is not None:
+            return device
+    return None
+
+# parsePage()
+#______________________________________________________________________________
+# Parses the page part of /new and /crawlable urls, which is either a page
+# number or c/<cursor>. Returns (start, cursor, isHtml), where one of start
+# and cursor is None.
+def parsePage(page):
+    isHtml = False
+    if page and page.endswith('.html'):
+        isHtml = True
+        page   = page[:-5]
+
+    if not page:
+        return (0, None, isHtml)
+    elif page.startswith('c/'):
+        return (None, page[2:], isHtml)
     else:
-        device = None
-    return device
+        return (int(page), None, isHtml)
+
+# cursorQuery()
+#______________________________________________________________________________
+# Returns the solr query clause that selects the books after a cursor, in
+# cursorSort order. Raises ValueError for a malformed cursor.
+validDate       = re.compile(r'^\d{4}-\d\d-\d\dT\d\d:\d\d:\d\dZ$')
+validIdentifier = re.compile(r'^[\w.-]+$')
+
+def cursorQuery(cursor):
+    (publicdate, identifier) = catalog.Navigation.decodeCursor(cursor)
+    if not validDate.match(publicdate) or not validIdentifier.match(identifier):
+        raise ValueError('invalid cursor: %s' % (cursor))
+
+    return '(publicdate:{* TO "%s"} OR (publicdate:"%s" AND identifier:{* TO "%s"}))' % (publicdate, publicdate, identifier)
+
+# pageUrl()
+#______________________________________________________________________________
+# Returns the solr url for one page of a keyset-paginated route
+def pageUrl(query, start, cursor, rows):
+    if cursor is None:
+        return query.getUrl(start=start*rows, rows=rows)
+
+    try:
+        after = cursorQuery(cursor)
+    except ValueError:
+        raise web.notfound()
+    return query.getUrl(after, rows=rows)
+
+# snapshotPage()
+#______________________________________________________________________________
+# Returns the body of a page from the static snapshot, or None if there is
+# no snapshot of it that is still current.
+def snapshotPage(name, datestr):
+    if snapshot is None:
+        return None
+
+    midnight  = calendar.timegm(time.strptime(datestr, '%Y-%m-%dT%H:%M:%SZ'))
+    notBefore = max(midnight, time.time() - snapshotMaxAge)
+    return snapshot.read(name, notBefore)
+
+# renderCatalog()
+#______________________________________________________________________________
+# Returns a (contentType, body) tuple. If stream is set, the body is an
+# iterable of chunks instead of a string, and entries are rendered one at a
+# time, so lazy catalogs are never built in full. route selects the html
+# renderer from htmlRenderers.
+def renderCatalog(c, mode, device = None, fabricateContentElement = False, stream = False, route = None):
+    if 'html' == mode:
+        renderer = htmlRenderers.get(route, output.ArchiveCatalogToHtml)
+        r = renderer(c, device = device, stream = stream, entryCache = entryCaches['html'])
+        if stream:
+            return ('text/html', iter(r))
+        return ('text/html', r.toString())
+    else:
+        r = output.TemplateCatalogToAtom(c, fabricateContentElement = fabricateContentElement,
+                                         entryCache = entryCaches['xml'])
+        if stream:
+            return (pubInfo['mimetype'], iter(r))
+        return (pubInfo['mimetype'], r.toString())
+
+# sendValidators()
+#______________________________________________________________________________
+# Sends the ETag and Cache-Control headers for a page. Returns True, after
+# setting a 304 status, if the client's copy is current.
+def sendValidators(route, etag, mode):
+    web.header('ETag', etag)
+    web.header('Cache-Control', 'public, max-age=%d' % (responseCache.getTTL(route)))
+    if 'html' == mode:
+        #html output depends on the device detected from the User-Agent
+        web.header('Vary', 'User-Agent')
+
+    if bookserver.conditional.isNotModified(web.ctx.env, etag):
+        web.ctx.status = '304 Not Modified'
+        return True
+    return False
+
+# cacheWhileStreaming()
+#______________________________________________________________________________
+# Passes the chunks of a streamed body through to the client, and caches
+# the whole body once the last chunk has been sent. Bodies too big for the
+# response cache are not collected at all.
+def cacheWhileStreaming(route, key, page, chunks):
+    (contentType, etag) = page
+    maxBytes = responseCache.getMaxBytes(route)
+    body = []
+    size = 0
+    for chunk in chunks:
+        if body is not None:
+            body.append(chunk)
+            size += len(chunk)
+            if size > maxBytes:
+                body = None
+        yield chunk
+
+    if body is not None:
+        responseCache.set(route, key, (contentType, ''.join(body), etag))
+
+# cachedPage()
+#______________________________________________________________________________
+# Returns the body for a page. createCatalog() is called only if the page
+# for this url, output mode, and device is not in the response cache, and
+# the catalog is rendered only if the client does not already have it.
+def cachedPage(route, url, mode, device, createCatalog, **renderArgs):
+    variant = mode
+    if 'html' == mode and device is not None:
+        variant += ':' + device.variant
+    key  = responseCache.makeKey(url, variant)
+    page = responseCache.get(route, key)
+
+    if page is None:
+        c = createCatalog()
+        etag = bookserver.conditional.catalogValidator(c, key)
+        if sendValidators(route, etag, mode):
+            return ''
+
+        (contentType, body) = renderCatalog(c, mode, device, route = route, **renderArgs)
+        web.header('Content-Type', contentType)
+        if not isinstance(body, str):
+            return cacheWhileStreaming(route, key, (contentType, etag), body)
+
+        responseCache.set(route, key, (contentType, body, etag))
+        return body
+
+    (contentType, body, etag) = page
+    if sendValidators(route, etag, mode):
+        return ''
+
+    web.header('Content-Type', contentType)
+    return body
+
+# snapshotResponse()
+#______________________________________________________________________________
+# Returns a page body from the static snapshot, or None.
+def snapshotResponse(route, name, mode, datestr):
+    body = snapshotPage(name, datestr)
+    if body is None:
+        return None
+
+    etag = bookserver.conditional.makeETag(body)
+    if sendValidators(route, etag, mode):
+        return ''
+
+    web.header('Content-Type', types[mode])
+    return body
 
 # /
 #______________________________________________________________________________
 class index:
     def GET(self, url):
         mode = 'xml'
+        device = None
         if url and url.endswith('.html'):
             mode = 'html'
+            device = getDevice()
 
         datestr = getDateString()
 
+        if device is None:
+            body = snapshotResponse('index', 'index.' + mode, mode, datestr)
+            if body is not None:
+                return body
+
+        return cachedPage('index', pubInfo['opdsroot'] + '/?date=' + datestr, mode, device,
+                          lambda: self.createCatalog(mode, datestr))
+
+    def createCatalog(self, mode, datestr):
         c = catalog.Catalog(
                             title     = 'Internet Archive Catalog',
                             urn       = pubInfo['urnroot'],
@@ -139,14 +448,7 @@ class index:
         o = catalog.OpenSearch(osDescriptionDoc)
         c.addOpenSearch(o)
 
-        if url and url.endswith('.html'):
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            web.header('Content-Type', 'text/html')
-            return r.toString()
-        else:
-            r = output.CatalogToAtom(c)
-            web.header('Content-Type', pubInfo['mimetype'])
-            return r.toString()
+        return c
 
 
 # /alpha/a/0
@@ -155,32 +457,30 @@ class alpha:
 
     def GET(self, letter, start):
         mode = 'xml'
+        device = None
         if not start:
             start = 0
         else:
             if start.endswith('.html'):
                 start = start[:-5]
                 mode = 'html'
+                device = getDevice()
             start = int(start)
 
-        solrUrl       = pubInfo['solr_base']+'&q='+pubInfo['query_base']+'+AND+firstTitle%3A'+letter.upper()+'&sort=titleSorter+asc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl       = queries['alpha'][mode].getUrl('firstTitle:'+letter.upper(), start=start*numRows)
         titleFragment = 'books starting with "%s"' % (letter.upper())
         urn           = pubInfo['urnroot'] + ':%s:%d'%(letter, start)
 
-        ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
-                                                start=start, numRows=numRows,
-                                                urlBase='/catalog/alpha/%s/' % (letter),
-                                                titleFragment = titleFragment)
-        c = ingestor.getCatalog()
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
+                                                    start=start, numRows=numRows,
+                                                    urlBase='/catalog/alpha/%s/' % (letter),
+                                                    titleFragment = titleFragment,
+                                                    transport = solrTransport,
+                                                    lazy = True)
+            return ingestor.getCatalog()
 
-        if 'html' == mode:
-            web.header('Content-Type', 'text/html')
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            return r.toString()
-        else:
-            web.header('Content-Type', pubInfo['mimetype'])
-            r = output.CatalogToAtom(c, fabricateContentElement=True)
-            return r.toString()
+        return cachedPage('alpha', solrUrl, mode, device, createCatalog, fabricateContentElement=True, stream=True)
 
 # /alpha.xml
 #______________________________________________________________________________
@@ -192,12 +492,47 @@ class alphaList:
         return url
 
     def GET(self, extension):
-        #IA is continuously scanning books. Since this OPDS file is constructed
-        #from search engine results, let's change the updated date every midnight
-        #TODO: create a version of /alpha.xml with the correct updated dates,
-        #and cache it for an hour to ease load on solr
+        #IA is continuously scanning books. The feed updated date changes every
+        #midnight, and each letter gets the date of its most recent book
         datestr = getDateString()
 
+        device = None
+        if 'html' == extension:
+            device = getDevice()
+
+        if device is None:
+            body = snapshotResponse('alphaList', 'alpha.' + extension, extension, datestr)
+            if body is not None:
+                return body
+
+        return cachedPage('alphaList', pubInfo['opdsroot'] + '/alpha?date=' + datestr, extension, device,
+                          lambda: self.createCatalog(extension, datestr))
+
+    # getLatestDates()
+    #___________________________________________________________________________
+    # Returns a dict of letter to the updated date of the newest book whose
+    # title starts with that letter. The 26 solr queries run concurrently.
+    def getLatestDates(self):
+        letterQueries = []
+        for letter in string.ascii_uppercase:
+            letterQueries.append({'url' : queries['alphaLatest']['xml'].getUrl('firstTitle:'+letter),
+                                  'urn' : pubInfo['urnroot'] + ':titles:' + letter.lower()})
+
+        try:
+            ingestors = catalog.ingest.IASolrToCatalog.createMany(pubInfo, letterQueries, transport=solrTransport)
+        except catalog.ingest.SolrTransportError:
+            return {}
+
+        dates = {}
+        for letter, ingestor in zip(string.ascii_uppercase, ingestors):
+            entries = ingestor.getCatalog().getEntries()
+            if entries:
+                dates[letter] = entries[0].get('updated')
+        return dates
+
+    def createCatalog(self, extension, datestr):
+        latestDates = self.getLatestDates()
+
         c = catalog.Catalog(
                             title     = 'Internet Archive - All Titles',
                             urn       = pubInfo['urnroot'] + ':titles:all',
@@ -221,7 +556,7 @@ class alphaList:
             l = catalog.Link(url = self.alphaURL(extension, lower, 0), type = linkType)
             e = catalog.Entry({'title'   : 'Titles: ' + letter,
                                'urn'     : pubInfo['urnroot'] + ':titles:'+lower,
-                               'updated' : datestr,
+                               'updated' : latestDates.get(letter, datestr),
                                'content' : 'Titles starting with ' + letter
                              }, links=(l,))
             c.addEntry(e)
@@ -230,108 +565,98 @@ class alphaList:
         o = catalog.OpenSearch(osDescriptionDoc)
         c.addOpenSearch(o)
 
-        if ('xml' == extension):
-            web.header('Content-Type', pubInfo['mimetype'])
-            r = output.CatalogToAtom(c)
-            return r.toString()
-        else:
-            web.header('Content-Type', 'text/html')
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            return r.toString()
+        return c
 
 # /downloads.xml
 #______________________________________________________________________________
 class downloads:
     def GET(self, extension):
-        solrUrl       = pubInfo['solr_base']+'&q='+pubInfo['query_base']+'&sort=month+desc&rows='+str(numRows)
+        if extension not in ('xml', 'html'):
+            web.seeother('/')
+            return
+
+        device = None
+        if 'html' == extension:
+            device = getDevice()
+
+        solrUrl       = queries['downloads'][extension].getUrl()
 
         titleFragment = 'Most Downloaded Books in the last Month'
         urn           = pubInfo['urnroot'] + ':downloads'
-        ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn, titleFragment=titleFragment)
-        c = ingestor.getCatalog()
-
-        if ('xml' == extension):
-            web.header('Content-Type', pubInfo['mimetype'])
-            r = output.CatalogToAtom(c, fabricateContentElement=True)
-            return r.toString()
-        elif ('html' == extension):
-            web.header('Content-Type', 'text/html')
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            return r.toString()
-        else:
-            web.seeother('/')
+
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn, titleFragment=titleFragment,
+                                                      transport=solrTransport, lazy=True)
+            return ingestor.getCatalog()
+
+        return cachedPage('downloads', solrUrl, extension, device, createCatalog, fabricateContentElement=True, stream=True)
 
 # /new/0
 #______________________________________________________________________________
 class newest:
-    def GET(self, start, extension):
-        if extension == '.html':
+    def GET(self, page, extension):
+        (start, cursor, isHtml) = parsePage(page)
+        if isHtml or extension == '.html':
             extension = 'html'
         else:
             extension = 'xml'
 
-        if not start:
-            start = 0
-        else:
-            if start.endswith('.html'):
-                extension = 'html'
-                start = start[:-5]
-            start = int(start)
-
+        device = None
+        if 'html' == extension:
+            device = getDevice()
 
-        solrUrl       = pubInfo['solr_base'] + '&q='+pubInfo['query_base']+'&sort=publicdate+desc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl       = pageUrl(queries['newest'][extension], start, cursor, numRows)
         titleFragment = 'books sorted by update date'
-        urn           = pubInfo['urnroot'] + ':new:%d' % (start)
-        ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
-                                                start=start, numRows=numRows,
-                                                urlBase='/catalog/new/',
-                                                titleFragment = titleFragment)
-        c = ingestor.getCatalog()
-
-        if 'html' == extension:
-            web.header('Content-Type', 'text/html')
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            return r.toString()
+        if cursor is None:
+            urn       = pubInfo['urnroot'] + ':new:%d' % (start)
         else:
-            web.header('Content-Type', pubInfo['mimetype'])
-            r = output.CatalogToAtom(c, fabricateContentElement=True)
-            return r.toString()
+            urn       = pubInfo['urnroot'] + ':new:c:' + cursor
+
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
+                                                    start=start, numRows=numRows,
+                                                    urlBase='/catalog/new/',
+                                                    titleFragment = titleFragment,
+                                                    transport = solrTransport,
+                                                    cursorFields = cursorFields,
+                                                    lazy = True)
+            return ingestor.getCatalog()
+
+        return cachedPage('newest', solrUrl, extension, device, createCatalog, fabricateContentElement=True, stream=True)
 
 # /crawlable/0
 #______________________________________________________________________________
 class crawlable:
-    def GET(self, start, extension):
-        if extension == '.html':
+    def GET(self, page, extension):
+        (start, cursor, isHtml) = parsePage(page)
+        if isHtml or extension == '.html':
             extension = 'html'
         else:
             extension = 'xml'
 
-        if not start:
-            start = 0
-        else:
-            if start.endswith('.html'):
-                extension = 'html'
-                start = start[:-5]
-            start = int(start)
+        device = None
+        if 'html' == extension:
+            device = getDevice()
 
         crawlNumRows = 1000;
-        solrUrl       = pubInfo['solr_base'] + '&q='+pubInfo['query_base']+'&rows='+str(crawlNumRows)+'&start='+str(start*crawlNumRows)
+        solrUrl       = pageUrl(queries['crawlable'][extension], start, cursor, crawlNumRows)
         titleFragment = '- crawlable feed'
-        urn           = pubInfo['urnroot'] + ':crawl:%d' % (start)
-        ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
-                                                start=start, numRows=crawlNumRows,
-                                                urlBase='/catalog/crawlable/',
-                                                titleFragment = titleFragment)
-        c = ingestor.getCatalog()
-
-        if 'html' == extension:
-            web.header('Content-Type', 'text/html')
-            r = output.ArchiveCatalogToHtml(c, device = getDevice())
-            return r.toString()
+        if cursor is None:
+            urn       = pubInfo['urnroot'] + ':crawl:%d' % (start)
         else:
-            web.header('Content-Type', pubInfo['mimetype'])
-            r = output.CatalogToAtom(c, fabricateContentElement=True)
-            return r.toString()
+            urn       = pubInfo['urnroot'] + ':crawl:c:' + cursor
+
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
+                                                    start=start, numRows=crawlNumRows,
+                                                    urlBase='/catalog/crawlable/',
+                                                    titleFragment = titleFragment,
+                                                    transport = solrTransport,
+                                                    cursorFields = cursorFields,
+                                                    lazy = True)
+            return ingestor.getCatalog()
+
+        return cachedPage('crawlable', solrUrl, extension, device, createCatalog, fabricateContentElement=True, stream=True)
 
 
 # /opensearch
@@ -347,20 +672,21 @@ class opensearch:
 
         q  = params['?q'][0]
         qq = urllib.quote(q)
-        solrUrl       = pubInfo['solr_base'] + '&q='+qq+'+AND+'+pubInfo['query_base']+'&sort=month+desc&rows='+str(numRows)+'&start='+str(start*numRows)
+        solrUrl       = queries['opensearch']['xml'].getUrl(q, start=start*numRows)
         titleFragment = 'search results for ' + q
         urn           = pubInfo['urnroot'] + ':search:%s:%d' % (qq, start)
 
-        ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
-                                                start=start, numRows=numRows,
-                                                urlBase='opensearch?q=%s&start=' % (qq),
-                                                titleFragment = titleFragment)
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
+                                                    start=start, numRows=numRows,
+                                                    urlBase='opensearch?q=%s&start=' % (qq),
+                                                    titleFragment = titleFragment,
+                                                    transport = solrTransport,
+                                                    lazy = True)
 
-        c = ingestor.getCatalog()
+            return ingestor.getCatalog()
 
-        web.header('Content-Type', pubInfo['mimetype'])
-        r = output.CatalogToAtom(c, fabricateContentElement=True)
-        return r.toString()
+        return cachedPage('opensearch', solrUrl, 'xml', None, createCatalog, fabricateContentElement=True, stream=True)
 
 # /search
 #______________________________________________________________________________
@@ -382,20 +708,22 @@ class htmlsearch:
 
         q  = params['q'][0]
         qq = urllib.quote(q)
-        solrUrl       = 'http://se.us.archive.org:8983/solr/select?q='+qq+'+AND+'+pubInfo['query_base']+'&fl=identifier,title,creator,oai_updatedate,date,contributor,publisher,subject,language,format&rows='+str(numRows)+'&start='+str(start*numRows)+'&wt=json'
+        solrUrl       = queries['htmlsearch']['html'].getUrl(q, start=start*numRows)
         titleFragment = 'search results for ' + q
         urn           = pubInfo['urnroot'] + ':search:%s:%d' % (qq, start)
+        device        = getDevice()
 
-        ingestor = catalog.ingest.SolrToCatalog(pubInfo, solrUrl, urn,
-                                                start=start, numRows=numRows,
-                                                urlBase='/search?q=%s&start=' % (qq), # XXX adding .html to end...
-                                                titleFragment = titleFragment)
+        def createCatalog():
+            ingestor = catalog.ingest.IASolrToCatalog(pubInfo, solrUrl, urn,
+                                                    start=start, numRows=numRows,
+                                                    urlBase='/search?q=%s&start=' % (qq), # XXX adding .html to end...
+                                                    titleFragment = titleFragment,
+                                                    transport = solrTransport,
+                                                    lazy = True)
 
-        c = ingestor.getCatalog()
+            return ingestor.getCatalog()
 
-        web.header('Content-Type', 'text/html')
-        r = output.ArchiveCatalogToHtml(c, device = getDevice())
-        return r.toString()
+        return cachedPage('htmlsearch', solrUrl, 'html', device, createCatalog, stream=True)
 
 # /opensearch.xml - Open Search Description
 #______________________________________________________________________________
@@ -411,6 +739,26 @@ class openSearchDescription:
 </OpenSearchDescription>""" % (pubInfo['opdsroot'])
 
 
+# /stats - cache statistics, one "name value" line each
+#______________________________________________________________________________
+class stats:
+    def GET(self):
+        if web.ctx.ip not in statsClients:
+            raise web.notfound()
+
+        lines = []
+        caches = [('responseCache', responseCache.backend)]
+        caches += [('entryCache.' + mode, cache) for (mode, cache) in sorted(entryCaches.items())]
+        for (name, cache) in caches:
+            if not hasattr(cache, 'getStats'):
+                continue
+            for (key, value) in sorted(cache.getStats().items()):
+                lines.append('%s.%s %s\n' % (name, key, value))
+
+        web.header('Content-Type', 'text/plain')
+        return ''.join(lines)
+
+
 # redirect to remove trailing slash
 #______________________________________________________________________________
 class redirect:
@@ -424,9 +772,30 @@ class indexRedirect:
         web.seeother('/')
 
 
+# writeSnapshot()
+#______________________________________________________________________________
+# Renders the navigation feeds, in both output modes, to static files.
+snapshotPages = (
+    ('index.xml',  index,     'xml'),
+    ('index.html', index,     'html'),
+    ('alpha.xml',  alphaList, 'xml'),
+    ('alpha.html', alphaList, 'html'),
+    )
+
+def writeSnapshot(snapshot):
+    datestr = getDateString()
+    for (name, page, mode) in snapshotPages:
+        (contentType, body) = renderCatalog(page().createCatalog(mode, datestr), mode)
+        snapshot.write(name, body)
+
+
 # main() - standalone mode
 #______________________________________________________________________________
 if __name__ == "__main__":
-    #run in standalone mode
-    app = web.application(urls, globals())
-    app.run()
+    if 3 == len(sys.argv) and '--snapshot' == sys.argv[1]:
+        #e.g. from cron: opds.py --snapshot /var/www/catalog-snapshot
+        writeSnapshot(bookserver.snapshot.Snapshot(sys.argv[2]))
+    else:
+        #run in standalone mode
+        app = web.application(urls, globals())
+        app.run(compressMiddleware)
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Times the html renderers, ArchiveCatalogToHtml and
+TemplateArchiveCatalogToHtml, on the feeds in test/feeds, and checks that
+they render the same page.
+
+    python bench_html_render.py [--entries N] [feed.xml ...]
+
+--entries repeats the entries of each feed up to N entries, to time pages
+of the size opds.py serves. Rendering the search form fetches the
+opensearch description once, so the first run needs network access.
+"""
+
+import glob
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+testDir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(testDir, '..'))
+
+from bookserver.catalog import OpenSearch
+from bookserver.catalog.ingest import OpdsToCatalog
+from bookserver.catalog.output import ArchiveCatalogToHtml, TemplateArchiveCatalogToHtml
+
+osDescription = 'http://bookserver.archive.org/catalog/opensearch.xml'
+
+# loadCatalog()
+#______________________________________________________________________________
+def loadCatalog(path, numEntries):
+    f = open(path, 'rb')
+    c = OpdsToCatalog(f.read(), 'file://' + path).getCatalog()
+    f.close()
+
+    if c._opensearch is None:
+        c.addOpenSearch(OpenSearch(osDescription))
+
+    entries = c._entries
+    if numEntries and entries:
+        c._entries = [entries[i % len(entries)] for i in range(numEntries)]
+    return c
+
+# bench()
+#______________________________________________________________________________
+# Returns the best time of several runs of f, in milliseconds.
+def bench(f, runs):
+    best = None
+    for i in range(runs):
+        t = time.time()
+        f()
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    return best * 1000.0
+
+# benchFeed()
+#______________________________________________________________________________
+def benchFeed(path, numEntries):
+    c = loadCatalog(path, numEntries)
+
+    #also fetches and caches the opensearch description
+    lxmlPage     = ArchiveCatalogToHtml(c).toString()
+    templatePage = TemplateArchiveCatalogToHtml(c).toString()
+
+    runs = max(5, 2000 / max(1, len(c._entries)))
+    lxmlTime     = bench(lambda: ArchiveCatalogToHtml(c).toString(), runs)
+    templateTime = bench(lambda: TemplateArchiveCatalogToHtml(c).toString(), runs)
+
+    print '%s: %d entries, %d bytes' % (os.path.basename(path), len(c._entries), len(lxmlPage))
+    print '    %-30s %8.2fms' % ('ArchiveCatalogToHtml', lxmlTime)
+    print '    %-30s %8.2fms  %.1fx' % ('TemplateArchiveCatalogToHtml', templateTime, lxmlTime / templateTime)
+    if lxmlPage != templatePage:
+        print '    pages differ!'
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [--entries N] [feed.xml ...]')
+    parser.add_option('--entries', type='int', default=0,
+                      help='repeat the entries of each feed up to N entries')
+    (options, args) = parser.parse_args()
+
+    paths = args or sorted(glob.glob(os.path.join(testDir, 'feeds', '*.xml')))
+    for path in paths:
+        benchFeed(path, options.entries)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Times the decoding of Solr responses: each installed JSON module, ijson
+streaming, key renaming, and building a whole catalog with IASolrToCatalog.
+
+    python bench_solr_decode.py [response.json ...]
+
+Pass recorded responses, e.g. saved with bench_solr_fq.py --record or with
+curl from the urls opds.py requests. Without arguments, responses of 50
+and 1000 rows are made up in the format of the archive.org solr.
+"""
+
+import cStringIO
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import simplejson
+from bookserver.catalog.ingest import IASolrToCatalog, SolrToCatalog, SolrDecoder, KeyMap
+from bookserver.catalog.ingest.SolrDecoder import jsonModule, ijson
+
+pubInfo = {
+    'name'     : 'Internet Archive',
+    'uri'      : 'http://www.archive.org',
+    'opdsroot' : 'http://bookserver.archive.org/catalog',
+    'urnroot'  : 'urn:x-internet-archive:bookserver:catalog',
+}
+
+# makeResponse()
+#______________________________________________________________________________
+def makeResponse(numRows):
+    docs = []
+    for i in range(numRows):
+        docs.append({
+            'identifier'  : 'book%05d' % (i),
+            'title'       : u'The Collected Works of Author %d, Volume %d \xe9' % (i, i % 7),
+            'creator'     : [u'Author %d' % (i), u'Editor, An'],
+            'publicdate'  : '2009-%02d-%02dT12:00:00Z' % (1 + i % 12, 1 + i % 28),
+            'date'        : '%d-01-01T00:00:00Z' % (1850 + i % 100),
+            'contributor' : [u'University of California Libraries'],
+            'publisher'   : [u'London : Macmillan and co.'],
+            'subject'     : [u'History', u'Literature', u'Poetry'],
+            'language'    : [u'eng'],
+            'format'      : [u'Abbyy GZ', u'Animated GIF', u'DjVu', u'Scandata', u'Text PDF'],
+            'month'       : i * 3,
+        })
+    return simplejson.dumps({'response': {'numFound': 123456, 'start': 0, 'docs': docs}})
+
+# bench()
+#______________________________________________________________________________
+# Prints the best time of several runs of f, in milliseconds.
+def bench(label, f, runs):
+    best = None
+    for i in range(runs):
+        t = time.time()
+        f()
+        elapsed = time.time() - t
+        if best is None or elapsed < best:
+            best = elapsed
+    print '    %-36s %8.2fms' % (label, best * 1000.0)
+
+# benchResponse()
+#______________________________________________________________________________
+def benchResponse(name, data):
+    import json
+    docs = simplejson.loads(data)['response']['docs']
+    print '%s: %d docs, %d bytes' % (name, len(docs), len(data))
+    runs = max(5, 20000 / max(1, len(docs)))
+
+    bench('json.loads', lambda: json.loads(data), runs)
+    bench('simplejson.loads', lambda: simplejson.loads(data), runs)
+    try:
+        import ujson
+        bench('ujson.loads', lambda: ujson.loads(data), runs)
+    except ImportError:
+        print '    ujson not installed'
+
+    decoder = SolrDecoder()
+    bench('SolrDecoder.decode (%s)' % (jsonModule), lambda: decoder.decode(data), runs)
+    if ijson is not None:
+        backend = ijson.__name__.split('.')[-1]
+        bench('SolrDecoder.stream (ijson %s)' % (backend),
+              lambda: list(decoder.stream(cStringIO.StringIO(data))[1]), runs)
+    else:
+        print '    ijson not installed'
+
+    keymap = SolrToCatalog.keymap
+    bench('keymap generator', lambda: [dict((keymap[key], val) for key, val in doc.iteritems()) for doc in docs], runs)
+    keyMap = KeyMap(keymap)
+    bench('KeyMap.translate', lambda: [keyMap.translate(doc) for doc in docs], runs)
+
+    bench('IASolrToCatalog', lambda: IASolrToCatalog(pubInfo, None, pubInfo['urnroot'], response=data), runs)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        for path in sys.argv[1:]:
+            f = open(path, 'rb')
+            benchResponse(path, f.read())
+            f.close()
+    else:
+        for numRows in (50, 1000):
+            benchResponse('%d rows' % (numRows), makeResponse(numRows))
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Copyright(c)2009 Internet Archive. Software license AGPL version 3.
+
+This file is part of bookserver.
+
+    bookserver is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    bookserver is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with bookserver.  If not, see <http://www.gnu.org/licenses/>.
+
+    The bookserver source is hosted at http://github.com/internetarchive/bookserver/
+
+Compares solr query time for the constant pubInfo restrictions sent as
+part of q (the old query_base) and as separate filter queries (fq).
+
+Runs the catalog's alpha, downloads and search queries against a solr
+server, several rounds each, and prints solr's QTime and the wall clock
+time for both variants. The first round is reported separately, since it
+fills solr's caches.
+
+    python bench_solr_fq.py --solr http://localhost:8983/solr/select
+
+Responses can be recorded with --record DIR and the QTimes reported again
+later, without a server, with --recorded DIR.
+"""
+
+import glob
+import os
+import sys
+import time
+
+from optparse import OptionParser
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import opds
+from bookserver.catalog.ingest import SolrQuery, SolrTransport
+
+searchTerms = ('twain', 'history', 'poetry', 'science', 'england', 'war',
+               'dickens', 'music', 'america', 'shakespeare')
+
+# getWorkload()
+#______________________________________________________________________________
+# Returns {variant: [(name, query, clause, start)]}. The requests in a round
+# are all different; later rounds repeat them with warm solr caches.
+def getWorkload(solrBase):
+    filterQueries = tuple(opds.pubInfo['filter_queries'])
+    queryBase     = ' AND '.join(filterQueries)
+    fields        = opds.solrFields['xml']
+
+    variants = {}
+    for variant in ('q', 'fq'):
+        if 'q' == variant:
+            kwargs = {'q': queryBase}
+        else:
+            kwargs = {'filterQueries': filterQueries}
+
+        def query(sort):
+            return SolrQuery(solrBase, sort=sort, fields=fields, rows=opds.numRows,
+                             omitHeader=False, **kwargs)
+
+        alpha     = query('titleSorter asc')
+        downloads = query('month desc')
+
+        requests = []
+        for letter in 'ABCDEFGHIJKLMNOPQRSTUVWXYZ':
+            requests.append(('alpha', alpha, 'firstTitle:' + letter, 0))
+        for page in range(5):
+            requests.append(('downloads', downloads, None, page * opds.numRows))
+        for term in searchTerms:
+            requests.append(('search', downloads, term, 0))
+        variants[variant] = requests
+
+    return variants
+
+# run()
+#______________________________________________________________________________
+# Returns {variant: [(round, name, qtime, wallTime)]}
+def run(solrBase, rounds, recordDir):
+    transport = SolrTransport(maxConnections = 1)
+    variants  = getWorkload(solrBase)
+    results   = dict((variant, []) for variant in variants)
+
+    for r in range(rounds):
+        #alternate the variants, so both see the same server state
+        for variant in sorted(variants):
+            for (i, (name, query, clause, start)) in enumerate(variants[variant]):
+                url = query.getUrl(clause, start=start)
+                t = time.time()
+                body = transport.get(url)
+                wallTime = (time.time() - t) * 1000.0
+
+                qtime = json.loads(body)['responseHeader']['QTime']
+                results[variant].append((r, name, qtime, wallTime))
+
+                if recordDir is not None:
+                    path = os.path.join(recordDir, '%s-%03d-%03d.json' % (variant, r, i))
+                    f = open(path, 'wb')
+                    f.write(body)
+                    f.close()
+
+    transport.close()
+    return results
+
+# readRecorded()
+#______________________________________________________________________________
+def readRecorded(recordDir):
+    results = {}
+    for path in sorted(glob.glob(os.path.join(recordDir, '*.json'))):
+        (variant, r, i) = os.path.basename(path)[:-len('.json')].split('-')
+        f = open(path, 'rb')
+        qtime = json.load(f)['responseHeader']['QTime']
+        f.close()
+        results.setdefault(variant, []).append((int(r), i, qtime, None))
+    return results
+
+# percentile()
+#______________________________________________________________________________
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+# report()
+#______________________________________________________________________________
+def report(results):
+    print '%-8s %-6s %6s %8s %8s %8s %10s' % ('variant', 'round', 'count', 'qtime', 'p50', 'p90', 'wall p50')
+    for variant in sorted(results):
+        for (label, warm) in (('first', False), ('rest', True)):
+            rows = [row for row in results[variant] if (row[0] > 0) == warm]
+            if not rows:
+                continue
+
+            qtimes = [row[2] for row in rows]
+            walls  = [row[3] for row in rows if row[3] is not None]
+            if walls:
+                wall = '%8.1fms' % (percentile(walls, 0.5))
+            else:
+                wall = '-'
+
+            print '%-8s %-6s %6d %6.1fms %6dms %6dms %10s' % (variant, label, len(rows),
+                float(sum(qtimes)) / len(qtimes), percentile(qtimes, 0.5), percentile(qtimes, 0.9), wall)
+
+
+if __name__ == '__main__':
+    parser = OptionParser(usage='%prog [--solr URL] [--rounds N] [--record DIR | --recorded DIR]')
+    parser.add_option('--solr', default='http://localhost:8983/solr/select',
+                      help='solr select url [default: %default]')
+    parser.add_option('--rounds', type='int', default=5,
+                      help='number of times to run the workload [default: %default]')
+    parser.add_option('--record', metavar='DIR',
+                      help='save the solr responses in DIR')
+    parser.add_option('--recorded', metavar='DIR',
+                      help='report on responses saved with --record, without querying solr')
+    (options, args) = parser.parse_args()
+
+    if options.recorded:
+        report(readRecorded(options.recorded))
+    else:
+        if options.record and not os.path.exists(options.record):
+            os.makedirs(options.record)
+        report(run(options.solr, options.rounds, options.record))